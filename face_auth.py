@@ -1,9 +1,11 @@
 from facenet_pytorch import InceptionResnetV1
-from PIL import Image
 import torch
 import numpy as np
 import torchvision.transforms as transforms
 import time
+from utils.image_pipeline import load_stored_normalized, resize_to_box, derivative_or_original
+
+FACE_INPUT_SIZE = (160, 160)
 
 # Check if GPU is available and use it
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -15,12 +17,14 @@ def get_embeddings(image_paths):
     imgs = []
     for image_path in image_paths:
         start_time = time.time()  # Start timing for image loading
-        img = Image.open(image_path).convert('RGB')
+        img = load_stored_normalized(image_path)
         load_time = time.time() - start_time  # Calculate time taken to load the image
         print(f"Loading {image_path} time: {load_time:.2f} seconds")
         
         start_time = time.time()  # Start timing for resizing
-        img = transforms.Resize((160, 160))(img)
+        # Ingested uploads already have a 160x160 face image, only raw probes need resizing
+        if img.size != FACE_INPUT_SIZE:
+            img = resize_to_box(img, FACE_INPUT_SIZE)
         resize_time = time.time() - start_time  # Calculate time taken to resize the image
         print(f"Resizing {image_path} time: {resize_time:.2f} seconds")
         
@@ -36,8 +40,9 @@ def get_embeddings(image_paths):
 
 def is_face_match(stored_image_path, test_image_path):
     """Compare a stored face with a test image and return True/False."""
-    # Get embeddings for both images
-    embeddings = get_embeddings([stored_image_path, test_image_path])
+    # Get embeddings for both images, using the pre-generated face crop when available
+    stored_face_path = derivative_or_original(stored_image_path, "face")
+    embeddings = get_embeddings([stored_face_path, test_image_path])
     
     # If embeddings are not found, return False
     if embeddings is None or len(embeddings) < 2:
@@ -0,0 +1,27 @@
+import os
+import threading
+import firebase_admin
+from firebase_admin import db, credentials
+
+class FirebaseConfig:
+    CREDENTIALS_PATH = os.getenv(
+        "FIREBASE_CREDENTIALS",
+        "firebase_json/visitor-management-bbd7c-firebase-adminsdk-fbsvc-c39ae22327.json"
+    )
+    DATABASE_URL = os.getenv("FIREBASE_DATABASE_URL", "https://visitor-management-bbd7c-default-rtdb.firebaseio.com/")
+
+_init_lock = threading.Lock()
+
+def get_firebase_app():
+    """Initialize the Firebase Admin SDK on first use rather than at import time"""
+    with _init_lock:
+        if not firebase_admin._apps:
+            print("Initializing Firebase...")
+            cred = credentials.Certificate(FirebaseConfig.CREDENTIALS_PATH)
+            firebase_admin.initialize_app(cred, {"databaseURL": FirebaseConfig.DATABASE_URL})
+            print("Firebase initialized successfully")
+        return firebase_admin.get_app()
+
+def firebase_reference(path: str = "/"):
+    get_firebase_app()
+    return db.reference(path)
@@ -1,36 +1,27 @@
 from datetime import datetime, timedelta
-import firebase_admin
-from firebase_admin import db, credentials
+from firebase_config import firebase_reference
 from typing import Dict, Any
-import json
+from utils.event_logger import BufferedEventLogger
+from utils.app_user_cache import AppUserCacheUnavailable, AppUserCredentialCache
+from utils.event_sinks import create_event_sink
+from utils.live_stats import LiveStats, LiveStatsConfig
 
 class FirebaseController:
     def __init__(self):
-        try:
-            # Debugging: Firebase Initialization start
-            print("Initializing Firebase...")
-            
-            # Initialize Firebase Admin SDK if not already initialized
-            if not firebase_admin._apps:
-                print("Firebase not initialized. Initializing now...")
-                cred = credentials.Certificate("firebase_json/visitor-management-bbd7c-firebase-adminsdk-fbsvc-c737c089a5.json")
-                firebase_admin.initialize_app(cred, {
-                    'databaseURL': 'https://visitor-management-bbd7c-default-rtdb.firebaseio.com/'
-                })
-                print("Firebase initialized successfully")
-            else:
-                print("Firebase already initialized")
+        # Events go to the configured sink; Firebase itself is only initialized when first needed
+        self.event_sink = create_event_sink()
+        self.event_logger = BufferedEventLogger(self.event_sink.write_batch)
+        # App user credentials are served from a local index kept in sync with Firebase
+        self.app_user_cache = AppUserCredentialCache(lambda: firebase_reference('app_users'))
+        # Dashboards read aggregated counters instead of one event per scan
+        self.live_stats = LiveStats()
+        self._ref = None
 
-            # Get reference to the root of your Firebase database
-            self.ref = db.reference('/')
-            self.events_ref = self.ref.child('events')
-            self.logs_ref = self.ref.child('logs')
-            self.success_ref = self.ref.child('success')
-            self.error_ref = self.ref.child('error')
-
-        except Exception as e:
-            print(f"Firebase initialization error: {str(e)}")
-            raise
+    @property
+    def ref(self):
+        if self._ref is None:
+            self._ref = firebase_reference('/')
+        return self._ref
 
     def log_event(self, event_type: str, data: Dict[str, Any]) -> None:
         try:
@@ -40,10 +31,7 @@ class FirebaseController:
                 "type": event_type,
                 **data
             }
-            # Debugging: Event data being pushed to Firebase
-            print(f"Logging event: {event_type} with data: {json.dumps(event_data)}")
-            self.events_ref.push(event_data)
-            print(f"Event logged successfully: {event_type}")
+            self.event_logger.enqueue("events", event_data)
         except Exception as e:
             print(f"Error logging event: {str(e)}")
 
@@ -54,10 +42,8 @@ class FirebaseController:
                 "message": message,
                 "timestamp": datetime.now().isoformat()
             }
-            # Debugging: Server activity log data
             print(f"Logging server activity: {log_type} with message: {message}")
-            self.logs_ref.push(log_data)
-            print(f"Server activity logged successfully: {log_type}")
+            self.event_logger.enqueue("logs", log_data)
         except Exception as e:
             print(f"Error logging server activity: {str(e)}")
 
@@ -71,8 +57,8 @@ class FirebaseController:
             "success": success,
             "message": message
         }
-        print(f"Logging QR scan event: {user_name} ({'Success' if success else 'Failure'})")
-        self.log_event("qr_scan", event_data)
+        if LiveStatsConfig.RAW_EVENTS:
+            self.log_event("qr_scan", event_data)
 
     def log_face_verification(self, user_id: int, user_name: str, matched: bool) -> None:
         """
@@ -83,8 +69,8 @@ class FirebaseController:
             "user_name": user_name,
             "matched": matched
         }
-        print(f"Logging face verification event: {user_name} ({'Matched' if matched else 'Not matched'})")
-        self.log_event("face_verification", event_data)
+        if LiveStatsConfig.RAW_EVENTS:
+            self.log_event("face_verification", event_data)
 
     def log_user_creation(self, user_id: int, user_name: str, user_type: str) -> None:
         """
@@ -100,22 +86,17 @@ class FirebaseController:
 
     def verify_app_user(self, user_name: str, user_password: str) -> Dict[str, Any]:
         """
-        Verify user credentials
+        Verify user credentials against the local app user cache
         """
         print(f"Verifying user credentials for {user_name}...")
         try:
-            user_ref = self.ref.child('app_users')
-            all_users = user_ref.get()
-            print(f"Fetched users from Firebase: {json.dumps(all_users)}")
-
-            if all_users is not None:
-                for user_id, user in all_users.items():  # Iterate through the dictionary of users
-                    print(f"Checking user {user['name']} against {user_name}")
-                    if user['name'] == user_name and user['password'] == user_password:
-                        print(f"User found: {user_name}")
-                        return {"status": True, "message": "User found", "email": user['email']}
+            user = self.app_user_cache.verify(user_name, user_password)
+            if user:
+                return {"status": True, "message": "User found", "email": user['email']}
             print(f"User not found: {user_name}")
             return {"status": False, "message": "User not found", "email": None}
+        except AppUserCacheUnavailable:
+            raise
         except Exception as e:
             print(f"Error verifying user: {str(e)}")
             return {"status": False, "message": "Verification failed", "email": None}
@@ -126,26 +107,13 @@ class FirebaseController:
         """
         print(f"Creating user: {user_name}")
         try:
-            user_ref = self.ref.child('app_users')
-            all_users = user_ref.get()
-
-            if all_users is not None:
-                print(f"Users fetched from Firebase: {json.dumps(all_users)}")
-                for user_id, user in all_users.items():
-                    if user['name'] == user_name:
-                        print(f"User {user_name} already exists!")
-                        return {"status": False, "message": "User already exists"}
-            
-            # User does not exist, create new user
-            user_ref.push({
-                "name": user_name,
-                "password": user_password,
-                "email": user_email,
-                "unique_id_type": unique_id_type,
-                "unique_id": unique_id
-            })
+            if not self.app_user_cache.add(user_name, user_password, user_email, unique_id_type, unique_id):
+                print(f"User {user_name} already exists!")
+                return {"status": False, "message": "User already exists"}
             print(f"User {user_name} created successfully")
             return {"status": True, "message": "User created successfully"}
+        except AppUserCacheUnavailable:
+            raise
         except Exception as e:
             print(f"Error creating user: {str(e)}")
             return {"status": False, "message": "User creation failed"}
@@ -160,7 +128,7 @@ class FirebaseController:
             "message": message
         }
         print(f"Logging success event: {user_name} ({message})")
-        self.success_ref.push(event_data)
+        self.event_logger.enqueue("success", event_data)
 
     def log_error(self, user_id: int, user_name: str, message: str) -> None:
         """
@@ -172,7 +140,17 @@ class FirebaseController:
             "message": message
         }
         print(f"Logging error event: {user_name} ({message})")
-        self.error_ref.push(event_data)
+        self.event_logger.enqueue("error", event_data)
+
+    def start_live_stats(self) -> None:
+        self.live_stats.start(self.event_sink.write_batch)
+
+    def close(self) -> None:
+        """Write out queued events and stop background threads, used on shutdown"""
+        self.event_logger.close()
+        self.live_stats.stop(self.event_sink.write_batch)
+        self.event_sink.close()
+        self.app_user_cache.close()
 
 # Create a single instance
 firebase_controller = FirebaseController()
@@ -1,27 +1,28 @@
-import os
+import threading
 from fastapi import FastAPI, Depends, UploadFile, File, Form, Query
 from fastapi.responses import  JSONResponse
 from sqlalchemy.orm import Session
 from database import SessionLocal, engine
 import models
-import shutil
-from uuid import uuid4
 from fastapi import HTTPException
 import base64
 from fastapi.middleware.cors import CORSMiddleware
 import traceback
-import firebase_admin
-from firebase_admin import credentials
 from sqlalchemy import func
-
-# Remove the existing Firebase initialization
-# Initialize Firebase Admin SDK with the correct credentials
-cred = credentials.Certificate("firebase_json/visitor-management-bbd7c-firebase-adminsdk-fbsvc-c39ae22327.json")
-firebase_admin.initialize_app(cred, {
-    'databaseURL': 'https://visitor-management-bbd7c-default-rtdb.firebaseio.com/'
-})
-
-from routes import analytics, app_users_handler, face_recognition, institutions, push_update, qr, users
+from utils.file_handlers import save_upload_file, save_probe_upload, release_upload_file, purge_upload_file, UploadSizeLimitMiddleware
+from utils.image_pipeline import derivative_or_original
+from utils.storage import storage
+from template_generator import invalidate_cards
+from qr_generation import render_qr_png, require_signing_key, user_qr_payload
+from qr_decoder import shutdown_decode_pool
+
+from routes import analytics, app_users_handler, email_outbox, face_recognition, institutions, push_update, qr, users
+from firebase_controller import firebase_controller
+from utils.live_stats import seed_live_stats
+from utils.email_handler import mail_worker, outbox_dispatcher
+from utils.email_outbox import OutboxConfig
+from utils.api_key_cache import api_key_cache
+from utils.security import upgrade_api_key_storage
 
 app = FastAPI()
 
@@ -34,11 +35,12 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+# Reject oversized uploads before their bodies are parsed
+app.add_middleware(UploadSizeLimitMiddleware)
+
 # Create Tables
 models.Base.metadata.create_all(bind=engine)
-UPLOAD_DIR = "uploads"
-if not os.path.exists(UPLOAD_DIR):
-    os.makedirs(UPLOAD_DIR)
+upgrade_api_key_storage(engine)
 
 # Dependency to get DB session
 def get_db():
@@ -56,6 +58,37 @@ app.include_router(face_recognition.router)
 app.include_router(app_users_handler.router, prefix="/app_users", tags=["app_users"])
 app.include_router(analytics.router, )
 app.include_router(push_update.router, )
+app.include_router(email_outbox.router, prefix="/email_outbox", tags=["email_outbox"])
+
+@app.on_event("startup")
+def warm_caches():
+    # Every QR code, card and welcome email needs the signing key
+    require_signing_key()
+    # Load app user credentials in the background so the first login does not wait for Firebase
+    threading.Thread(target=firebase_controller.app_user_cache.start, daemon=True).start()
+    # Cached API keys are only served while revocations from other workers can be heard
+    api_key_cache.start()
+
+    db = SessionLocal()
+    try:
+        seed_live_stats(db)
+    except Exception as e:
+        print(f"Error seeding live stats: {str(e)}")
+    finally:
+        db.close()
+    firebase_controller.start_live_stats()
+
+    if OutboxConfig.IN_APP:
+        outbox_dispatcher.start()
+
+@app.on_event("shutdown")
+def shutdown_workers():
+    shutdown_decode_pool()
+    firebase_controller.close()
+    outbox_dispatcher.stop()
+    mail_worker.close()
+    api_key_cache.close()
+
 @app.get("/")
 async def check():
     return {True}
@@ -75,11 +108,7 @@ async def verify_face(
         raise HTTPException(status_code=404, detail="User not found")
 
     # Save the uploaded verification image
-    verify_image_filename = f"verify_{uuid4().hex}_{image.filename}"
-    verify_image_path = os.path.join(UPLOAD_DIR, verify_image_filename)
-    
-    with open(verify_image_path, "wb") as buffer:
-        shutil.copyfileobj(image.file, buffer)
+    verify_image_path = await save_probe_upload(image)
 
     # Perform face verification (implement your face recognition logic here)
     face_matched = True  # Replace with actual face verification logic
@@ -124,6 +153,7 @@ def update_user(
 
     # Track if any changes were made
     changes_made = False
+    replaced_image_path = None
 
     # Update basic fields if provided
     if name is not None and name.strip():  # Check if name is not None and not empty
@@ -164,17 +194,11 @@ def update_user(
         print(f"Updating aadhar_number to: {aadhar_number}")
 
     if image:
-        # Handle image update
-        if user.image_path and os.path.exists(user.image_path):
-            try:
-                os.remove(user.image_path)
-            except Exception as e:
-                print(f"Error deleting old image: {e}")
-
-        image_filename = f"{uuid4().hex}_{image.filename}"
-        image_path = os.path.join(UPLOAD_DIR, image_filename)
-        with open(image_path, "wb") as buffer:
-            shutil.copyfileobj(image.file, buffer)
+        # Handle image update; the old blob is only removed if no other user shares it
+        image_path = save_upload_file(image, db)
+        release_upload_file(db, user.image_path)
+        if user.image_path != image_path:
+            replaced_image_path = user.image_path
         user.image_path = image_path
         changes_made = True
         print(f"Updating image path to: {image_path}")
@@ -187,6 +211,10 @@ def update_user(
         print("Committing changes to database...")
         db.commit()
         db.refresh(user)
+        if replaced_image_path:
+            purge_upload_file(db, replaced_image_path)
+        # Drop the cached visitor card; the next download renders one from the new inputs
+        invalidate_cards(user.user_id)
 
         # Debug: Print user after update
         print(f"After update - User data: {user.__dict__}")
@@ -221,9 +249,13 @@ def delete_user(
     db.query(models.QRScan).filter(models.QRScan.user_id == user_id).delete()
     db.query(models.FaceRecognition).filter(models.FaceRecognition.user_id == user_id).delete()
     
-    # Delete user
+    # Delete user and drop its reference on the uploaded image
+    image_path = user.image_path
+    release_upload_file(db, image_path)
     db.delete(user)
     db.commit()
+    purge_upload_file(db, image_path)
+    invalidate_cards(user_id)
     return {"message": "User deleted successfully"}
 
 @app.get("/users/{user_id}")
@@ -247,7 +279,7 @@ def get_user(
                         "is_instructor": user.is_instructor,
                         "institution": user.institution.name if user.institution else None,
                         "image_path": f"/user/image/{user.user_id}?is_quick_register=false",
-                        "qr_code_path": f"/qr_code/{user.user_id}",
+                        "qr_code_path": f"/qr/image/{user.user_id}",
                         "qr_code": user.qr_code,
                         "is_quick_register": False
                     },
@@ -270,10 +302,8 @@ def get_user(
 
                 # Add QR code base64 if exists
                 try:
-                    if user.qr_code and os.path.exists(user.qr_code):
-                        with open(user.qr_code, "rb") as qr_file:
-                            qr_data = base64.b64encode(qr_file.read()).decode()
-                            response_data["qr_base64"] = f"data:image/png;base64,{qr_data}"
+                    qr_data = base64.b64encode(render_qr_png(user_qr_payload(user))).decode()
+                    response_data["qr_base64"] = f"data:image/png;base64,{qr_data}"
                 except Exception as qr_error:
                     print(f"Error processing QR code: {str(qr_error)}")
                     response_data["qr_base64"] = None
@@ -303,10 +333,11 @@ def get_user(
         # Add base64 encoded image if exists
         try:
             image_path = user.image_path if not is_quick_register else quick_user.image_path
-            if image_path and os.path.exists(image_path):
-                with open(image_path, "rb") as img_file:
-                    img_data = base64.b64encode(img_file.read()).decode()
-                    response_data["image_base64"] = f"data:image/jpeg;base64,{img_data}"
+            image_path = derivative_or_original(image_path, "thumb")
+            if image_path and storage.exists(image_path):
+                media_type = "image/webp" if image_path.endswith(".webp") else "image/jpeg"
+                img_data = base64.b64encode(storage.read_bytes(image_path)).decode()
+                response_data["image_base64"] = f"data:{media_type};base64,{img_data}"
         except Exception as img_error:
             print(f"Error processing image: {str(img_error)}")
             response_data["image_base64"] = None
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Date, UniqueConstraint
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Date, Float, UniqueConstraint, Index, Text
 from sqlalchemy.orm import relationship, backref
 from datetime import datetime
 from database import Base
@@ -24,7 +24,7 @@ class User(Base):
     unique_id_type = Column(String, unique=False, nullable=False)
     unique_id = Column(String, unique=False, nullable=False)
     image_path = Column(String)
-    qr_code = Column(String, nullable=True)
+    qr_code = Column(String, nullable=True)  # Legacy stored QR path; QR images are rendered on request
     is_student = Column(Boolean, default=False)
     is_instructor = Column(Boolean, default=False)
     is_quick_register = Column(Boolean, default=False)
@@ -49,7 +49,8 @@ class AppUsers(Base):
     unique_id = Column(String, unique=False, nullable=False)
     image_path = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
-    api_key = Column(String, unique=True, nullable=True)
+    api_key = Column(String, unique=True, nullable=True)  # Legacy plaintext key, hashed at startup
+    api_key_hash = Column(String(64), unique=True, index=True, nullable=True)
     api_key_expiry = Column(DateTime, nullable=True)
 
 class FinalRecords(Base):
@@ -87,3 +88,98 @@ class FinalRecords(Base):
         # Ensure unique combination of user_id, entry_date, and attempt_number
         UniqueConstraint('user_id', 'entry_date'),
     )
+
+
+class UploadBlob(Base):
+    __tablename__ = "upload_blobs"
+
+    # SHA-256 of the uploaded bytes, also used as the storage file name
+    digest = Column(String(64), primary_key=True)
+    path = Column(String, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class EmailOutbox(Base):
+    __tablename__ = "email_outbox"
+
+    outbox_id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False)
+    template = Column(String, nullable=False)
+    # pending -> sending -> sent, or back to pending for a retry, or failed once attempts run out
+    status = Column(String, nullable=False, default="pending")
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    locked_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        # One email per user and template; re-sends reset the existing row
+        UniqueConstraint('user_id', 'template'),
+        Index('ix_email_outbox_due', 'status', 'next_attempt_at'),
+    )
+
+class RollupMeasures:
+    """Counters shared by the analytics rollup tables, kept current by the scan, verify and departure paths"""
+    # Dimensions; institution_id is 0 for users without an institution
+    institution_id = Column(Integer, primary_key=True, default=0)
+    entry_type = Column(String, primary_key=True)
+    face_verified = Column(Boolean, primary_key=True)
+    qr_verified = Column(Boolean, primary_key=True)
+    instructor_verified = Column(Boolean, primary_key=True)
+
+    entries = Column(Integer, nullable=False, default=0)
+    new_visitors = Column(Integer, nullable=False, default=0)  # First entry of a user's record for the day
+    completed = Column(Integer, nullable=False, default=0)
+    duration_seconds = Column(Float, nullable=False, default=0)
+    completion_seconds = Column(Float, nullable=False, default=0)
+    completion_under_1m = Column(Integer, nullable=False, default=0)
+    completion_1_2m = Column(Integer, nullable=False, default=0)
+    completion_2_5m = Column(Integer, nullable=False, default=0)
+
+class AnalyticsHourlyRollup(RollupMeasures, Base):
+    __tablename__ = "analytics_hourly_rollups"
+
+    bucket_hour = Column(DateTime, primary_key=True, index=True)  # Start of the hour, Asia/Kolkata local time
+
+class AnalyticsDailyRollup(RollupMeasures, Base):
+    __tablename__ = "analytics_daily_rollups"
+
+    day = Column(Date, primary_key=True, index=True)  # Asia/Kolkata local date
+
+class AnalyticsHourlyHistogram(Base):
+    """Log-bucketed counts of completion and dwell times per local hour; bins of any range add up"""
+    __tablename__ = "analytics_hourly_histograms"
+
+    bucket_hour = Column(DateTime, primary_key=True, index=True)  # Start of the hour, Asia/Kolkata local time
+    institution_id = Column(Integer, primary_key=True, default=0)
+    metric = Column(String, primary_key=True)  # "completion" or "duration"
+    bin = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+class AnalyticsVisitorSketch(Base):
+    """HyperLogLog registers of the users seen per local hour; a range merges with max() per register"""
+    __tablename__ = "analytics_visitor_sketches"
+
+    bucket_hour = Column(DateTime, primary_key=True, index=True)  # Start of the hour, Asia/Kolkata local time
+    institution_id = Column(Integer, primary_key=True, default=0)
+    register = Column(Integer, primary_key=True)
+    rank = Column(Integer, nullable=False)
+
+class AnalyticsRollupGeneration(Base):
+    """Single row bumped by every rollup rebuild; cached closed days of an older generation are not served"""
+    __tablename__ = "analytics_rollup_generation"
+
+    id = Column(Integer, primary_key=True, default=1)
+    generation = Column(Integer, nullable=False, default=0)
+
+class LiveStatsCounter(Base):
+    """Per-minute live counters flushed by every worker; the published live stats snapshot sums them"""
+    __tablename__ = "live_stats_counters"
+
+    day = Column(Date, primary_key=True, index=True)  # UTC date, like FinalRecords.entry_date
+    operator_id = Column(Integer, primary_key=True, default=0)  # 0 without an operator, -1 for the startup backfill
+    bucket_minute = Column(DateTime, primary_key=True)
+    metric = Column(String, primary_key=True)  # arrivals, departures or verification:<outcome>
+    count = Column(Integer, nullable=False, default=0)
@@ -0,0 +1,79 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import Optional
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+
+# Longest side tried for each attempt; small frames decode fastest, full resolution is the last resort
+DECODE_SCALES = (640, 1024, None)
+
+_detector = None
+_pool = None
+
+def _get_detector():
+    global _detector
+    if _detector is None:
+        _detector = cv2.QRCodeDetector()
+    return _detector
+
+def _downscale(image: Image.Image, max_side: Optional[int]) -> Image.Image:
+    if max_side is None or max(image.size) <= max_side:
+        return image
+    scaled = image.copy()
+    scaled.thumbnail((max_side, max_side), Image.Resampling.BILINEAR)
+    return scaled
+
+def decode_frame(frame: bytes) -> dict:
+    """
+    Decode a QR code from one camera frame, trying downscaled copies first.
+    Runs inside a pool worker, so it only takes and returns picklable values.
+    """
+    start_time = time.perf_counter()
+    attempts = []
+    try:
+        image = ImageOps.exif_transpose(Image.open(BytesIO(frame))).convert("L")
+        tried = set()
+        for max_side in DECODE_SCALES:
+            candidate = _downscale(image, max_side)
+            if candidate.size in tried:
+                continue
+            tried.add(candidate.size)
+
+            attempt_start = time.perf_counter()
+            data, points, _ = _get_detector().detectAndDecode(np.asarray(candidate))
+            attempts.append({
+                "size": list(candidate.size),
+                "ms": round((time.perf_counter() - attempt_start) * 1000, 2),
+            })
+            if data:
+                return {
+                    "data": data,
+                    "attempts": attempts,
+                    "decode_ms": round((time.perf_counter() - start_time) * 1000, 2),
+                }
+        error = "No QR code found"
+    except Exception as e:
+        error = str(e)
+    return {
+        "data": None,
+        "error": error,
+        "attempts": attempts,
+        "decode_ms": round((time.perf_counter() - start_time) * 1000, 2),
+    }
+
+def get_decode_pool() -> ProcessPoolExecutor:
+    """Process pool shared by decode requests, created on first use"""
+    global _pool
+    if _pool is None:
+        workers = int(os.getenv("QR_DECODE_WORKERS", "0")) or min(4, os.cpu_count() or 1)
+        _pool = ProcessPoolExecutor(max_workers=workers)
+    return _pool
+
+def shutdown_decode_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
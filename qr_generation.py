@@ -1,35 +1,194 @@
 import qrcode
+import base64
+import binascii
+import hashlib
+import hmac
 import os
-import json
+import struct
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import Optional
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+from utils.image_pipeline import save_image
+from utils.storage import storage
 QR_DIR = "qrs"
-os.makedirs(QR_DIR,exist_ok=True)
-
-def generate_qr_code(user_id : int, name : str, email : str):
-    # Create a dictionary with user data
-    user_data = {
-        "user_id": user_id,
-        "name": name,
-        "email": email
-    }
-    # Convert to JSON string
-    qr_data = json.dumps(user_data)
-    qr = qrcode.make(qr_data)
-    qr_path = os.path.join(QR_DIR,f"qr_code_{user_id}.png")
-    qr.save(qr_path)
-    # Convert to JSON string
-    qr_data = json.dumps(user_data)
+
+# PNG text chunk holding the hash of the encoded payload, used to skip unchanged codes
+PAYLOAD_HASH_KEY = "payload-sha256"
+
+class QRConfig:
+    SIGNING_KEY = os.getenv("QR_SIGNING_KEY", "")
+    # Accept the legacy plain user_id form field at the gate while old printed codes are in circulation
+    ACCEPT_UNSIGNED = os.getenv("QR_ACCEPT_UNSIGNED", "true").lower() == "true"
+
+# Compact payload: version (1 byte) + user id (4 bytes) + truncated HMAC-SHA256 (8 bytes),
+# base32-encoded without padding so the QR code is generated in alphanumeric mode
+PAYLOAD_VERSION = 1
+PAYLOAD_LENGTH = 13
+SIGNATURE_LENGTH = 8
+
+class QRSignatureError(ValueError):
+    """The QR signing key is missing, so payloads can be neither signed nor verified"""
+
+def _signing_key() -> bytes:
+    if not QRConfig.SIGNING_KEY:
+        raise QRSignatureError("QR signing key not configured, set QR_SIGNING_KEY")
+    return QRConfig.SIGNING_KEY.encode()
+
+def require_signing_key() -> None:
+    """Fail at startup rather than on the first QR code generated or scanned"""
+    _signing_key()
+
+def _sign(body: bytes) -> bytes:
+    return hmac.new(_signing_key(), body, hashlib.sha256).digest()[:SIGNATURE_LENGTH]
+
+def qr_payload(user_id: int) -> str:
+    """Build the signed string encoded into a user's QR code"""
+    body = struct.pack(">BI", PAYLOAD_VERSION, user_id)
+    return base64.b32encode(body + _sign(body)).decode().rstrip("=")
+
+def verify_qr_payload(code: str) -> Optional[int]:
+    """Return the user id of a genuine QR payload, or None, without touching the database"""
+    code = (code or "").strip().upper()
+    if len(code) != 21:
+        return None
+    try:
+        raw = base64.b32decode(code + "===")
+    except (binascii.Error, ValueError):
+        return None
+    if len(raw) != PAYLOAD_LENGTH or raw[0] != PAYLOAD_VERSION:
+        return None
+    body, signature = raw[:5], raw[5:]
+    if not hmac.compare_digest(signature, _sign(body)):
+        return None
+    return struct.unpack(">BI", body)[1]
+
+def payload_hash(payload: str) -> str:
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def qr_path_for(user_id: int) -> str:
+    return f"{QR_DIR}/qr_code_{user_id}.png"
+
+def stored_payload_hash(qr_path: str):
+    """Read the payload hash recorded in an existing QR image, if any"""
+    try:
+        return Image.open(BytesIO(storage.read_bytes(qr_path))).text.get(PAYLOAD_HASH_KEY)
+    except Exception:
+        return None
+
+class LRUBytesCache:
+    """Bounded, thread-safe LRU of encoded images with hit/miss counters"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: bytes) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "bytes": sum(len(v) for v in self._entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0,
+            }
+
+qr_cache = LRUBytesCache(max_entries=int(os.getenv("QR_CACHE_SIZE", "4096")))
+
+def render_qr_png(payload: str) -> bytes:
+    """Render a QR code to PNG bytes in memory, served from the LRU cache when possible"""
+    key = payload_hash(payload)
+    png = qr_cache.get(key)
+    if png is None:
+        buffer = BytesIO()
+        qrcode.make(payload).save(buffer, "PNG", optimize=True)
+        png = buffer.getvalue()
+        qr_cache.put(key, png)
+    return png
+
+def user_qr_payload(user) -> str:
+    return qr_payload(user.user_id)
+
+def qr_etag(payload: str) -> str:
+    return f'"{payload_hash(payload)[:32]}"'
+
+def generate_qr_code(user_id : int):
+    qr_data = qr_payload(user_id)
     qr = qrcode.make(qr_data)
-    qr_path = os.path.join(QR_DIR,f"qr_code_{user_id}.png")
-    qr.save(qr_path)
+    metadata = PngInfo()
+    metadata.add_text(PAYLOAD_HASH_KEY, payload_hash(qr_data))
+    qr_path = qr_path_for(user_id)
+    # Storage writes go through temp-file-and-rename, so readers never see a partial PNG
+    save_image(qr, qr_path, "PNG", pnginfo=metadata)
     return qr_path
 
-def generate_qr_codes(users : list[dict]):
-    for user in users:
-        user_data = {
-            "user_id": user["user_id"],
-            "name": user["name"],
-            "email": user["email"]
-        }
-        qr_data = json.dumps(user_data)
-        qr_path = generate_qr_code(qr_data)
-        print(f"QR code generated for {user['name']} at {qr_path}")
+def _generate_if_changed(user: dict, force: bool = False) -> dict:
+    """Worker task: regenerate one user's QR unless its payload is unchanged"""
+    try:
+        qr_path = qr_path_for(user["user_id"])
+        expected_hash = payload_hash(qr_payload(user["user_id"]))
+        if not force and stored_payload_hash(qr_path) == expected_hash:
+            return {"user_id": user["user_id"], "status": "skipped", "path": qr_path}
+        qr_path = generate_qr_code(user["user_id"])
+        return {"user_id": user["user_id"], "status": "generated", "path": qr_path}
+    except Exception as e:
+        return {"user_id": user["user_id"], "status": "failed", "error": str(e)}
+
+def generate_qr_codes(users : list[dict], workers: int = None, force: bool = False) -> dict:
+    """
+    Regenerate QR codes for many users across a process pool.
+    users is a list of dicts with at least a user_id.
+    """
+    start_time = time.perf_counter()
+    results = []
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for result in pool.map(_generate_if_changed, users, [force] * len(users), chunksize=32):
+            results.append(result)
+            if result["status"] == "failed":
+                print(f"QR code generation failed for user {result['user_id']}: {result['error']}")
+
+    seconds = time.perf_counter() - start_time
+    stats = {
+        "total": len(results),
+        "generated": sum(1 for r in results if r["status"] == "generated"),
+        "skipped": sum(1 for r in results if r["status"] == "skipped"),
+        "failed": [r for r in results if r["status"] == "failed"],
+        "paths": {r["user_id"]: r["path"] for r in results if r["status"] != "failed"},
+        "seconds": round(seconds, 2),
+        "codes_per_second": round(len(results) / seconds, 2) if seconds > 0 else 0,
+    }
+    print(
+        f"QR codes: {stats['generated']} generated, {stats['skipped']} unchanged, "
+        f"{len(stats['failed'])} failed in {stats['seconds']} s ({stats['codes_per_second']}/s)"
+    )
+    return stats
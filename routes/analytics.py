@@ -1,11 +1,14 @@
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
-from sqlalchemy import func, distinct
-from dependencies import get_db
+from sqlalchemy import func, distinct, text
+from dependencies import get_db, get_current_app_user
 import models
+from utils.analytics_cache import AnalyticsCacheConfig, analytics_cache, local_today, single_flight
+from utils.analytics_engine import OccupancyConfig, heatmap, load_frame, occupancy
+from utils.analytics_rollups import distribution_summary, logs_cte, record_filters, visit_intervals
 from datetime import datetime, timedelta, timezone
 from typing import Optional
-from collections import defaultdict
+import numpy as np
 
 router = APIRouter()
 
@@ -45,7 +48,65 @@ def validate_date_range(start_date: Optional[datetime], end_date: Optional[datet
     
     return start_date, end_date
 
+def as_count(value) -> int:
+    """Rollup sums come back as floats from the analytics frame"""
+    return int(round(float(value)))
+
+def recent_scans(db: Session, start_day, end_day, institution_id=None, user_id=None, limit: int = 10) -> list:
+    """Completion times of the latest scans, expanded in Postgres from the newest records only"""
+    record_filter, _, params = record_filters(start_day, end_day, institution_id, user_id)
+    newest_filter, _, _ = record_filters(start_day, end_day, institution_id, user_id, records="fr", users="fu")
+    newest_records = f"""r.record_id IN (
+        SELECT fr.record_id FROM final_records fr JOIN users fu ON fu.user_id = fr.user_id
+        WHERE {newest_filter}
+        ORDER BY fr.entry_date DESC, fr.record_id DESC
+        LIMIT :limit
+    )"""
+    rows = db.execute(text(f"""
+        WITH {logs_cte(f"{record_filter} AND {newest_records}")}
+        SELECT local_arrival, entry_type, instructor_verified, completion_minutes
+        FROM scored
+        ORDER BY arrival DESC
+        LIMIT :limit
+    """), {**params, "limit": limit}).mappings().all()
+    return [{
+        'time': round(row['completion_minutes'], 2),
+        'date': row['local_arrival'].date().isoformat(),
+        'type': row['entry_type'],
+        'verification_type': 'instructor' if row['entry_type'] == 'group_entry' and row['instructor_verified'] else 'normal'
+    } for row in reversed(rows)]
+
+def ongoing_users(db: Session, start_day, end_day, institution_id=None, user_id=None) -> list:
+    """
+    Entries without a departure on the open days of the range; older entries never closed are not ongoing.
+    Only records still holding an open entry are expanded, and only those log entries leave the database.
+    """
+    start_day = max(start_day, local_today() - timedelta(days=AnalyticsCacheConfig.OPEN_DAYS - 1))
+    if start_day > end_day:
+        return []
+    record_filter, _, params = record_filters(start_day, end_day, institution_id, user_id)
+    open_records = """jsonb_typeof(r.time_logs) = 'array' AND EXISTS (
+        SELECT 1 FROM jsonb_array_elements(r.time_logs) AS open_log
+        WHERE COALESCE(open_log->>'departure', '') = ''
+    )"""
+    rows = db.execute(text(f"""
+        WITH {logs_cte(f"{record_filter} AND {open_records}")}
+        SELECT user_id, arrival, entry_type FROM logs WHERE departure IS NULL
+    """), params).mappings().all()
+    current_time = get_current_time()
+    ongoing = []
+    for row in rows:
+        arrival_time = convert_to_system_time(row['arrival'])
+        ongoing.append({
+            'user_id': row['user_id'],
+            'arrival_time': arrival_time.isoformat(),
+            'duration_so_far': round((current_time - arrival_time).total_seconds() / 60, 2),
+            'entry_type': row['entry_type']
+        })
+    return ongoing
+
 @router.get("/analytics")
+@single_flight("analytics")
 def get_analytics(
     start_date: Optional[datetime] = None,
     end_date: Optional[datetime] = None,
@@ -56,176 +117,51 @@ def get_analytics(
     try:
         # Initialize date range with IST
         start_date, end_date = validate_date_range(start_date, end_date)
-
-        # Build base query filters
-        base_filters = [
-            models.FinalRecords.entry_date.between(start_date.date(), end_date.date())
-        ]
-        if institution_id:
-            base_filters.append(models.User.institution_id == institution_id)
-        if user_id:
-            base_filters.append(models.FinalRecords.user_id == user_id)
-
-        # Initialize statistics containers
-        stats = {
-            'hourly_stats': defaultdict(int),
-            'verification_stats': {
-                'total_attempts': 0,
-                'face_success': 0,
-                'qr_success': 0,
-                'both_success': 0,
-                'group_success': 0,
-                'failures': 0
-            },
-            'entry_types': defaultdict(int),
-            'daily_stats': defaultdict(lambda: {
-                'entries': 0,
-                'successes': 0,
-                'unique_users': set(),
-                'group_entries': 0,
-                'group_successes': 0
-            }),
-            'completion_times': [],
-            'duration_stats': [],
-            'ongoing_users': []
+        start_day, end_day = start_date.date(), end_date.date()
+
+        # One query loads the range; a single user's logs are aggregated the same way in Postgres
+        frame = load_frame(db, start_day, end_day, institution_id, user_id)
+
+        entries_by_hour = frame.by_hour()
+        hourly_stats = {int(hour): as_count(entries_by_hour[hour]) for hour in frame.active_hours()}
+
+        group = frame.of_type('group_entry')
+        success = frame.success
+        verification = {
+            'total_attempts': as_count(frame.total()),
+            'face_success': as_count(frame.total(mask=frame.face | (group & frame.instructor))),
+            'qr_success': as_count(frame.total(mask=frame.qr)),
+            'both_success': as_count(frame.total(mask=success)),
+            'group_success': as_count(frame.total(mask=success & group)),
+        }
+        entry_types = {name: as_count(count) for name, count in frame.by_type().items()}
+
+        day_entries = frame.by_day()
+        day_successes = frame.by_day(mask=success)
+        day_visitors = frame.by_day('new_visitors')
+        day_groups = frame.by_day(mask=group)
+        daily_stats = {
+            frame.day_label(index): {
+                'entries': as_count(day_entries[index]),
+                'successes': as_count(day_successes[index]),
+                'unique_users': as_count(day_visitors[index]),
+                'group_entries': as_count(day_groups[index]),
+            }
+            for index in frame.active_days()
+        }
+        completion = {
+            measure: frame.total(measure)
+            for measure in ('completed', 'duration_seconds', 'completion_seconds',
+                            'completion_under_1m', 'completion_1_2m', 'completion_2_5m')
         }
 
-        # Process records
-        records = db.query(models.FinalRecords).filter(*base_filters).order_by(
-            models.FinalRecords.entry_date.desc()
-        ).all()
-
-        for record in records:
-            for log in record.time_logs:
-                # Basic time processing
-                arrival_time = convert_to_system_time(datetime.fromisoformat(log['arrival']))
-                hour = arrival_time.hour
-                date_str = arrival_time.date().isoformat()
-
-                # Track entry type
-                entry_type = log.get('entry_type', 'normal')
-                stats['entry_types'][entry_type] += 1
-
-                # Track hourly distribution
-                stats['hourly_stats'][hour] += 1
-
-                # Process verification stats
-                stats['verification_stats']['total_attempts'] += 1
-                is_success = False
-
-                # Debug prints
-                print(f"\nProcessing entry:")
-                print(f"Entry type: {entry_type}")
-                print(f"Face verified: {log.get('face_verified')}")
-                print(f"QR verified: {log.get('qr_verified')}")
-                print(f"Instructor verified: {log.get('verified_by_instructor')}")
-
-                # Check face verification - Include both direct face verification and instructor verification
-                if log.get('face_verified') is True or (entry_type == 'group_entry' and log.get('verified_by_instructor') is True):
-                    stats['verification_stats']['face_success'] += 1
-                    print(f"Face verification counted. Total face success: {stats['verification_stats']['face_success']}")
-
-                # Check QR verification
-                if log.get('qr_verified') is True:
-                    stats['verification_stats']['qr_success'] += 1
-                    print(f"QR verification counted. Total QR success: {stats['verification_stats']['qr_success']}")
-
-                # Determine overall success
-                if entry_type == 'group_entry':
-                    # Group entry is successful if verified by instructor OR face verified
-                    if log.get('verified_by_instructor') is True or log.get('face_verified') is True:
-                        is_success = True
-                        stats['verification_stats']['group_success'] += 1
-                        stats['verification_stats']['both_success'] += 1
-                        print("Group entry success counted")
-                else:
-                    # Normal entry is successful if both face AND QR are verified
-                    if log.get('face_verified') is True and log.get('qr_verified') is True:
-                        is_success = True
-                        stats['verification_stats']['both_success'] += 1
-                        print("Normal entry success counted")
-
-                # Update success counters
-                if is_success:
-                    stats['daily_stats'][date_str]['successes'] += 1
-                    print(f"Success added to daily stats. Date: {date_str}")
-                else:
-                    stats['verification_stats']['failures'] += 1
-                    print("Entry marked as failure")
-
-                # Print running totals
-                print(f"\nRunning totals:")
-                print(f"Total attempts: {stats['verification_stats']['total_attempts']}")
-                print(f"Face successes: {stats['verification_stats']['face_success']}")
-                print(f"QR successes: {stats['verification_stats']['qr_success']}")
-                print(f"Overall successes: {stats['verification_stats']['both_success']}")
-                print(f"Group successes: {stats['verification_stats']['group_success']}")
-                print(f"Failures: {stats['verification_stats']['failures']}")
-
-                # Update daily statistics
-                stats['daily_stats'][date_str]['entries'] += 1
-                stats['daily_stats'][date_str]['unique_users'].add(record.user_id)
-                if entry_type == 'group_entry':
-                    stats['daily_stats'][date_str]['group_entries'] += 1
-
-                # Calculate completion time with improved logic
-                if log.get('arrival'):
-                    arrival = datetime.fromisoformat(log['arrival'])
-                    arrival_utc = convert_to_system_time(arrival)
-                    
-                    if entry_type == 'group_entry':
-                        completion_time = 0.5  # Set default 30 seconds for group entries
-                        verification_type = 'instructor' if log.get('verified_by_instructor') else 'normal'
-                    else:
-                        # For normal entries
-                        if log.get('face_verification_time'):
-                            verification_time = convert_to_system_time(
-                                datetime.fromisoformat(log['face_verification_time'])
-                            )
-                            completion_time = (verification_time - arrival_utc).total_seconds() / 60
-                        else:
-                            completion_time = 1.0  # Set default 1 minute for normal entries
-                        verification_type = 'normal'
-                    
-                    stats['completion_times'].append({
-                        'time': round(completion_time, 2),
-                        'date': arrival_utc.date().isoformat(),
-                        'type': entry_type,
-                        'verification_type': verification_type
-                    })
-
-                # Track ongoing users (no departure time)
-                current_time = get_current_time()
-                if log.get('arrival') and not log.get('departure'):
-                    arrival_time = convert_to_system_time(datetime.fromisoformat(log['arrival']))
-                    duration_so_far = (current_time - arrival_time).total_seconds() / 60
-                    
-                    stats['ongoing_users'].append({
-                        'user_id': record.user_id,
-                        'arrival_time': arrival_time.isoformat(),
-                        'duration_so_far': round(duration_so_far, 2),
-                        'entry_type': entry_type
-                    })
-
-                # Calculate duration if available
-                if log.get('arrival') and log.get('departure'):
-                    arrival = convert_to_system_time(datetime.fromisoformat(log['arrival']))
-                    departure = convert_to_system_time(datetime.fromisoformat(log['departure']))
-                    duration = (departure - arrival).total_seconds() / 60
-                    if duration > 0:
-                        stats['duration_stats'].append(duration)
-
-        # Calculate derived metrics
-        total_entries = stats['verification_stats']['total_attempts']
-        total_success = stats['verification_stats']['both_success']
-        total_group_entries = stats['entry_types'].get('group_entry', 0)
-        group_success = stats['verification_stats'].get('group_success', 0)
-
-        # Debug final calculations
-        print(f"\nFinal calculations:")
-        print(f"Total entries: {total_entries}")
-        print(f"Total success: {total_success}")
-        print(f"Success rate: {(total_success / total_entries * 100) if total_entries > 0 else 0}%")
+        total_entries = verification['total_attempts']
+        total_success = verification['both_success']
+        total_group_entries = entry_types.get('group_entry', 0)
+        group_success = verification['group_success']
+        recent = recent_scans(db, start_day, end_day, institution_id, user_id)
+        distribution = distribution_summary(db, start_day, end_day, institution_id, user_id)
+        ongoing = ongoing_users(db, start_day, end_day, institution_id, user_id)
 
         return {
             "time_range": {
@@ -236,16 +172,16 @@ def get_analytics(
             "traffic_analysis": {
                 "peak_hours": [
                     get_hour_range(hour)
-                    for hour, count in stats['hourly_stats'].items()
-                    if count >= max(stats['hourly_stats'].values()) * 0.8
+                    for hour, count in hourly_stats.items()
+                    if count >= max(hourly_stats.values()) * 0.8
                 ],
                 "hourly_distribution": {
                     get_hour_range(hour): count
-                    for hour, count in stats['hourly_stats'].items()
+                    for hour, count in hourly_stats.items()
                 },
                 "busiest_periods": sorted(
-                    [(get_hour_range(hour), count) 
-                     for hour, count in stats['hourly_stats'].items()],
+                    [(get_hour_range(hour), count)
+                     for hour, count in hourly_stats.items()],
                     key=lambda x: x[1],
                     reverse=True
                 )[:3]
@@ -256,11 +192,11 @@ def get_analytics(
                     if total_entries > 0 else 0, 2
                 ),
                 "face_verification_rate": round(
-                    (stats['verification_stats']['face_success'] / total_entries * 100)
+                    (verification['face_success'] / total_entries * 100)
                     if total_entries > 0 else 0, 2
                 ),
                 "qr_verification_rate": round(
-                    (stats['verification_stats']['qr_success'] / total_entries * 100)
+                    (verification['qr_success'] / total_entries * 100)
                     if total_entries > 0 else 0, 2
                 ),
                 "group_success_rate": round(
@@ -270,56 +206,54 @@ def get_analytics(
             },
             "scan_efficiency": {
                 "average_completion_time_minutes": round(
-                    sum(entry['time'] for entry in stats['completion_times']) / 
-                    len(stats['completion_times'])
-                    if stats['completion_times'] else 0, 2
+                    completion['completion_seconds'] / 60 / total_entries
+                    if total_entries > 0 else 0, 2
                 ),
                 "recent_average_completion_time_minutes": round(
-                    sum(entry['time'] for entry in stats['completion_times'][-10:]) / 
-                    len(stats['completion_times'][-10:])
-                    if stats['completion_times'][-10:] else 0, 2
-                ),
-                "recent_scans": [{
-                    'time': entry['time'],
-                    'date': entry['date'],
-                    'type': entry['type'],
-                    'verification_type': entry['verification_type']
-                } for entry in stats['completion_times'][-10:]],
-                "total_valid_scans": len(stats['completion_times']),
-                "completion_rate": round(
-                    (len(stats['completion_times']) / total_entries * 100)
-                    if total_entries > 0 else 0, 2
+                    sum(entry['time'] for entry in recent) / len(recent)
+                    if recent else 0, 2
                 ),
+                "recent_scans": recent,
+                "total_valid_scans": total_entries,
+                # Every entry has an arrival, so every entry has a completion time
+                "completion_rate": 100.0 if total_entries > 0 else 0,
                 "completion_time_distribution": {
-                    "under_1_minute": len([e for e in stats['completion_times'] if e['time'] <= 1]),
-                    "1_to_2_minutes": len([e for e in stats['completion_times'] if 1 < e['time'] <= 2]),
-                    "2_to_5_minutes": len([e for e in stats['completion_times'] if 2 < e['time'] <= 5])
-                }
+                    "under_1_minute": int(completion['completion_under_1m']),
+                    "1_to_2_minutes": int(completion['completion_1_2m']),
+                    "2_to_5_minutes": int(completion['completion_2_5m'])
+                },
+                "completion_time_percentiles_minutes": distribution['completion_time_percentiles_minutes']
             },
             "entry_statistics": {
                 "total_entries": total_entries,
-                "entry_types": dict(stats['entry_types']),
+                "unique_visitors": {
+                    "count": distribution['unique_visitors'],
+                    # "sketch" counts are HyperLogLog estimates, "exact" ones are distinct counts
+                    "mode": distribution['mode']
+                },
+                "entry_types": dict(entry_types),
                 "average_duration_minutes": round(
-                    sum(stats['duration_stats']) / len(stats['duration_stats'])
-                    if stats['duration_stats'] else 0, 2
+                    completion['duration_seconds'] / 60 / completion['completed']
+                    if completion['completed'] else 0, 2
                 ),
+                "duration_percentiles_minutes": distribution['duration_percentiles_minutes'],
                 "daily_patterns": {
                     date: {
                         "total_entries": data['entries'],
                         "successful_entries": data['successes'],
-                        "unique_users": len(data['unique_users']),
+                        "unique_users": data['unique_users'],
                         "group_entries": data['group_entries'],
                         "success_rate": round(
                             (data['successes'] / data['entries'] * 100)
                             if data['entries'] > 0 else 0, 2
                         )
                     }
-                    for date, data in stats['daily_stats'].items()
+                    for date, data in daily_stats.items()
                 },
                 "ongoing_users": {
-                    "count": len(stats['ongoing_users']),
+                    "count": len(ongoing),
                     "details": sorted(
-                        stats['ongoing_users'],
+                        ongoing,
                         key=lambda x: x['duration_so_far'],
                         reverse=True
                     )
@@ -331,6 +265,7 @@ def get_analytics(
         raise HTTPException(status_code=500, detail=f"Analytics error: {str(e)}")
 
 @router.get("/analytics/overview")
+@single_flight("overview")
 def get_analytics_overview(
     start_date: Optional[datetime] = None,
     end_date: Optional[datetime] = None,
@@ -361,84 +296,52 @@ def get_analytics_overview(
             models.User.user_id == models.FinalRecords.user_id
         ).filter(*base_filters).first()
 
-        # Entry Type Distribution
-        entries_by_type = []
-        for record in db.query(models.FinalRecords).filter(*base_filters).all():
-            for log in record.time_logs:
-                entries_by_type.append(log.get('entry_type', 'normal'))
+        # Entry, duration and verification counts come from the rollups, loaded once
+        frame = load_frame(db, start_date.date(), end_date.date(), institution_id)
 
+        # Entry Type Distribution
         entry_distribution = {
-            'normal': entries_by_type.count('normal'),
-            'bypass': entries_by_type.count('bypass'),
-            'group': len([e for e in entries_by_type if 'group_entry' in str(e)])
+            'normal': as_count(frame.total(mask=frame.of_type('normal'))),
+            'bypass': as_count(frame.total(mask=frame.of_type('bypass'))),
+            'group': as_count(frame.total(mask=frame.matching_types(lambda name: 'group_entry' in name)))
         }
 
         # Time Analysis
         time_analysis = {
             'average_duration': timedelta(0),
-            'total_entries': 0,
-            'completed_entries': 0
+            'total_entries': as_count(frame.total()),
+            'completed_entries': as_count(frame.total('completed'))
         }
-
-        for record in db.query(models.FinalRecords).filter(*base_filters).all():
-            for log in record.time_logs:
-                time_analysis['total_entries'] += 1
-                if log.get('departure'):
-                    time_analysis['completed_entries'] += 1
-                    arrival = datetime.fromisoformat(log['arrival'])
-                    departure = datetime.fromisoformat(log['departure'])
-                    time_analysis['average_duration'] += (departure - arrival)
-
         if time_analysis['completed_entries'] > 0:
             time_analysis['average_duration'] = str(
-                time_analysis['average_duration'] / time_analysis['completed_entries']
+                timedelta(seconds=frame.total('duration_seconds')) / time_analysis['completed_entries']
             )
 
         # Daily Statistics
-        daily_stats = []
-        current_date = start_date
-        while current_date <= end_date:
-            day_records = db.query(models.FinalRecords).filter(
-                models.FinalRecords.entry_date == current_date.date(),
-                *base_filters
-            ).all()
-
-            daily_entry_count = sum(len(record.time_logs) for record in day_records)
-            daily_stats.append({
-                'date': current_date.date().isoformat(),
-                'total_entries': daily_entry_count,
-                'unique_users': len(set(record.user_id for record in day_records))
-            })
-            current_date += timedelta(days=1)
+        day_entries = frame.by_day()
+        day_visitors = frame.by_day('new_visitors')
+        daily_stats = [
+            {
+                'date': frame.day_label(index),
+                'total_entries': as_count(day_entries[index]),
+                'unique_users': as_count(day_visitors[index])
+            }
+            for index in range(len(frame.days))
+        ]
 
         # Verification Statistics
+        group = frame.of_type('group')
         verification_stats = {
-            'face_verified': 0,
-            'qr_verified': 0,
-            'both_verified': 0,
-            'total_entries': 0,
-            'group_verifications': 0,
-            'group_verification_success': 0,
-            'instructor_verifications': 0,
+            'face_verified': as_count(frame.total(mask=frame.face)),
+            'qr_verified': as_count(frame.total(mask=frame.qr)),
+            'both_verified': as_count(frame.total(mask=frame.strict_success)),
+            'total_entries': as_count(frame.total()),
+            'group_verifications': as_count(frame.total(mask=group)),
+            'group_verification_success': as_count(frame.total(mask=group & frame.face)),
+            'instructor_verifications': as_count(frame.total(mask=group & frame.instructor)),
             'instructor_led_entries': 0
         }
 
-        for record in db.query(models.FinalRecords).filter(*base_filters).all():
-            for log in record.time_logs:
-                verification_stats['total_entries'] += 1
-                if log.get('face_verified'):
-                    verification_stats['face_verified'] += 1
-                if log.get('qr_verified'):
-                    verification_stats['qr_verified'] += 1
-                if log.get('face_verified') and log.get('qr_verified'):
-                    verification_stats['both_verified'] += 1
-                if log.get('entry_type') == 'group':
-                    verification_stats['group_verifications'] += 1
-                    if log.get('face_verified') and (log.get('verified_by_instructor') or log.get('face_verified')):
-                        verification_stats['group_verification_success'] += 1
-                    if log.get('verified_by_instructor'):
-                        verification_stats['instructor_verifications'] += 1
-
         # User Type Analysis
         user_type_stats = db.query(
             models.User.is_instructor,
@@ -504,6 +407,7 @@ def get_analytics_overview(
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/analytics/user/{user_id}")
+@single_flight("user")
 def get_user_analytics(
     user_id: int,
     start_date: Optional[datetime] = None,
@@ -516,72 +420,39 @@ def get_user_analytics(
         if not start_date:
             start_date = end_date - timedelta(days=30)
 
-        user_records = db.query(models.FinalRecords).filter(
-            models.FinalRecords.user_id == user_id,
-            models.FinalRecords.entry_date.between(start_date.date(), end_date.date())
-        ).all()
+        # The user's logs, aggregated per local hour in Postgres and summed here
+        frame = load_frame(db, start_date.date(), end_date.date(), user_id=user_id)
 
+        entry_types = {'normal': 0, 'bypass': 0, 'group': 0}
+        entry_types.update({name: as_count(count) for name, count in frame.by_type().items()})
+        completed = as_count(frame.total('completed'))
         entry_patterns = {
-            'total_entries': 0,
-            'completed_entries': 0,
+            'total_entries': as_count(frame.total()),
+            'completed_entries': completed,
             'average_duration': timedelta(0),
-            'entry_types': {
-                'normal': 0,
-                'bypass': 0,
-                'group': 0
-            },
+            'entry_types': entry_types,
             'verification_stats': {
-                'face_verified': 0,
-                'qr_verified': 0,
-                'both_verified': 0
+                'face_verified': as_count(frame.total(mask=frame.face)),
+                'qr_verified': as_count(frame.total(mask=frame.qr)),
+                'both_verified': as_count(frame.total(mask=frame.strict_success))
             }
         }
-
-        daily_activity = {}
-
-        for record in user_records:
-            for log in record.time_logs:
-                entry_patterns['total_entries'] += 1
-                
-                # Entry type counting
-                entry_type = log.get('entry_type', 'normal')
-                if not isinstance(entry_type, str):
-                    print(f"Warning: Invalid entry_type: {entry_type}")  # Debug print
-                    entry_type = 'normal'  # Default to normal if invalid
-                
-                entry_patterns['entry_types'][entry_type] += 1
-                
-                # Verification counting
-                if log.get('face_verified'):
-                    entry_patterns['verification_stats']['face_verified'] += 1
-                if log.get('qr_verified'):
-                    entry_patterns['verification_stats']['qr_verified'] += 1
-                if log.get('face_verified') and log.get('qr_verified'):
-                    entry_patterns['verification_stats']['both_verified'] += 1
-                
-                # Duration calculation
-                if log.get('departure'):
-                    entry_patterns['completed_entries'] += 1
-                    arrival = datetime.fromisoformat(log['arrival'])
-                    departure = datetime.fromisoformat(log['departure'])
-                    duration = departure - arrival
-                    entry_patterns['average_duration'] += duration
-                    
-                    # Daily activity tracking
-                    date_str = arrival.date().isoformat()
-                    if date_str not in daily_activity:
-                        daily_activity[date_str] = {
-                            'entries': 0,
-                            'total_duration': timedelta(0)
-                        }
-                    daily_activity[date_str]['entries'] += 1
-                    daily_activity[date_str]['total_duration'] += duration
-
-        if entry_patterns['completed_entries'] > 0:
+        if completed > 0:
             entry_patterns['average_duration'] = str(
-                entry_patterns['average_duration'] / entry_patterns['completed_entries']
+                timedelta(seconds=frame.total('duration_seconds')) / completed
             )
 
+        # Daily activity only counts completed entries
+        day_completed = frame.by_day('completed')
+        day_duration = frame.by_day('duration_seconds')
+        daily_activity = {
+            frame.day_label(index): {
+                'entries': as_count(day_completed[index]),
+                'total_duration': timedelta(seconds=float(day_duration[index]))
+            }
+            for index in np.flatnonzero(day_completed)
+        }
+
         return {
             "user_id": user_id,
             "time_range": {
@@ -596,6 +467,7 @@ def get_user_analytics(
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/analytics/detailed")
+@single_flight("detailed")
 def get_detailed_analytics(
     start_date: Optional[datetime] = None,
     end_date: Optional[datetime] = None,
@@ -608,120 +480,69 @@ def get_detailed_analytics(
         if not start_date:
             start_date = end_date - timedelta(days=30)
 
-        base_filters = [
-            models.FinalRecords.entry_date.between(start_date.date(), end_date.date())
-        ]
-        if institution_id:
-            base_filters.append(models.User.institution_id == institution_id)
+        frame = load_frame(db, start_date.date(), end_date.date(), institution_id)
+        success = frame.strict_success
+        bypass = frame.of_type('bypass')
+
+        # Hourly statistics
+        hour_entries = frame.by_hour()
+        hour_successes = frame.by_hour(mask=success)
+        hour_bypasses = frame.by_hour(mask=bypass)
+        hourly_stats = {
+            int(hour): {
+                'total_entries': as_count(hour_entries[hour]),
+                'successful_entries': as_count(hour_successes[hour]),
+                'failed_entries': as_count(hour_entries[hour] - hour_successes[hour]),
+                'bypass_entries': as_count(hour_bypasses[hour])
+            }
+            for hour in frame.active_hours()
+        }
 
-        # Initialize statistics containers
-        hourly_stats = defaultdict(lambda: {
-            'total_entries': 0,
-            'successful_entries': 0,
-            'failed_entries': 0,
-            'bypass_entries': 0
-        })
-        
-        daily_stats = defaultdict(lambda: {
-            'total_entries': 0,
-            'successful_entries': 0,
-            'failed_entries': 0,
-            'bypass_entries': 0,
-            'unique_users': set()
-        })
+        # Daily statistics
+        day_entries = frame.by_day()
+        day_successes = frame.by_day(mask=success)
+        day_bypasses = frame.by_day(mask=bypass)
+        day_visitors = frame.by_day('new_visitors')
+        daily_stats = {
+            frame.day_label(index): {
+                'total_entries': as_count(day_entries[index]),
+                'successful_entries': as_count(day_successes[index]),
+                'failed_entries': as_count(day_entries[index] - day_successes[index]),
+                'bypass_entries': as_count(day_bypasses[index]),
+                'unique_users': as_count(day_visitors[index])
+            }
+            for index in frame.active_days()
+        }
 
+        total_entries = as_count(frame.total())
+        successful = as_count(frame.total(mask=success))
         verification_stats = {
-            'total_attempts': 0,
-            'successful_verifications': 0,
-            'failed_verifications': 0,
-            'face_verification_failures': 0,
-            'qr_verification_failures': 0
+            'total_attempts': total_entries,
+            'successful_verifications': successful,
+            'failed_verifications': total_entries - successful,
+            'face_verification_failures': as_count(frame.total(mask=~frame.face)),
+            'qr_verification_failures': as_count(frame.total(mask=~frame.qr))
         }
 
+        completed = as_count(frame.total('completed'))
         entry_stats = {
-            'total_entries': 0,
-            'normal_entries': 0,
-            'bypass_entries': 0,
-            'group_entries': 0,
-            'completed_entries': 0,
-            'incomplete_entries': 0
+            'total_entries': total_entries,
+            'normal_entries': as_count(frame.total(mask=frame.of_type('normal'))),
+            'bypass_entries': as_count(frame.total(mask=bypass)),
+            'group_entries': as_count(frame.total(mask=frame.of_type('group_entry'))),
+            'completed_entries': completed,
+            'incomplete_entries': total_entries - completed
         }
-
-        peak_hour_data = defaultdict(int)
-        duration_stats = []
-        
-        # Process records
-        records = db.query(models.FinalRecords).filter(*base_filters).all()
-        for record in records:
-            for log in record.time_logs:
-                entry_stats['total_entries'] += 1
-                arrival_time = datetime.fromisoformat(log['arrival'])
-                hour = arrival_time.hour
-                date_str = arrival_time.date().isoformat()
-
-                # Hourly statistics
-                hourly_stats[hour]['total_entries'] += 1
-                peak_hour_data[hour] += 1
-
-                # Daily statistics
-                daily_stats[date_str]['total_entries'] += 1
-                daily_stats[date_str]['unique_users'].add(record.user_id)
-
-                # Entry type tracking
-                entry_type = log.get('entry_type', 'normal')
-                if not isinstance(entry_type, str):
-                    print(f"Warning: Invalid entry_type: {entry_type}")  # Debug print
-                    entry_type = 'normal'  # Default to normal if invalid
-                
-                if entry_type == 'normal':
-                    entry_stats['normal_entries'] += 1
-                elif entry_type == 'bypass':
-                    entry_stats['bypass_entries'] += 1
-                    hourly_stats[hour]['bypass_entries'] += 1
-                    daily_stats[date_str]['bypass_entries'] += 1
-                elif entry_type == 'group_entry':
-                    entry_stats['group_entries'] += 1
-
-                print(f"Current entry_stats: {entry_stats}")  # Debug print
-
-                # Verification tracking
-                verification_stats['total_attempts'] += 1
-                is_successful = True
-
-                if not log.get('face_verified'):
-                    verification_stats['face_verification_failures'] += 1
-                    is_successful = False
-
-                if not log.get('qr_verified'):
-                    verification_stats['qr_verification_failures'] += 1
-                    is_successful = False
-
-                if is_successful:
-                    verification_stats['successful_verifications'] += 1
-                    hourly_stats[hour]['successful_entries'] += 1
-                    daily_stats[date_str]['successful_entries'] += 1
-                else:
-                    verification_stats['failed_verifications'] += 1
-                    hourly_stats[hour]['failed_entries'] += 1
-                    daily_stats[date_str]['failed_entries'] += 1
-
-                # Duration tracking
-                if log.get('departure'):
-                    entry_stats['completed_entries'] += 1
-                    arrival = datetime.fromisoformat(log['arrival'])
-                    departure = datetime.fromisoformat(log['departure'])
-                    duration_stats.append((departure - arrival).total_seconds())
-                else:
-                    entry_stats['incomplete_entries'] += 1
+        duration_seconds = frame.total('duration_seconds')
 
         # Calculate peak hours
         peak_hours = []
-        if peak_hour_data:
-            max_entries = max(peak_hour_data.values())
+        if hourly_stats:
+            max_entries = max(stats['total_entries'] for stats in hourly_stats.values())
             peak_hours = [
                 get_hour_range(hour) 
-                for hour, count in peak_hour_data.items() 
-                if count >= max_entries * 0.8  # Consider hours with at least 80% of max traffic
+                for hour, stats in hourly_stats.items() 
+                if stats['total_entries'] >= max_entries * 0.8  # Consider hours with at least 80% of max traffic
             ]
 
         # Calculate success rates
@@ -737,8 +558,8 @@ def get_detailed_analytics(
 
         # Calculate average duration
         avg_duration = (
-            sum(duration_stats) / len(duration_stats)
-            if duration_stats else 0
+            duration_seconds / entry_stats['completed_entries']
+            if entry_stats['completed_entries'] else 0
         )
 
         return {
@@ -776,10 +597,7 @@ def get_detailed_analytics(
                 **entry_stats,
                 "average_duration_seconds": round(avg_duration, 2),
                 "daily_patterns": {
-                    date: {
-                        **stats,
-                        "unique_users": len(stats["unique_users"])
-                    }
+                    date: dict(stats)
                     for date, stats in daily_stats.items()
                 }
             },
@@ -800,6 +618,7 @@ def get_detailed_analytics(
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/analytics/trends")
+@single_flight("trends")
 def get_trend_analytics(
     start_date: Optional[datetime] = None,
     end_date: Optional[datetime] = None,
@@ -813,56 +632,52 @@ def get_trend_analytics(
             start_date = end_date - timedelta(days=30)
 
         # Weekly trends
-        weekly_stats = defaultdict(lambda: {
-            'total_entries': 0,
-            'successful_entries': 0,
-            'unique_users': set(),
-            'bypass_count': 0,
-            'average_duration': [],
-            'group_entries': 0,
-            'successful_group_entries': 0,
-            'instructor_verifications': 0
-        })
+        frame = load_frame(db, start_date.date(), end_date.date(), institution_id)
+        group = frame.of_type('group')
+        week_entries = frame.by_week()
+        week_successes = frame.by_week(mask=frame.strict_success)
+        week_bypasses = frame.by_week(mask=frame.of_type('bypass'))
+        week_completed = frame.by_week('completed')
+        week_duration = frame.by_week('duration_seconds')
+        week_groups = frame.by_week(mask=group)
+        week_group_successes = frame.by_week(mask=group & frame.face)
+        week_instructor = frame.by_week(mask=group & frame.instructor)
+        weekly_stats = {
+            int(week): {
+                'total_entries': as_count(week_entries[week]),
+                'successful_entries': as_count(week_successes[week]),
+                'unique_users': 0,
+                'bypass_count': as_count(week_bypasses[week]),
+                'completed': as_count(week_completed[week]),
+                'duration_seconds': float(week_duration[week]),
+                'group_entries': as_count(week_groups[week]),
+                'successful_group_entries': as_count(week_group_successes[week]),
+                'instructor_verifications': as_count(week_instructor[week])
+            }
+            for week in frame.active_weeks()
+        }
 
-        # Process records for weekly trends
-        records = db.query(models.FinalRecords).filter(
+        # Distinct visitors per week, counted without reading time_logs
+        week = func.extract('week', models.FinalRecords.entry_date)
+        unique_query = db.query(week, func.count(distinct(models.FinalRecords.user_id))).filter(
             models.FinalRecords.entry_date.between(start_date.date(), end_date.date())
-        ).all()
-
-        for record in records:
-            for log in record.time_logs:
-                arrival_time = datetime.fromisoformat(log['arrival'])
-                week_number = arrival_time.isocalendar()[1]
-                
-                weekly_stats[week_number]['total_entries'] += 1
-                weekly_stats[week_number]['unique_users'].add(record.user_id)
-                
-                if log.get('entry_type') == 'bypass':
-                    weekly_stats[week_number]['bypass_count'] += 1
-                
-                if log.get('face_verified') and log.get('qr_verified'):
-                    weekly_stats[week_number]['successful_entries'] += 1
-                
-                if log.get('departure'):
-                    departure_time = datetime.fromisoformat(log['departure'])
-                    duration = (departure_time - arrival_time).total_seconds()
-                    weekly_stats[week_number]['average_duration'].append(duration)
-
-                if log.get('entry_type') == 'group':
-                    weekly_stats[week_number]['group_entries'] += 1
-                    if log.get('face_verified') and (log.get('verified_by_instructor') or log.get('face_verified')):
-                        weekly_stats[week_number]['successful_group_entries'] += 1
-                    if log.get('verified_by_instructor'):
-                        weekly_stats[week_number]['instructor_verifications'] += 1
+        )
+        if institution_id:
+            unique_query = unique_query.join(
+                models.User, models.User.user_id == models.FinalRecords.user_id
+            ).filter(models.User.institution_id == institution_id)
+        for week_number, unique_users in unique_query.group_by(week).all():
+            if int(week_number) in weekly_stats:
+                weekly_stats[int(week_number)]['unique_users'] = unique_users
 
         # Process weekly stats
         trend_analysis = {
             week: {
                 'total_entries': stats['total_entries'],
                 'successful_entries': stats['successful_entries'],
-                'unique_users': len(stats['unique_users']),
+                'unique_users': stats['unique_users'],
                 'bypass_rate': round(stats['bypass_count'] / stats['total_entries'] * 100, 2) if stats['total_entries'] > 0 else 0,
-                'average_duration_seconds': round(sum(stats['average_duration']) / len(stats['average_duration']), 2) if stats['average_duration'] else 0,
+                'average_duration_seconds': round(stats['duration_seconds'] / stats['completed'], 2) if stats['completed'] else 0,
                 'group_entry_success_rate': round(
                     stats['successful_group_entries'] / stats['group_entries'] * 100
                     if stats['group_entries'] > 0 else 0, 2
@@ -889,6 +704,92 @@ def get_trend_analytics(
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/analytics/heatmap")
+@single_flight("heatmap")
+def get_arrival_heatmap(
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    institution_id: Optional[int] = None,
+    db: Session = Depends(get_db)
+):
+    """Arrivals, departures and average face verification time per IST date and hour"""
+    try:
+        start_date, end_date = validate_date_range(start_date, end_date)
+        return {
+            "time_range": {
+                "start_date": start_date.isoformat(),
+                "end_date": end_date.isoformat(),
+                "timezone": "Asia/Kolkata (UTC+5:30)"
+            },
+            "hours": [get_hour_range(hour) for hour in range(24)],
+            **heatmap(db, start_date.date(), end_date.date(), institution_id)
+        }
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/analytics/occupancy")
+@single_flight("occupancy")
+def get_occupancy_timeline(
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    institution_id: Optional[int] = None,
+    threshold: int = 0,
+    resolution_minutes: int = 15,
+    closing_time: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    """People on site over time, with the peak and the time spent above threshold; defaults to today"""
+    try:
+        start_date, end_date = validate_date_range(start_date or end_date or get_current_time(), end_date)
+        start_day, end_day = start_date.date(), end_date.date()
+        if (end_day - start_day).days + 1 > OccupancyConfig.MAX_DAYS:
+            raise HTTPException(status_code=400, detail=f"Occupancy ranges are limited to {OccupancyConfig.MAX_DAYS} days")
+        if resolution_minutes < 1:
+            raise HTTPException(status_code=400, detail="resolution_minutes must be at least 1")
+
+        closing_minute = None
+        closing_time = closing_time or OccupancyConfig.CLOSING_TIME
+        if closing_time:
+            try:
+                hours, minutes = (int(part) for part in closing_time.split(":"))
+            except ValueError:
+                raise HTTPException(status_code=400, detail="closing_time must be HH:MM")
+            if not (0 <= hours < 24 and 0 <= minutes < 60):
+                raise HTTPException(status_code=400, detail="closing_time must be HH:MM")
+            closing_minute = hours * 60 + minutes
+
+        # The timeline runs in naive UTC like the logs, up to the end of the last local day
+        window_start = start_date.astimezone(timezone.utc).replace(tzinfo=None)
+        window_end = (end_date + timedelta(microseconds=1)).astimezone(timezone.utc).replace(tzinfo=None)
+        intervals = visit_intervals(db, start_day, end_day, institution_id)
+
+        return {
+            "time_range": {
+                "start_date": start_date.isoformat(),
+                "end_date": end_date.isoformat(),
+                "timezone": "Asia/Kolkata (UTC+5:30)"
+            },
+            "closing_time": closing_time or None,
+            **occupancy(intervals, window_start, window_end, datetime.utcnow(),
+                        threshold, resolution_minutes, closing_minute)
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/analytics/cache/stats")
+def get_analytics_cache_stats():
+    return analytics_cache.stats()
+
+@router.delete("/analytics/cache")
+def clear_analytics_cache(current_app_user: models.AppUsers = Depends(get_current_app_user)):
+    """Forget this worker's cached closed days; rebuilds by tasks/rebuild_rollups.py are picked up without it"""
+    analytics_cache.clear()
+    return {"message": "Analytics cache cleared"}
+
 def calculate_growth_rate(trend_data):
     if not trend_data or len(trend_data) < 2:
         return 0
@@ -1,12 +1,15 @@
-import os
 from fastapi import APIRouter, File, Form, UploadFile, Depends, Header
 from sqlalchemy.orm import Session
 from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
 
 from dependencies import get_db, get_current_app_user
-from firebase_controller import FirebaseController
+from firebase_controller import firebase_controller
 from models import AppUsers
 from utils.security import SecurityHandler
+from utils.api_key_cache import api_key_cache
+from utils.app_user_cache import AppUserCacheUnavailable
+from utils.file_handlers import save_app_user_picture
 
 router = APIRouter()
 
@@ -17,8 +20,8 @@ async def verify_app_user_endpoint(
     db: Session = Depends(get_db)
 ):
     try:
-        firebase_controller = FirebaseController()
-        result = firebase_controller.verify_app_user(user_name, user_password)
+        # Password hashing is CPU bound, keep it off the event loop
+        result = await run_in_threadpool(firebase_controller.verify_app_user, user_name, user_password)
         
         if result.get('status'):
             # Get or create app user
@@ -28,7 +31,7 @@ async def verify_app_user_endpoint(
             
             if app_user:
                 # Clear any existing API key first
-                if app_user.api_key:
+                if app_user.api_key_hash:
                     SecurityHandler().logout_user(db, app_user)
                 
                 # Generate new API key
@@ -47,6 +50,8 @@ async def verify_app_user_endpoint(
                 }
         
         return {"status": False, "message": "Invalid credentials"}
+    except AppUserCacheUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -64,6 +69,10 @@ async def logout_endpoint(
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/api_key_cache_stats")
+def get_api_key_cache_stats():
+    return api_key_cache.stats()
+
 @router.post("/create")
 async def create_app_user_endpoint(
     admin_name: str = Form(...),
@@ -78,16 +87,13 @@ async def create_app_user_endpoint(
 ):
     try:
         if admin_name == "admin" and admin_password == "future_scope":
-            firebase_controller = FirebaseController()
-            isCreated = firebase_controller.create_app_user(
+            isCreated = await run_in_threadpool(
+                firebase_controller.create_app_user,
                 user_name, user_password, user_email, unique_id_type, unique_id
             )
             print("credentials verified")
             if isCreated and isCreated.get('status'):
-                profile_picture_path = f"app_users/{user_name}_{profile_picture.filename}"
-                os.makedirs(os.path.dirname(profile_picture_path), exist_ok=True)
-                with open(profile_picture_path, "wb") as f:
-                    f.write(await profile_picture.read())
+                profile_picture_path = await save_app_user_picture(profile_picture, user_name)
                 print("")
                 app_user = AppUsers(
                     name=user_name,
@@ -117,14 +123,18 @@ async def create_app_user_endpoint(
             return {"status": False, "message": "User creation failed"}
         
         return {"status": False, "message": "Invalid admin credentials"}
+    except AppUserCacheUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/verify_user")
 def verify_user(user_name: str = Form(...), user_password: str = Form(...),api_key: str = Header(...), db: Session = Depends(get_db)):
-    firebase_controller = FirebaseController()
-    result = firebase_controller.verify_app_user(user_name, user_password)
+    try:
+        result = firebase_controller.verify_app_user(user_name, user_password)
+    except AppUserCacheUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
     if result.get('status'):
         app_user = SecurityHandler().verify_api_key(db, api_key)
         return { "status" : True, "message" : "User verified", "user" : app_user }
@@ -0,0 +1,39 @@
+from fastapi import APIRouter, Depends, HTTPException, Form
+from sqlalchemy.orm import Session
+from dependencies import get_db, get_current_app_user
+import models
+from utils.email_handler import WELCOME_TEMPLATE, mail_worker, outbox_dispatcher
+from utils.email_outbox import enqueue_institution, outbox_stats
+
+router = APIRouter()
+
+@router.get("/stats")
+def get_outbox_stats(
+    current_app_user: models.AppUsers = Depends(get_current_app_user),
+    db: Session = Depends(get_db)
+):
+    return {
+        "outbox": outbox_stats(db),
+        "dispatcher": outbox_dispatcher.stats(),
+        "mail_worker": mail_worker.stats(),
+    }
+
+@router.post("/resend/institution")
+def resend_institution_emails(
+    institution_id: int = Form(...),
+    template: str = Form(WELCOME_TEMPLATE),
+    current_app_user: models.AppUsers = Depends(get_current_app_user),
+    db: Session = Depends(get_db)
+):
+    """Queue the template again for every user of an institution"""
+    if template not in outbox_dispatcher.builders:
+        raise HTTPException(status_code=400, detail="Unknown email template")
+    institution = db.query(models.Institution).filter(models.Institution.institution_id == institution_id).first()
+    if not institution:
+        raise HTTPException(status_code=404, detail="Institution not found")
+    try:
+        queued = enqueue_institution(db, institution_id, template, resend=True)
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"status": True, "queued": queued}
@@ -1,14 +1,15 @@
-from uuid import uuid4
 from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile, Header
 from sqlalchemy.orm import Session
 from dependencies import get_db
 from face_auth import is_face_match
 import models
-import os
 from firebase_controller import firebase_controller
 from datetime import datetime
 from utils.security import SecurityHandler
 import json
+from utils.file_handlers import save_probe_upload
+from utils.storage import storage
+from utils.analytics_rollups import RollupDelta
 
 router = APIRouter()
 UPLOAD_DIR = "uploads"
@@ -22,27 +23,22 @@ async def verify_face(
     try:
         app_user = SecurityHandler().verify_api_key(db, api_key)
 
-        os.makedirs("temp_images", exist_ok=True)
         user = db.query(models.User).filter(models.User.user_id == user_id).first()
         if not user:
+            firebase_controller.live_stats.record_verification("unknown_user", app_user.user_id)
             firebase_controller.log_face_verification(user_id, "Unknown", False)
             raise HTTPException(status_code=404, detail="User not found")
         
         print(f"Found user with image_path: {user.image_path}")
         stored_image_path = user.image_path
         
-        if not stored_image_path or not os.path.exists(stored_image_path):
+        if not stored_image_path or not storage.exists(stored_image_path):
             print(f"Stored image not found at path: {stored_image_path}")
             return {"error": "Stored image not found"}
         
-        temp_image_path = os.path.join("temp_images", f"temp_{uuid4().hex}_{image.filename}")
         try:
-            print(f"Saving temporary image to: {temp_image_path}")
-            await image.seek(0)
-            
-            with open(temp_image_path, "wb") as buffer:
-                content = await image.read()
-                buffer.write(content)
+            temp_image_path = await save_probe_upload(image)
+            print(f"Saved probe image to: {temp_image_path}")
             
             print("Calling face_match function")
             # Single face verification check
@@ -50,11 +46,14 @@ async def verify_face(
             print(f"Face match result: {is_match}")
             
             # Log the verification result only once
+            firebase_controller.live_stats.record_verification("matched" if is_match else "not_matched", app_user.user_id)
             firebase_controller.log_face_verification(user_id, user.name, is_match)
             
             # If face match is successful
             if is_match:
                 current_time = datetime.utcnow()
+                new_arrival = False
+                rollups = RollupDelta()
                 # Check for existing record for today
                 existing_record = db.query(models.FinalRecords).filter(
                     models.FinalRecords.user_id == user_id,
@@ -65,6 +64,7 @@ async def verify_face(
                     # Update the latest time_log entry with face verification
                     if existing_record.time_logs and existing_record.time_logs[-1].get('departure') is None:
                         latest_entry = existing_record.time_logs[-1]
+                        previous_entry = dict(latest_entry)
                         latest_entry.update({
                             "face_verified": True,
                             "face_verification_time": current_time.isoformat(),
@@ -81,6 +81,8 @@ async def verify_face(
                             "time_logs": existing_record.time_logs,
                             "verified_by": app_user.user_id
                         })
+                        rollups.replace(user.institution_id, previous_entry, latest_entry,
+                                        first_visit=len(existing_record.time_logs) == 1)
                 else:
                     # Create new record with face verification
                     new_record = models.FinalRecords(
@@ -100,7 +102,12 @@ async def verify_face(
                         }]
                     )
                     db.add(new_record)
+                    rollups.add(user.institution_id, new_record.time_logs[0], first_visit=True, user_id=user.user_id)
+                    new_arrival = True
+                rollups.apply(db)
                 db.commit()
+                if new_arrival:
+                    firebase_controller.live_stats.record_arrival(app_user.user_id)
                 # firebase_controller.log_success(user_id, user.name, "Face matched")
                 
                 # Return a successful response
@@ -182,15 +189,11 @@ async def group_entry(
             students.append(student)
 
         # Save temporary image for face verification
-        os.makedirs("temp_images", exist_ok=True)
-        temp_image_path = os.path.join("temp_images", f"temp_{uuid4().hex}_{image.filename}")
-        await image.seek(0)
-        with open(temp_image_path, "wb") as buffer:
-            content = await image.read()
-            buffer.write(content)
+        temp_image_path = await save_probe_upload(image)
             
         # Process instructor face verification
         is_match = is_face_match(user.image_path, temp_image_path)
+        firebase_controller.live_stats.record_verification("matched" if is_match else "not_matched", app_user.user_id)
         if not is_match:
             firebase_controller.log_error(user_id, user.name, "Instructor face did not match")
             raise HTTPException(status_code=400, detail="Instructor face did not match")
@@ -214,6 +217,8 @@ async def group_entry(
             }]
         )
         db.add(instructor_record)
+        rollups = RollupDelta()
+        rollups.add(user.institution_id, instructor_record.time_logs[0], first_visit=True, user_id=user.user_id)
 
         # Create records for all students
         for student in students:
@@ -232,8 +237,11 @@ async def group_entry(
                 }]
             )
             db.add(student_record)
+            rollups.add(student.institution_id, student_record.time_logs[0], first_visit=True, user_id=student.user_id)
 
+        rollups.apply(db)
         db.commit()
+        firebase_controller.live_stats.record_arrival(app_user.user_id, len(students) + 1)
         firebase_controller.log_success(user_id, user.name, f"Group entry successful for {len(students)} students")
         
         return {
@@ -1,6 +1,8 @@
-import os
-from fastapi import APIRouter, Depends, HTTPException, Header
-from fastapi.responses import FileResponse
+import asyncio
+import json
+import time
+from fastapi import APIRouter, Depends, HTTPException, Header, File
+from fastapi.responses import FileResponse, Response
 from sqlalchemy.orm import Session
 from dependencies import get_db, get_current_app_user
 import models
@@ -11,32 +13,72 @@ from fastapi import Form
 from utils.security import SecurityHandler
 from typing import List
 from fastapi import UploadFile
-from uuid import uuid4
+from starlette.concurrency import run_in_threadpool
+from utils.file_handlers import save_probe_upload, read_qr_frame, MAX_QR_FRAMES
+from qr_decoder import decode_frame, get_decode_pool
+from qr_generation import QRConfig, QRSignatureError, qr_cache, qr_etag, render_qr_png, user_qr_payload, verify_qr_payload
+from utils.analytics_rollups import RollupDelta
 
 router = APIRouter()
 security_handler = SecurityHandler()
 
 async def save_image(image: UploadFile) -> str:
     """Save uploaded image and return the path"""
-    os.makedirs("temp_images", exist_ok=True)
-    temp_image_path = os.path.join("temp_images", f"temp_{uuid4().hex}_{image.filename}")
-    
-    await image.seek(0)
-    with open(temp_image_path, "wb") as buffer:
-        content = await image.read()
-        buffer.write(content)
-    
-    return temp_image_path
+    return await save_probe_upload(image)
+
+@router.get("/image/{user_id}")
+def get_qr_image(
+    user_id: int,
+    if_none_match: str = Header(None),
+    db: Session = Depends(get_db)
+):
+    """Render a user's QR code on request, answering 304 when the client already has it"""
+    user = db.query(models.User).filter(models.User.user_id == user_id).first()
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    payload = user_qr_payload(user)
+    etag = qr_etag(payload)
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=3600"}
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=render_qr_png(payload), media_type="image/png", headers=headers)
+
+@router.get("/cache_stats")
+def get_qr_cache_stats():
+    return qr_cache.stats()
+
+def verified_user_id(qr_data: str):
+    """verify_qr_payload() for the handlers; a code that cannot be verified is refused with 403"""
+    try:
+        return verify_qr_payload(qr_data)
+    except QRSignatureError as e:
+        firebase_controller.log_server_activity("ERROR", f"QR verification failed: {str(e)}")
+        raise HTTPException(status_code=403, detail="QR code could not be verified")
 
 @router.post("/scan_qr")
 def scan_qr(
-    user_id: int = Form(...),
+    user_id: int = Form(None),
+    qr_data: str = Form(None),
     is_group_entry: bool = Form(False),
     is_bypass: bool = Form(False),
     bypass_reason: str = Form(None),
     current_app_user: models.AppUsers = Depends(get_current_app_user),
     db: Session = Depends(get_db)
 ):
+    # Signed codes are checked in memory so forged or garbled scans never reach the database
+    if qr_data is not None:
+        signed_user_id = verified_user_id(qr_data)
+        if signed_user_id is None:
+            raise HTTPException(status_code=403, detail="Invalid QR code")
+        if user_id is not None and user_id != signed_user_id:
+            raise HTTPException(status_code=400, detail="user_id does not match the QR code")
+        user_id = signed_user_id
+    elif user_id is None:
+        raise HTTPException(status_code=400, detail="qr_data or user_id is required")
+    elif not QRConfig.ACCEPT_UNSIGNED:
+        raise HTTPException(status_code=403, detail="Signed QR code required")
+
     try:
         # Use current_app_user instead of looking up app_user
         app_user_id = current_app_user.user_id
@@ -73,6 +115,9 @@ def scan_qr(
             
             return entry
 
+        new_arrivals = 1
+        rollups = RollupDelta()
+
         # Handle existing entry
         existing_entry = db.query(models.FinalRecords).filter(
             models.FinalRecords.user_id == user_id,
@@ -123,8 +168,11 @@ def scan_qr(
                         ).update({
                             "time_logs": new_time_logs
                         }, synchronize_session=False)
+                        rollups.replace(user.institution_id, last_entry, updated_entry,
+                                        first_visit=len(existing_entry.time_logs) == 1)
 
                         try:
+                            rollups.apply(db)
                             db.commit()
                             # Refresh to get updated data
                             db.refresh(existing_entry)
@@ -152,6 +200,7 @@ def scan_qr(
             
             if should_add_new_entry:
                 new_log = create_time_log_entry("bypass" if is_bypass else "normal")
+                rollups.add(user.institution_id, new_log, first_visit=not existing_entry.time_logs, user_id=user.user_id)
                 # Create a new list with existing logs plus new log
                 updated_logs = existing_entry.time_logs + [new_log]
                 # Update the entire time_logs field
@@ -166,6 +215,7 @@ def scan_qr(
                 app_user_id=app_user_id
             )
             db.add(new_record)
+            rollups.add(user.institution_id, new_record.time_logs[0], first_visit=True, user_id=user.user_id)
 
             # Handle group entry
             if is_group_entry and not is_bypass:
@@ -187,8 +237,12 @@ def scan_qr(
                             app_user_id=app_user_id
                         )
                         db.add(student_record)
+                        rollups.add(student.institution_id, student_record.time_logs[0], first_visit=True, user_id=student.user_id)
+                        new_arrivals += 1
 
+        rollups.apply(db)
         db.commit()
+        firebase_controller.live_stats.record_arrival(app_user_id, new_arrivals)
         firebase_controller.log_qr_scan(user_id, user.name, True, "Successful QR scan")
         
         return {
@@ -204,6 +258,92 @@ def scan_qr(
         firebase_controller.log_server_activity("ERROR", f"Error processing QR scan for user_id: {user_id} - {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
 
+def _user_id_from_legacy_payload(data: str):
+    """User id from the JSON payload of codes printed before signed payloads"""
+    try:
+        return int(json.loads(data)["user_id"])
+    except (ValueError, TypeError, KeyError):
+        return None
+
+@router.post("/scan_frames")
+async def scan_frames(
+    frames: List[UploadFile] = File(...),
+    is_group_entry: bool = Form(False),
+    is_bypass: bool = Form(False),
+    bypass_reason: str = Form(None),
+    current_app_user: models.AppUsers = Depends(get_current_app_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Decode a QR code from one or a burst of camera frames and check the user in.
+    Frames are decoded in parallel in the decode pool; the first decoded frame wins.
+    """
+    if len(frames) > MAX_QR_FRAMES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_QR_FRAMES} frames can be sent at once")
+
+    start_time = time.perf_counter()
+    frame_bytes = [await read_qr_frame(frame) for frame in frames]
+
+    loop = asyncio.get_running_loop()
+    pool = get_decode_pool()
+    pending = {
+        asyncio.ensure_future(loop.run_in_executor(pool, decode_frame, data)): index
+        for index, data in enumerate(frame_bytes)
+    }
+    timings = []
+    decoded = None
+    while pending and decoded is None:
+        done, _ = await asyncio.wait(pending.keys(), return_when=asyncio.FIRST_COMPLETED)
+        for future in done:
+            index = pending.pop(future)
+            result = future.result()
+            timings.append({
+                "frame": index,
+                "decoded": result["data"] is not None,
+                "decode_ms": result["decode_ms"],
+                "attempts": result["attempts"],
+            })
+            if result["data"] is not None and decoded is None:
+                decoded = {"frame": index, "data": result["data"]}
+    # Frames still queued are not needed any more
+    for future in pending:
+        future.cancel()
+
+    timings.sort(key=lambda t: t["frame"])
+    decode_ms = round((time.perf_counter() - start_time) * 1000, 2)
+    print(f"Decoded {len(timings)}/{len(frames)} frames in {decode_ms} ms, found: {decoded is not None}")
+    if decoded is None:
+        raise HTTPException(
+            status_code=422,
+            detail={"message": "No QR code found in the frames", "frames": timings, "decode_ms": decode_ms}
+        )
+
+    decoded_user_id = verified_user_id(decoded["data"])
+    if decoded_user_id is not None:
+        scan_args = {"qr_data": decoded["data"], "user_id": None}
+    else:
+        decoded_user_id = _user_id_from_legacy_payload(decoded["data"])
+        if decoded_user_id is None:
+            raise HTTPException(status_code=403, detail="Invalid QR code")
+        scan_args = {"qr_data": None, "user_id": decoded_user_id}
+
+    scan_result = await run_in_threadpool(
+        scan_qr,
+        is_group_entry=is_group_entry,
+        is_bypass=is_bypass,
+        bypass_reason=bypass_reason,
+        current_app_user=current_app_user,
+        db=db,
+        **scan_args
+    )
+    return {
+        "decoded_user_id": decoded_user_id,
+        "decoded_frame": decoded["frame"],
+        "decode_ms": decode_ms,
+        "frames": timings,
+        "scan": scan_result,
+    }
+
 @router.post("/departure")
 def departure(
     user_id: int = Form(...),
@@ -297,6 +437,7 @@ def process_single_departure(user_id: int, app_user_id: int, db: Session):
     
     # Get the latest entry
     latest_entry = user_record.time_logs[-1]
+    previous_entry = dict(latest_entry)
     
     # Check if already departed
     if latest_entry.get('departure') is not None:
@@ -325,8 +466,13 @@ def process_single_departure(user_id: int, app_user_id: int, db: Session):
     ).update({
         "time_logs": user_record.time_logs
     })
-    
+
+    rollups = RollupDelta()
+    rollups.replace(user_record.user.institution_id if user_record.user else None, previous_entry, latest_entry,
+                    first_visit=len(user_record.time_logs) == 1)
+    rollups.apply(db)
     db.commit()
+    firebase_controller.live_stats.record_departure(app_user_id)
     firebase_controller.log_server_activity("INFO", f"Departure recorded for user_id: {user_id}")
     
     return {
@@ -441,8 +587,12 @@ async def group_entry_bypass(
             if not student_record:
                 raise HTTPException(status_code=404, detail=f"No active entry found for student with ID {student_id}")
 
-            # Add the bypass entry to the student's record
-            student_record.time_logs.append(bypass_entry)
+            # Add the bypass entry to the student's record; reassigned so the JSONB change is flushed
+            rollups = RollupDelta()
+            rollups.add(student_record.user.institution_id if student_record.user else None, bypass_entry,
+                        first_visit=not student_record.time_logs, user_id=student_record.user_id)
+            student_record.time_logs = (student_record.time_logs or []) + [bypass_entry]
+            rollups.apply(db)
             db.commit()
             db.refresh(student_record)
 
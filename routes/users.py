@@ -5,23 +5,26 @@ from sqlalchemy.orm import Session
 from dependencies import get_db, get_current_app_user
 import models
 from utils.file_handlers import save_upload_file, delete_file
-from qr_generation import generate_qr_code
+from utils.image_pipeline import derivative_or_original, DERIVATIVES
+from utils.storage import storage, file_response, normalize_key
+from qr_generation import render_qr_png, user_qr_payload
 import base64
 import os
 from typing import Optional
 import traceback
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse
 from firebase_controller import firebase_controller
 from uuid import uuid4
-from template_generator import VisitorCardGenerator
+from template_generator import VisitorCardGenerator, CARD_DIR, card_data_for_user, get_or_render_card
 from utils.security import SecurityHandler
-from fastapi import BackgroundTasks
-from pathlib import Path
 import mimetypes  # Add this import
-from utils.email_handler import send_welcome_email_background
+from utils.email_handler import WELCOME_TEMPLATE
+from utils.email_outbox import enqueue_email
 import pytz  # Import the pytz library
 
 router = APIRouter()
+# Shares the cached template and fonts across requests
+visitor_card_generator = VisitorCardGenerator()
 
 
 @router.post("/check/email/{email}")
@@ -31,7 +34,6 @@ def check_email(email: str, db: Session = Depends(get_db)):
 
 @router.post("/create")
 def create_user(
-    background_tasks: BackgroundTasks,
     name: str = Form(...),
     email: str = Form(...),
     image: UploadFile = File(...),
@@ -62,8 +64,7 @@ def create_user(
             "image_filename": image.filename
         }
         print(f"Creating new user with data: {request_data}")
-        if image.filename.split(".")[-1] not in ["jpg", "jpeg", "png", "webp"]:
-            raise HTTPException(status_code=400, detail="Image must be a jpg, jpeg, png, or webp file")
+        # Image type and size are checked from the file contents when it is saved below
         # Validation checks...
         existing_user = db.query(models.User).filter(
             (models.User.email == email) 
@@ -89,7 +90,7 @@ def create_user(
             raise HTTPException(status_code=400, detail="Invalid unique ID type")
 
         # Save image
-        image_path = save_upload_file(image)
+        image_path = save_upload_file(image, db)
         print(f"Saved image at: {image_path}")
 
         # Create user
@@ -109,11 +110,9 @@ def create_user(
         db.flush()
         
         print(f"Generated user with ID: {new_user.user_id}")
-        
-        # Generate QR Code
-        qr_path = generate_qr_code(new_user.user_id, new_user.name, new_user.email)
-        new_user.qr_code = qr_path
-        print(f"Generated QR code at: {qr_path}")
+
+        # Queued in the same transaction, so the welcome email survives SMTP failures and restarts
+        enqueue_email(db, new_user.user_id, WELCOME_TEMPLATE)
         
         db.commit()
         db.refresh(new_user)
@@ -125,45 +124,30 @@ def create_user(
             "instructor" if new_user.is_instructor else "student"
         )
         
-        # After successful user creation, generate visitor card
-        visitor_card_generator = VisitorCardGenerator()
-        card_path = visitor_card_generator.create_visitor_card({
-            "name": new_user.name,
-            "email": new_user.email,
-            "profile_image_path": str(Path(new_user.image_path)),
-            "qr_code_path": new_user.qr_code,
-            "user_id": str(new_user.user_id)
-        })
-
         print(f"Successfully created user: {new_user.user_id}")
 
-        # After successful user creation and visitor card generation
-        send_welcome_email_background(
-            background_tasks=background_tasks,
-            user_email=new_user.email,
-            user_name=new_user.name,
-            qr_code_path=new_user.qr_code,
-            visitor_card_path=card_path
-        )
+        # The visitor card is rendered lazily by the mail worker or the first download
+        card_url = f"/users/download-visitor-card/?user_id={new_user.user_id}"
 
         return {
             "user_id": new_user.user_id,
             "name": new_user.name,
             "email": new_user.email,
-            "qr_code": new_user.qr_code,
+            # QR codes are rendered on request from the user's payload
+            "qr_code": f"/qr/image/{new_user.user_id}",
             "image_path": new_user.image_path,
-            "visitor_card_path": card_path,
+            "visitor_card_path": None,
             "visitor_card": {
-                "path": card_path,
-                "url": f"/static/visitor_cards/{card_path.split('/')[-1]}" if card_path else None,
-                "generated_at": str(datetime.now())
+                "path": None,
+                "url": card_url,
+                "generated_at": None
             },
             "is_student": new_user.is_student,
             "is_instructor": new_user.is_instructor,
             "institution_id": new_user.institution_id,
             "unique_id_type": new_user.unique_id_type,
             "unique_id": new_user.unique_id,
-            "email_status": "sending_in_background"
+            "email_status": "queued"
         }
 
     except Exception as e:
@@ -240,7 +224,7 @@ def get_user(
                     "is_instructor": user.is_instructor,
                     "institution": user.institution.name if user.institution else None,
                     "image_path": f"{user.image_path}",
-                    "qr_code_path": f"{user.qr_code}",
+                    "qr_code_path": f"/qr/image/{user.user_id}",
                     "is_quick_register": user.is_quick_register,
                     "unique_id_type": user.unique_id_type,
                     "unique_id": user.unique_id,
@@ -269,18 +253,17 @@ def get_user(
 
             # Add base64 encoded images
             try:
-                if user.qr_code and os.path.exists(user.qr_code):
-                    with open(user.qr_code, "rb") as qr_file:
-                        qr_data = base64.b64encode(qr_file.read()).decode()
-                        response_data["qr_base64"] = f"data:image/png;base64,{qr_data}"
+                qr_data = base64.b64encode(render_qr_png(user_qr_payload(user))).decode()
+                response_data["qr_base64"] = f"data:image/png;base64,{qr_data}"
             except Exception as qr_error:
                 print(f"Error processing QR code: {str(qr_error)}")
 
             try:
-                if user.image_path and os.path.exists(user.image_path):
-                    with open(user.image_path, "rb") as img_file:
-                        img_data = base64.b64encode(img_file.read()).decode()
-                        response_data["image_base64"] = f"data:image/jpeg;base64,{img_data}"
+                thumb_path = derivative_or_original(user.image_path, "thumb")
+                if thumb_path and storage.exists(thumb_path):
+                    media_type = mimetypes.guess_type(thumb_path)[0] or "image/jpeg"
+                    img_data = base64.b64encode(storage.read_bytes(thumb_path)).decode()
+                    response_data["image_base64"] = f"data:{media_type};base64,{img_data}"
             except Exception as img_error:
                 print(f"Error processing image: {str(img_error)}")
 
@@ -468,27 +451,64 @@ def get_all_users(
 # from fastapi import Query
 
 @router.get("/download-visitor-card/")
-async def download_visitor_card(
-    card_path: str = Query(..., description="Path of the visitor card file"),
+def download_visitor_card(
+    user_id: int = Query(None, description="User whose visitor card to download"),
+    card_path: str = Query(None, description="Path of a previously generated visitor card file"),
+    db: Session = Depends(get_db)
 ):
 
     try:
+        if user_id is not None:
+            user = db.query(models.User).filter(models.User.user_id == user_id).first()
+            if not user:
+                raise HTTPException(status_code=404, detail="User not found")
+            # Rendered on first request, then served from the cache until an input changes
+            card_path, _ = get_or_render_card(card_data_for_user(user), generator=visitor_card_generator)
+            return file_response(
+                card_path,
+                media_type='image/png',
+                filename=f"visitor_card_{user.user_id}.png"
+            )
+
+        if not card_path:
+            raise HTTPException(status_code=400, detail="user_id or card_path is required")
+
         # Print debug info
         print(f"Requested card path: {card_path}")
-        print(f"File exists check: {os.path.exists(card_path)}")
-        
-        if not os.path.exists(card_path):
-            raise HTTPException(
-                status_code=404, 
-                detail=f"File not found at path: {card_path}"
-            )
-        
-        return FileResponse(
-            path=card_path,
-            filename=os.path.basename(card_path),
-            media_type='image/png'  # Set specific media type for PNG
+
+        # Only generated cards may be downloaded through this endpoint; the prefix is checked on the
+        # normalized key, and paths that normalize to something else (e.g. with "..") are refused
+        try:
+            card_key = normalize_key(card_path)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid visitor card path")
+        if card_key != card_path or not card_key.startswith(f"{CARD_DIR}/"):
+            raise HTTPException(status_code=400, detail="Invalid visitor card path")
+
+        # Redirects to object storage when available, so this node does not proxy the bytes
+        return file_response(
+            card_key,
+            media_type='image/png',  # Set specific media type for PNG
+            filename=os.path.basename(card_path)
         )
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error serving file: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/{user_id}/image")
+def get_user_image(
+    user_id: int,
+    variant: str = Query("thumb", description="master, face, avatar, thumb or thumb_small"),
+    db: Session = Depends(get_db)
+):
+    if variant != "master" and variant not in DERIVATIVES:
+        raise HTTPException(status_code=400, detail="Invalid image variant")
+
+    user = db.query(models.User).filter(models.User.user_id == user_id).first()
+    if not user or not user.image_path:
+        raise HTTPException(status_code=404, detail="User image not found")
+
+    image_path = user.image_path if variant == "master" else derivative_or_original(user.image_path, variant)
+    return file_response(image_path, media_type=mimetypes.guess_type(image_path)[0] or "image/jpeg")
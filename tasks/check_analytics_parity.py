@@ -0,0 +1,251 @@
+import argparse
+import sys
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, List
+from sqlalchemy.orm import Session
+from database import SessionLocal
+import models
+from routes.analytics import INDIA_TIMEZONE, convert_to_system_time, get_analytics, get_hour_range
+from utils.analytics_rollups import (
+    DIMENSIONS, MEASURES, daily_rollup_rows, hour_of_day_rollup_rows, log_rows, rebuild_rollups, rows_from_records
+)
+
+FIXTURE_START = date(2001, 1, 1)
+
+def load_fixture(db: Session) -> None:
+    """Visitors covering the edge cases of the aggregation, added to the caller's transaction"""
+    institution = models.Institution(name="Parity check", count="0")
+    db.add(institution)
+    db.flush()
+    users = []
+    for index in range(4):
+        user = models.User(
+            name=f"Parity {index}",
+            email=f"parity-{index}@example.invalid",
+            unique_id_type="parity",
+            unique_id=str(index),
+            is_instructor=index == 0,
+            is_student=index > 0,
+            institution_id=institution.institution_id if index < 3 else None,
+        )
+        db.add(user)
+        users.append(user)
+    db.flush()
+
+    def at(day: int, hour: int, minute: int = 0) -> str:
+        return (datetime.combine(FIXTURE_START, datetime.min.time())
+                + timedelta(days=day, hours=hour, minutes=minute)).isoformat()
+
+    logs_by_user = [
+        [
+            # 18:40 UTC is past midnight in Asia/Kolkata
+            {"arrival": at(0, 18, 40), "departure": at(0, 20), "entry_type": "group_entry",
+             "face_verified": True, "face_verification_time": at(0, 18, 41)},
+            {"arrival": at(1, 9), "departure": None, "entry_type": "normal", "qr_verified": True},
+        ],
+        [
+            {"arrival": at(0, 18, 40), "departure": "", "entry_type": "group_entry",
+             "face_verified": True, "verified_by_instructor": users[0].user_id},
+            {"arrival": at(1, 4, 15), "departure": at(1, 6), "entry_type": "bypass", "qr_verified": True,
+             "bypass_details": {"reason": "parity"}},
+        ],
+        [
+            {"arrival": at(0, 3), "departure": at(0, 4), "entry_type": None, "qr_verified": True,
+             "face_verified": True, "face_verification_time": at(0, 3, 3)},
+            {"arrival": at(0, 5), "departure": at(0, 5, 30), "qr_verified": True, "face_verified": False,
+             "face_verification_time": at(0, 5, 1)},
+        ],
+        [
+            {"arrival": at(2, 12), "departure": at(2, 12, 45), "entry_type": "normal", "qr_verified": True,
+             "face_verified": True, "face_verification_time": at(2, 12, 1)},
+            {"departure": at(2, 13)},
+        ],
+    ]
+    for user, logs in zip(users, logs_by_user):
+        db.add(models.FinalRecords(user_id=user.user_id, entry_date=FIXTURE_START, time_logs=logs))
+    db.flush()
+
+def _keyed(rows: List[dict], grain: str) -> Dict[tuple, dict]:
+    keyed = {}
+    for row in rows:
+        if not row["entries"]:
+            continue
+        keyed[(row[grain], *(row[d] for d in DIMENSIONS))] = {m: float(row[m]) for m in MEASURES}
+    return keyed
+
+def compare(name: str, expected: List[dict], actual: List[dict], grain: str) -> int:
+    expected, actual = _keyed(expected, grain), _keyed(actual, grain)
+    mismatches = 0
+    for key in sorted(set(expected) | set(actual), key=str):
+        left, right = expected.get(key), actual.get(key)
+        if left is None or right is None or any(abs(left[m] - right[m]) > 1e-6 for m in MEASURES):
+            mismatches += 1
+            print(f"  {name} {key}: python={left} other={right}")
+    print(f"{name}: {len(expected)} rows, {mismatches} mismatches")
+    return mismatches
+
+def legacy_analytics(records: List[tuple], start_day: date, end_day: date) -> dict:
+    """
+    The original /analytics loop over time_logs, reduced to the fields it shares with the current response.
+    Deliberate changes since are applied here too: logs are bucketed by local day, flags holding ids count
+    as set, a missing entry_type is normal, and logs without an arrival are skipped instead of failing.
+    Ongoing users are left out, they are limited to the open days now.
+    """
+    verification = dict.fromkeys(('total_attempts', 'face_success', 'qr_success', 'both_success', 'group_success'), 0)
+    hourly_stats, entry_types = defaultdict(int), defaultdict(int)
+    daily_stats = defaultdict(lambda: {'entries': 0, 'successes': 0, 'unique_users': set(), 'group_entries': 0})
+    completion_times, duration_stats = [], []
+
+    for record, _ in records:
+        for log in record.time_logs if isinstance(record.time_logs, list) else []:
+            if not log.get('arrival'):
+                continue
+            arrival_time = convert_to_system_time(datetime.fromisoformat(log['arrival']))
+            if not start_day <= arrival_time.date() <= end_day:
+                continue
+            date_str = arrival_time.date().isoformat()
+            entry_type = log.get('entry_type') if isinstance(log.get('entry_type'), str) and log.get('entry_type') else 'normal'
+            face, qr, instructor = bool(log.get('face_verified')), bool(log.get('qr_verified')), bool(log.get('verified_by_instructor'))
+
+            entry_types[entry_type] += 1
+            hourly_stats[arrival_time.hour] += 1
+            verification['total_attempts'] += 1
+            if face or (entry_type == 'group_entry' and instructor):
+                verification['face_success'] += 1
+            if qr:
+                verification['qr_success'] += 1
+            if entry_type == 'group_entry':
+                is_success = instructor or face
+                verification['group_success'] += is_success
+            else:
+                is_success = face and qr
+            verification['both_success'] += is_success
+
+            daily_stats[date_str]['entries'] += 1
+            daily_stats[date_str]['successes'] += is_success
+            daily_stats[date_str]['unique_users'].add(record.user_id)
+            if entry_type == 'group_entry':
+                daily_stats[date_str]['group_entries'] += 1
+
+            if entry_type == 'group_entry':
+                completion_time = 0.5
+            elif log.get('face_verification_time'):
+                verification_time = convert_to_system_time(datetime.fromisoformat(log['face_verification_time']))
+                completion_time = (verification_time - arrival_time).total_seconds() / 60
+            else:
+                completion_time = 1.0
+            completion_times.append(round(completion_time, 2))
+
+            if log.get('departure'):
+                departure = convert_to_system_time(datetime.fromisoformat(log['departure']))
+                duration = (departure - arrival_time).total_seconds() / 60
+                if duration > 0:
+                    duration_stats.append(duration)
+
+    total_entries = verification['total_attempts']
+    return {
+        "hourly_distribution": {get_hour_range(hour): count for hour, count in hourly_stats.items()},
+        "success_rate": round(verification['both_success'] / total_entries * 100 if total_entries else 0, 2),
+        "face_verification_rate": round(verification['face_success'] / total_entries * 100 if total_entries else 0, 2),
+        "qr_verification_rate": round(verification['qr_success'] / total_entries * 100 if total_entries else 0, 2),
+        "group_success_rate": round(
+            verification['group_success'] / entry_types['group_entry'] * 100 if entry_types.get('group_entry') else 0, 2
+        ),
+        "average_completion_time_minutes": round(sum(completion_times) / len(completion_times) if completion_times else 0, 2),
+        "completion_time_distribution": {
+            "under_1_minute": len([t for t in completion_times if t <= 1]),
+            "1_to_2_minutes": len([t for t in completion_times if 1 < t <= 2]),
+            "2_to_5_minutes": len([t for t in completion_times if 2 < t <= 5]),
+        },
+        "total_entries": total_entries,
+        "entry_types": dict(entry_types),
+        "average_duration_minutes": round(sum(duration_stats) / len(duration_stats) if duration_stats else 0, 2),
+        "daily_patterns": {
+            date_str: {
+                "total_entries": data['entries'],
+                "successful_entries": data['successes'],
+                "unique_users": len(data['unique_users']),
+                "group_entries": data['group_entries'],
+            }
+            for date_str, data in daily_stats.items()
+        },
+    }
+
+def current_analytics(db: Session, start_day: date, end_day: date, institution_id: int = None) -> dict:
+    """The same fields from the /analytics handler as it runs now"""
+    response = get_analytics(
+        start_date=datetime.combine(start_day, datetime.min.time(), INDIA_TIMEZONE),
+        end_date=datetime.combine(end_day, datetime.min.time(), INDIA_TIMEZONE),
+        institution_id=institution_id, user_id=None, db=db,
+    )
+    performance, efficiency, entries = response["performance_metrics"], response["scan_efficiency"], response["entry_statistics"]
+    return {
+        "hourly_distribution": response["traffic_analysis"]["hourly_distribution"],
+        **performance,
+        "average_completion_time_minutes": efficiency["average_completion_time_minutes"],
+        "completion_time_distribution": efficiency["completion_time_distribution"],
+        "total_entries": entries["total_entries"],
+        "entry_types": entries["entry_types"],
+        "average_duration_minutes": entries["average_duration_minutes"],
+        "daily_patterns": {
+            date_str: {key: value for key, value in data.items() if key != "success_rate"}
+            for date_str, data in entries["daily_patterns"].items()
+        },
+    }
+
+def compare_legacy(legacy: dict, current: dict) -> int:
+    mismatches = 0
+    for field in legacy:
+        if legacy[field] != current.get(field):
+            mismatches += 1
+            print(f"  legacy {field}: before={legacy[field]} now={current.get(field)}")
+    print(f"legacy /analytics: {len(legacy)} fields, {mismatches} mismatches")
+    return mismatches
+
+def check_parity(db: Session, start_day: date, end_day: date, institution_id: int = None) -> int:
+    """
+    Compare the original /analytics computation with the current handler, and the Python reference
+    aggregation with the SQL aggregation and the rollup tables
+    """
+    query = db.query(models.FinalRecords, models.User.institution_id).outerjoin(
+        models.User, models.User.user_id == models.FinalRecords.user_id
+    ).filter(models.FinalRecords.entry_date.between(start_day - timedelta(days=1), end_day))
+    if institution_id:
+        query = query.filter(models.User.institution_id == institution_id)
+    records = query.all()
+
+    mismatches = compare_legacy(legacy_analytics(records, start_day, end_day),
+                                current_analytics(db, start_day, end_day, institution_id))
+    for grain in ("day", "hour"):
+        reference = rows_from_records(records, start_day, end_day, grain)
+        mismatches += compare(f"sql {grain}", reference, log_rows(db, start_day, end_day, grain, institution_id), grain)
+        rollups = (daily_rollup_rows if grain == "day" else hour_of_day_rollup_rows)(db, start_day, end_day, institution_id)
+        mismatches += compare(f"rollup {grain}", reference, rollups, grain)
+    return mismatches
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check /analytics against its original computation, and the SQL and rollup analytics against the Python aggregation"
+    )
+    parser.add_argument("--start", type=date.fromisoformat, help="First local (IST) day, YYYY-MM-DD")
+    parser.add_argument("--end", type=date.fromisoformat, help="Last local (IST) day, YYYY-MM-DD")
+    parser.add_argument("--institution-id", type=int)
+    parser.add_argument("--fixture", action="store_true",
+                        help="Check a built-in fixture dataset inside a transaction that is rolled back")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        if args.fixture:
+            load_fixture(db)
+            start_day, end_day = args.start or FIXTURE_START, args.end or FIXTURE_START + timedelta(days=3)
+            rebuild_rollups(db, start_day, end_day, commit=False)
+        else:
+            end_day = args.end or datetime.utcnow().date()
+            start_day = args.start or end_day - timedelta(days=30)
+        mismatches = check_parity(db, start_day, end_day, args.institution_id)
+    finally:
+        db.rollback()
+        db.close()
+    sys.exit(1 if mismatches else 0)
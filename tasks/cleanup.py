@@ -1,6 +1,8 @@
 from datetime import datetime
 from sqlalchemy.orm import Session
+from database import SessionLocal
 from models import AppUsers
+from utils.blob_store import collect_unreferenced_blobs, collect_unreferenced_probes
 
 def cleanup_expired_api_keys(db: Session):
     """Cleanup expired API keys periodically"""
@@ -9,9 +11,27 @@ def cleanup_expired_api_keys(db: Session):
             AppUsers.api_key_expiry < datetime.utcnow()
         ).update({
             AppUsers.api_key: None,
+            AppUsers.api_key_hash: None,
             AppUsers.api_key_expiry: None
         })
         db.commit()
     except Exception as e:
         db.rollback()
-        print(f"Error cleaning up API keys: {str(e)}") 
\ No newline at end of file
+        print(f"Error cleaning up API keys: {str(e)}")
+
+def cleanup_uploads(db: Session):
+    """Remove upload blobs and probe images that nothing references any more"""
+    try:
+        print(f"Unreferenced upload blobs removed: {collect_unreferenced_blobs(db)}")
+        print(f"Unreferenced probe images removed: {collect_unreferenced_probes(db)}")
+    except Exception as e:
+        db.rollback()
+        print(f"Error cleaning up uploads: {str(e)}")
+
+if __name__ == "__main__":
+    db = SessionLocal()
+    try:
+        cleanup_expired_api_keys(db)
+        cleanup_uploads(db)
+    finally:
+        db.close()
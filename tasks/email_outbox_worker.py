@@ -0,0 +1,19 @@
+from qr_generation import require_signing_key
+from utils.email_handler import mail_worker, outbox_dispatcher
+
+def run_outbox_worker() -> None:
+    """Send queued emails from a dedicated process; set EMAIL_OUTBOX_IN_APP=false on the web workers"""
+    # Welcome emails embed the signed QR code
+    require_signing_key()
+    print("Email outbox worker started")
+    try:
+        outbox_dispatcher.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        outbox_dispatcher.stop()
+        mail_worker.close()
+        print(f"Email outbox worker stopped: {outbox_dispatcher.stats()}")
+
+if __name__ == "__main__":
+    run_outbox_worker()
@@ -0,0 +1,86 @@
+from io import BytesIO
+from sqlalchemy.orm import Session
+from database import SessionLocal
+from models import User, FinalRecords
+from utils.blob_store import PROBE_DIR, is_blob_path, probe_extension, store_image, store_probe
+from utils.file_handlers import delete_file
+from utils.image_pipeline import regenerate_derivative
+from utils.storage import storage
+
+def migrate_user_images(db: Session) -> int:
+    """Move flat uploads/ user images into the content-addressed store"""
+    migrated = 0
+    users = db.query(User).filter(User.image_path.isnot(None)).all()
+    for user in users:
+        old_path = user.image_path
+        if is_blob_path(old_path) or not storage.exists(old_path):
+            continue
+        try:
+            user.image_path = store_image(db, BytesIO(storage.read_bytes(old_path)))
+            db.commit()
+            delete_file(old_path)
+            migrated += 1
+            print(f"Migrated image for user {user.user_id}: {old_path} -> {user.image_path}")
+        except Exception as e:
+            db.rollback()
+            print(f"Error migrating image for user {user.user_id}: {str(e)}")
+    return migrated
+
+def migrate_probe_images(db: Session, batch_size: int = 500) -> int:
+    """Move flat temp_images/ probes into the sharded layout and rewrite the records pointing at them"""
+    moved = {}
+    for old_path in list(storage.list(f"{PROBE_DIR}/")):
+        if is_blob_path(old_path):
+            continue
+        moved[old_path] = store_probe(BytesIO(storage.read_bytes(old_path)), probe_extension(old_path))
+
+    if not moved:
+        return 0
+
+    # Rewrite every reference before removing the old files
+    last_id = 0
+    while True:
+        records = db.query(FinalRecords).filter(
+            FinalRecords.record_id > last_id
+        ).order_by(FinalRecords.record_id).limit(batch_size).all()
+        if not records:
+            break
+        for record in records:
+            last_id = record.record_id
+            if record.face_image_path in moved:
+                record.face_image_path = moved[record.face_image_path]
+            if record.time_logs and any(log.get("face_image_path") in moved for log in record.time_logs):
+                record.time_logs = [
+                    {**log, "face_image_path": moved[log["face_image_path"]]}
+                    if log.get("face_image_path") in moved else log
+                    for log in record.time_logs
+                ]
+        db.commit()
+
+    for old_path in moved:
+        storage.delete(old_path)
+    print(f"Migrated {len(moved)} probe images")
+    return len(moved)
+
+def regenerate_face_images(db: Session) -> int:
+    """Rewrite the face derivative of every stored user image, e.g. after the face resize changed"""
+    regenerated = 0
+    paths = [path for (path,) in db.query(User.image_path).filter(User.image_path.isnot(None)).distinct()]
+    for path in paths:
+        if not is_blob_path(path) or not storage.exists(path):
+            continue
+        try:
+            regenerate_derivative(path, "face")
+            regenerated += 1
+        except Exception as e:
+            print(f"Error regenerating face image for {path}: {str(e)}")
+    return regenerated
+
+if __name__ == "__main__":
+    db = SessionLocal()
+    try:
+        print(f"User images migrated: {migrate_user_images(db)}")
+        print(f"Probe images migrated: {migrate_probe_images(db)}")
+        print(f"Face images regenerated: {regenerate_face_images(db)}")
+    finally:
+        db.close()
@@ -0,0 +1,188 @@
+import argparse
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import Callable, List, Optional
+from PIL import Image
+from sqlalchemy.orm import Session
+from database import SessionLocal
+from models import User
+from template_generator import VisitorCardGenerator, card_data_for_user, load_card_assets
+
+# A4 portrait at 300 DPI
+PAGE_SIZE = (2480, 3508)
+PAGE_DPI = 300
+PAGE_MARGIN = 120
+CARD_GAP = 60
+
+_generator = None
+
+def _init_worker():
+    """Load the template and fonts once per worker process"""
+    global _generator
+    load_card_assets()
+    _generator = VisitorCardGenerator()
+
+def _render_for_sheet(card_data: dict) -> dict:
+    """Render one card in a worker and return it JPEG-encoded to keep inter-process transfers small"""
+    start_time = time.perf_counter()
+    try:
+        card = _generator.render_card(card_data)
+        buffer = BytesIO()
+        card.save(buffer, "JPEG", quality=92)
+        return {
+            "user_id": card_data["user_id"],
+            "image": buffer.getvalue(),
+            "render_ms": (time.perf_counter() - start_time) * 1000,
+        }
+    except Exception as e:
+        return {"user_id": card_data["user_id"], "error": str(e)}
+
+def _slot_layout(columns: int, rows: int) -> tuple:
+    """Card size and top-left positions of each slot on a page"""
+    usable_width = PAGE_SIZE[0] - 2 * PAGE_MARGIN - (columns - 1) * CARD_GAP
+    usable_height = PAGE_SIZE[1] - 2 * PAGE_MARGIN - (rows - 1) * CARD_GAP
+    card_width, card_height = load_card_assets()["template"].size
+    scale = min(usable_width / columns / card_width, usable_height / rows / card_height)
+    size = (int(card_width * scale), int(card_height * scale))
+
+    positions = []
+    for row in range(rows):
+        for column in range(columns):
+            positions.append((
+                PAGE_MARGIN + column * (size[0] + CARD_GAP),
+                PAGE_MARGIN + row * (size[1] + CARD_GAP),
+            ))
+    return size, positions
+
+class SheetWriter:
+    """Appends pages to a PDF one at a time so only the current page is held in memory"""
+
+    def __init__(self, output_path: str):
+        self.output_path = output_path
+        self.pages = 0
+
+    def write(self, page: Image.Image) -> None:
+        page.save(self.output_path, "PDF", resolution=PAGE_DPI, append=self.pages > 0)
+        self.pages += 1
+
+def select_users(db: Session, institution_id: Optional[int] = None, user_ids: Optional[List[int]] = None) -> list:
+    query = db.query(User)
+    if institution_id is not None:
+        query = query.filter(User.institution_id == institution_id)
+    if user_ids:
+        query = query.filter(User.user_id.in_(user_ids))
+    return query.order_by(User.name, User.user_id).all()
+
+def print_cards(
+    db: Session,
+    output_path: str,
+    institution_id: Optional[int] = None,
+    user_ids: Optional[List[int]] = None,
+    columns: int = 2,
+    rows: int = 2,
+    workers: Optional[int] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> dict:
+    """
+    Render visitor cards in a process pool and impose them N-up onto a multi-page PDF.
+    Only a bounded window of renders is in flight, so memory stays flat for large groups.
+    """
+    start_time = time.perf_counter()
+    cards = [card_data_for_user(user) for user in select_users(db, institution_id, user_ids)]
+    total = len(cards)
+    if total == 0:
+        return {"cards": 0, "pages": 0, "failed": [], "seconds": 0}
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    card_size, positions = _slot_layout(columns, rows)
+    writer = SheetWriter(output_path)
+    page, slot = None, 0
+    done, failed, render_ms = 0, [], []
+
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        pending = deque()
+        queue = iter(cards)
+        window = workers * 4
+
+        def submit_next():
+            card_data = next(queue, None)
+            if card_data is not None:
+                pending.append(pool.submit(_render_for_sheet, card_data))
+
+        for _ in range(window):
+            submit_next()
+
+        # Results are consumed in submission order so the sheets follow the sorted user list
+        while pending:
+            result = pending.popleft().result()
+            submit_next()
+            done += 1
+
+            if "error" in result:
+                failed.append({"user_id": result["user_id"], "error": result["error"]})
+            else:
+                render_ms.append(result["render_ms"])
+                if page is None:
+                    page = Image.new("RGB", PAGE_SIZE, "white")
+                card = Image.open(BytesIO(result["image"])).resize(card_size, Image.Resampling.LANCZOS)
+                page.paste(card, positions[slot])
+                slot += 1
+                if slot == len(positions):
+                    writer.write(page)
+                    page, slot = None, 0
+
+            if progress:
+                progress(done, total)
+
+    if page is not None:
+        writer.write(page)
+
+    seconds = time.perf_counter() - start_time
+    printed = total - len(failed)
+    stats = {
+        "cards": printed,
+        "pages": writer.pages,
+        "failed": failed,
+        "seconds": round(seconds, 2),
+        "cards_per_second": round(printed / seconds, 2) if seconds > 0 else 0,
+        "average_render_ms": round(sum(render_ms) / len(render_ms), 2) if render_ms else 0,
+        "output_path": output_path,
+    }
+    print(f"Printed {stats['cards']} cards on {stats['pages']} pages in {stats['seconds']} s")
+    return stats
+
+def _print_progress(done: int, total: int) -> None:
+    if done == total or done % 25 == 0:
+        print(f"Rendered {done}/{total} cards")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print visitor cards onto N-up PDF sheets")
+    parser.add_argument("--institution-id", type=int)
+    parser.add_argument("--user-ids", help="Comma separated user ids")
+    parser.add_argument("--output", default="print_sheets/visitor_cards.pdf")
+    parser.add_argument("--columns", type=int, default=2)
+    parser.add_argument("--rows", type=int, default=2)
+    parser.add_argument("--workers", type=int)
+    args = parser.parse_args()
+
+    if args.institution_id is None and not args.user_ids:
+        parser.error("--institution-id or --user-ids is required")
+
+    db = SessionLocal()
+    try:
+        print_cards(
+            db,
+            output_path=args.output,
+            institution_id=args.institution_id,
+            user_ids=[int(i) for i in args.user_ids.split(",")] if args.user_ids else None,
+            columns=args.columns,
+            rows=args.rows,
+            workers=args.workers,
+            progress=_print_progress,
+        )
+    finally:
+        db.close()
@@ -0,0 +1,18 @@
+import argparse
+from datetime import date
+from database import SessionLocal
+from utils.analytics_rollups import rebuild_rollups
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the analytics rollups from final_records")
+    parser.add_argument("--start", type=date.fromisoformat, help="First local (IST) day to rebuild, YYYY-MM-DD")
+    parser.add_argument("--end", type=date.fromisoformat, help="Last local (IST) day to rebuild, YYYY-MM-DD")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        logs = rebuild_rollups(db, args.start, args.end)
+        # Running servers see the bumped rollup generation and drop their cached days on the next request
+        print(f"Rebuilt rollups from {logs} log entries")
+    finally:
+        db.close()
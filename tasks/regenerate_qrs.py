@@ -0,0 +1,60 @@
+import argparse
+from typing import List, Optional
+from sqlalchemy.orm import Session
+from database import SessionLocal
+from models import User
+from qr_generation import generate_qr_codes
+
+def regenerate_qr_codes(
+    db: Session,
+    institution_id: Optional[int] = None,
+    user_ids: Optional[List[int]] = None,
+    workers: Optional[int] = None,
+    force: bool = False,
+) -> dict:
+    """Regenerate QR codes for all users or a filtered subset and point users at the new files"""
+    query = db.query(User.user_id, User.name, User.email, User.qr_code)
+    if institution_id is not None:
+        query = query.filter(User.institution_id == institution_id)
+    if user_ids:
+        query = query.filter(User.user_id.in_(user_ids))
+    rows = query.all()
+
+    stats = generate_qr_codes(
+        [{"user_id": row.user_id, "name": row.name, "email": row.email} for row in rows],
+        workers=workers,
+        force=force,
+    )
+
+    # Only touch rows whose stored path is stale
+    current_paths = {row.user_id: row.qr_code for row in rows}
+    updates = [
+        {"user_id": user_id, "qr_code": path}
+        for user_id, path in stats["paths"].items()
+        if current_paths.get(user_id) != path
+    ]
+    if updates:
+        db.bulk_update_mappings(User, updates)
+        db.commit()
+    print(f"Updated qr_code path for {len(updates)} users")
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Regenerate user QR codes in parallel")
+    parser.add_argument("--institution-id", type=int)
+    parser.add_argument("--user-ids", help="Comma separated user ids")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--force", action="store_true", help="Regenerate even if the payload is unchanged")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        regenerate_qr_codes(
+            db,
+            institution_id=args.institution_id,
+            user_ids=[int(i) for i in args.user_ids.split(",")] if args.user_ids else None,
+            workers=args.workers,
+            force=args.force,
+        )
+    finally:
+        db.close()
@@ -0,0 +1,68 @@
+import argparse
+import json
+import os
+from utils.event_sinks import EventSink, FirebaseSink, LocalLogSink, read_segment
+
+CHECKPOINT_FILE = "replay.checkpoint"
+
+def load_checkpoint(log_dir: str) -> dict:
+    path = os.path.join(log_dir, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return {"segment": None, "offset": 0}
+    with open(path) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+def save_checkpoint(log_dir: str, segment: str, offset: int) -> None:
+    path = os.path.join(log_dir, CHECKPOINT_FILE)
+    with open(f"{path}.tmp", "w") as checkpoint_file:
+        json.dump({"segment": segment, "offset": offset}, checkpoint_file)
+    os.replace(f"{path}.tmp", path)
+
+def replay_events(log_dir: str = None, sink: EventSink = None, batch_size: int = 500, delete_replayed: bool = False) -> int:
+    """
+    Replay the local event log into another sink, Firebase by default.
+    Progress is checkpointed per batch, and events keep their push keys, so re-running is safe.
+    """
+    log = LocalLogSink(log_dir)
+    sink = sink or FirebaseSink()
+    checkpoint = load_checkpoint(log.directory)
+    segments = log.segments()
+    replayed = 0
+
+    for index, segment_path in enumerate(segments):
+        name = os.path.basename(segment_path)
+        if checkpoint["segment"] and name < checkpoint["segment"]:
+            continue
+        offset = checkpoint["offset"] if name == checkpoint["segment"] else 0
+
+        batch = {}
+        for offset_after, event in read_segment(segment_path, offset):
+            batch[event["path"]] = event["data"]
+            if len(batch) >= batch_size:
+                sink.write_batch(batch)
+                replayed += len(batch)
+                save_checkpoint(log.directory, name, offset_after)
+                batch = {}
+            offset = offset_after
+        if batch:
+            sink.write_batch(batch)
+            replayed += len(batch)
+        save_checkpoint(log.directory, name, offset)
+
+        # The newest segment may still be appended to by the server
+        is_last = index == len(segments) - 1
+        if delete_replayed and not is_last:
+            os.remove(segment_path)
+        print(f"Replayed {name} up to byte {offset}")
+
+    print(f"Replayed {replayed} events")
+    return replayed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay the local event log into Firebase")
+    parser.add_argument("--log-dir")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--delete-replayed", action="store_true", help="Remove fully replayed segments")
+    args = parser.parse_args()
+
+    replay_events(args.log_dir, batch_size=args.batch_size, delete_replayed=args.delete_replayed)
@@ -1,76 +1,150 @@
-from datetime import datetime
+from functools import lru_cache
 from PIL import Image, ImageDraw, ImageFont
 import os
+import time
 import qrcode
 from io import BytesIO
+from typing import Optional, Tuple
 import base64
+import hashlib
+import json
+from qr_generation import payload_hash, render_qr_png, user_qr_payload
+from utils.image_pipeline import derivative_or_original, open_stored_image
+from utils.storage import storage
+
+# Bundled assets are resolved next to this module rather than the working directory
+ASSET_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_PATH = os.path.join(ASSET_DIR, "template", "template.jpeg")
+FONT_PATH = os.path.join(ASSET_DIR, "fonts", "arial.ttf")
+CARD_DIR = "generated_cards"
+CARD_SIZE = (720, 1280)
+
+# Output formats tuned for size: format name -> (Pillow format, extension, media type, save options)
+OUTPUT_FORMATS = {
+    "png": ("PNG", "png", "image/png", {"optimize": True}),
+    "webp": ("WEBP", "webp", "image/webp", {"quality": 85, "method": 4}),
+    "jpeg": ("JPEG", "jpg", "image/jpeg", {"quality": 88, "optimize": True, "progressive": True}),
+}
+
+@lru_cache(maxsize=None)
+def load_card_assets(template_path: str = TEMPLATE_PATH, font_path: str = FONT_PATH, card_size: tuple = CARD_SIZE) -> dict:
+    """Load the pre-resized template and the fonts once per process"""
+    start_time = time.perf_counter()
+    template = Image.open(template_path).convert("RGB").resize(card_size, Image.Resampling.LANCZOS)
+    assets = {
+        "template": template,
+        "font_name": ImageFont.truetype(font_path, 48),
+        "font_email": ImageFont.truetype(font_path, 20),
+        "font_id": ImageFont.truetype(font_path, 30),
+    }
+    print(f"Loaded visitor card assets in {(time.perf_counter() - start_time) * 1000:.1f} ms")
+    return assets
 
 class VisitorCardGenerator:
     def __init__(self):
-        self.template_path = "template/template.jpeg"
-        self.font_path = "fonts/arial.ttf"
-        self.card_size = (720, 1280)  # Updated to specified size
-        
-    def create_visitor_card(self, user_data):
+        self.template_path = TEMPLATE_PATH
+        self.font_path = FONT_PATH
+        self.card_size = CARD_SIZE
+
+    @property
+    def assets(self) -> dict:
+        return load_card_assets(self.template_path, self.font_path, self.card_size)
+
+    def render_card(self, user_data, profile_img=None, qr_img=None) -> Image.Image:
         """
-        Generate a visitor card for a user
-        user_data should contain: name, email, profile_image_path, qr_code_path
+        Render a visitor card in memory.
+        Pre-loaded profile and QR images can be passed in to skip reading them from storage.
         """
-        try:
-            # Load template
-            template = Image.open(self.template_path)
-            template = template.resize(self.card_size)
-            
-            # Load user profile image
-            profile_img = Image.open(user_data["profile_image_path"])
+        assets = self.assets
+
+        # Load user profile image, preferring the pre-scaled card avatar
+        if profile_img is None:
+            profile_img = open_stored_image(derivative_or_original(user_data["profile_image_path"], "avatar"))
+        if profile_img.size != (150, 150):
             profile_img = self._resize_image(profile_img, (150, 150))  # Adjusted profile image size
-            
-            # Load QR code
-            qr_img = Image.open(user_data["qr_code_path"])
-            qr_img = self._resize_image(qr_img, (450, 450))  # Increased QR code size
-            
-            # Create a copy of template to work on
-            card = template.copy()
-            profile_pos = (80, 380)  # Adjusted profile image position
-            qr_pos = (135, 700)  # Adjusted QR code position (taking space from the bottom)
-            name_pos = (283, 380)
-            email_pos = (283, 440)
-            id_pos = (283, 480)  # Adjusted position for ID
-            valid_pos = (153, 600)  # Position for "Valid Upto" below the image and text section
-            
-            # Paste images with transparency
-            if profile_img.mode == 'RGBA':
-                card.paste(profile_img, profile_pos, profile_img)
-            else:
-                card.paste(profile_img, profile_pos)
-                
-            if qr_img.mode == 'RGBA':
-                card.paste(qr_img, qr_pos, qr_img)
+
+        # Render the QR code from its payload, falling back to a stored legacy image
+        if qr_img is None:
+            if user_data.get("qr_payload"):
+                qr_img = Image.open(BytesIO(render_qr_png(user_data["qr_payload"])))
             else:
-                card.paste(qr_img, qr_pos)
-            
-            # Add text
-            draw = ImageDraw.Draw(card)
-            font_name = ImageFont.truetype(self.font_path, 48)
-            font_email = ImageFont.truetype(self.font_path, 20)
-            font_id = ImageFont.truetype(self.font_path, 30)
-            
-            draw.text(name_pos, user_data["name"], fill="black", font=font_name, stroke_width=2, stroke_fill="black")
-            draw.text(email_pos, user_data["email"], fill="black", font=font_email)
-            draw.text(id_pos, user_data["user_id"], fill="black", font=font_id, stroke_width=1, stroke_fill="black")
-            draw.text(valid_pos, "Valid Upto: 07-03-2025 --- 09-03-2025", fill="black", font=font_id)
-            
-            # Save the card
-            os.makedirs("generated_cards", exist_ok=True)
-            output_path = f"generated_cards/{user_data['name'].replace(' ', '_')}_visitor_card_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.png"
-            card.save(output_path, "PNG", quality=95)
-            
-            return output_path
-        
+                qr_img = open_stored_image(user_data["qr_code_path"])
+        qr_img = self._resize_image(qr_img, (450, 450))  # Increased QR code size
+
+        # Create a copy of the cached template to work on
+        card = assets["template"].copy()
+        profile_pos = (80, 380)  # Adjusted profile image position
+        qr_pos = (135, 700)  # Adjusted QR code position (taking space from the bottom)
+        name_pos = (283, 380)
+        email_pos = (283, 440)
+        id_pos = (283, 480)  # Adjusted position for ID
+        valid_pos = (153, 600)  # Position for "Valid Upto" below the image and text section
+
+        # Paste images with transparency
+        if profile_img.mode == 'RGBA':
+            card.paste(profile_img, profile_pos, profile_img)
+        else:
+            card.paste(profile_img, profile_pos)
+
+        if qr_img.mode == 'RGBA':
+            card.paste(qr_img, qr_pos, qr_img)
+        else:
+            card.paste(qr_img, qr_pos)
+
+        # Add text
+        draw = ImageDraw.Draw(card)
+        draw.text(name_pos, user_data["name"], fill="black", font=assets["font_name"], stroke_width=2, stroke_fill="black")
+        draw.text(email_pos, user_data["email"], fill="black", font=assets["font_email"])
+        draw.text(id_pos, str(user_data["user_id"]), fill="black", font=assets["font_id"], stroke_width=1, stroke_fill="black")
+        draw.text(valid_pos, "Valid Upto: 07-03-2025 --- 09-03-2025", fill="black", font=assets["font_id"])
+
+        return card
+
+    def encode_card(self, card: Image.Image, output_format: str = "png") -> bytes:
+        """Encode a rendered card in one of OUTPUT_FORMATS"""
+        image_format, _, _, options = OUTPUT_FORMATS[output_format]
+        buffer = BytesIO()
+        card.save(buffer, image_format, **options)
+        return buffer.getvalue()
+
+    def create_visitor_card(self, user_data, output_format: str = "png"):
+        """
+        Generate a visitor card for a user and return its storage key
+        user_data should contain: name, email, profile_image_path and qr_payload or qr_code_path
+        """
+        try:
+            return get_or_render_card(user_data, output_format, generator=self)[0]
         except Exception as e:
             print(f"Error generating visitor card: {str(e)}")
             raise
-    
+
+    def render_batch(self, users, output_format: str = "png") -> list:
+        """
+        Render visitor cards for several users with the shared template and fonts.
+        Returns one result per user with its cache key or error and the render time,
+        which is None for cards served from the cache.
+        """
+        results = []
+        for user_data in users:
+            try:
+                path, render_ms = get_or_render_card(user_data, output_format, generator=self)
+                error = None
+            except Exception as e:
+                path, render_ms = None, None
+                error = str(e)
+            results.append({
+                "user_id": user_data.get("user_id"),
+                "path": path,
+                "error": error,
+                "render_ms": round(render_ms, 2) if render_ms is not None else None,
+            })
+
+        rendered = [r for r in results if r["render_ms"] is not None]
+        if rendered:
+            average = sum(r["render_ms"] for r in rendered) / len(rendered)
+            print(f"Rendered {len(rendered)}/{len(results)} visitor cards, {average:.1f} ms per card")
+        return results
+
     def _resize_image(self, image, box_size):
         """Resize and crop image to exactly fit the given box size, maintaining aspect ratio."""
         img_width, img_height = image.size
@@ -93,6 +167,64 @@ class VisitorCardGenerator:
         
         return image.crop((left, top, right, bottom))
 
+# Bump when the card layout changes so cached cards are re-rendered
+CARD_VERSION = 1
+
+def card_data_for_user(user) -> dict:
+    """Collect the inputs a visitor card is rendered from"""
+    return {
+        "name": user.name,
+        "email": user.email,
+        "profile_image_path": user.image_path,
+        "qr_code_path": user.qr_code,
+        "qr_payload": user_qr_payload(user),
+        "user_id": str(user.user_id),
+    }
+
+def card_cache_key(user_data, output_format: str = "png") -> str:
+    """Storage key of a rendered card: one per user and content hash of its inputs"""
+    inputs = json.dumps({
+        "version": CARD_VERSION,
+        "name": user_data["name"],
+        "email": user_data["email"],
+        # Uploads are content addressed, so the path identifies the photo bytes
+        "photo": user_data["profile_image_path"],
+        "qr": payload_hash(user_data["qr_payload"]) if user_data.get("qr_payload") else user_data.get("qr_code_path"),
+    }, sort_keys=True)
+    digest = hashlib.sha256(inputs.encode()).hexdigest()[:32]
+    return f"{CARD_DIR}/{user_data['user_id']}/{digest}.{OUTPUT_FORMATS[output_format][1]}"
+
+def get_or_render_card(user_data, output_format: str = "png",
+                       generator: VisitorCardGenerator = None) -> Tuple[str, Optional[float]]:
+    """
+    Return the cached card for the current inputs, rendering and storing it on first use.
+    Returns (key, render time in ms), the time is None when the card came from the cache.
+    """
+    key = card_cache_key(user_data, output_format)
+    if storage.exists(key):
+        return key, None
+
+    generator = generator or VisitorCardGenerator()
+    start_time = time.perf_counter()
+    card = generator.render_card(user_data)
+    media_type = OUTPUT_FORMATS[output_format][2]
+    storage.write_bytes(key, generator.encode_card(card, output_format), media_type)
+    render_ms = (time.perf_counter() - start_time) * 1000
+    print(f"Visitor card for {user_data['user_id']} rendered in {render_ms:.1f} ms")
+
+    # Keep a single card per user
+    invalidate_cards(user_data["user_id"], keep=key)
+    return key, render_ms
+
+def invalidate_cards(user_id, keep: str = None) -> int:
+    """Delete cached cards of a user, except the one to keep"""
+    removed = 0
+    for key in list(storage.list(f"{CARD_DIR}/{user_id}/")):
+        if key != keep:
+            storage.delete(key)
+            removed += 1
+    return removed
+
 def generate_qr_code(data, output_path):
     qr = qrcode.QRCode(version=1, box_size=10, border=5)
     qr.add_data(data)
@@ -0,0 +1,154 @@
+import functools
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from datetime import date, datetime, timedelta
+from typing import Callable, Hashable, List
+from utils.analytics_rollups import ROLLUP_TIMEZONE
+
+class AnalyticsCacheConfig:
+    # Cached (scope, day) segments of rollup rows
+    SEGMENTS = int(os.getenv("ANALYTICS_CACHE_SEGMENTS", "20000"))
+    # Days that can still change: today, and yesterday for visitors who leave after midnight
+    OPEN_DAYS = int(os.getenv("ANALYTICS_CACHE_OPEN_DAYS", "2"))
+    ENABLED = os.getenv("ANALYTICS_CACHE_ENABLED", "true").lower() == "true"
+
+def local_today() -> date:
+    return datetime.now(ROLLUP_TIMEZONE).date()
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class AnalyticsCache:
+    """
+    Rollup rows per (rollup generation, scope, closed local day), kept until evicted or a rebuild
+    bumps the generation, plus single-flight for whole requests.
+    Open days are loaded on every request and merged with the cached closed days.
+    """
+
+    def __init__(self, size: int = None):
+        self.size = size or AnalyticsCacheConfig.SEGMENTS
+        self._segments = OrderedDict()  # (generation, scope, day) -> tuple of rows
+        self._generation = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.computations = 0
+        self.shared = 0
+        self.compute_seconds = 0.0
+        self.last_compute_seconds = 0.0
+
+    def rows(self, scope: Hashable, start_day: date, end_day: date,
+             load: Callable[[date, date], List[dict]], generation: int = 0) -> List[dict]:
+        """
+        Rows for the inclusive range; load(start, end) queries Postgres for days that are open or not cached.
+        generation is rollup_generation() read before loading, so rows cached across a rebuild are never served.
+        """
+        if not AnalyticsCacheConfig.ENABLED:
+            return load(start_day, end_day)
+        first_open = local_today() - timedelta(days=AnalyticsCacheConfig.OPEN_DAYS - 1)
+        closed_end = min(end_day, first_open - timedelta(days=1))
+        rows = []
+
+        if start_day <= closed_end:
+            days = [start_day + timedelta(days=offset) for offset in range((closed_end - start_day).days + 1)]
+            with self._lock:
+                if generation > self._generation:
+                    # Segments of older generations can never be hit again
+                    self._segments.clear()
+                    self._generation = generation
+                cached = {}
+                for day in days:
+                    segment = self._segments.get((generation, scope, day))
+                    if segment is not None:
+                        self._segments.move_to_end((generation, scope, day))
+                        cached[day] = segment
+                self.hits += len(cached)
+                self.misses += len(days) - len(cached)
+            missing = [day for day in days if day not in cached]
+            if missing:
+                # One query spanning the missing days; days cached in between are simply loaded again
+                loaded = defaultdict(list)
+                for row in load(missing[0], missing[-1]):
+                    loaded[row["bucket_hour"].date()].append(row)
+                with self._lock:
+                    for day in missing:
+                        cached[day] = self._segments[(generation, scope, day)] = tuple(loaded[day])
+                    while len(self._segments) > self.size:
+                        self._segments.popitem(last=False)
+            for day in days:
+                rows.extend(cached[day])
+
+        if end_day > closed_end:
+            rows.extend(load(max(start_day, closed_end + timedelta(days=1)), end_day))
+        return rows
+
+    def single_flight(self, key: Hashable, compute: Callable[[], object]) -> object:
+        """Run compute once for concurrent callers with the same key; the others wait and share its result"""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            flight.done.wait()
+            with self._lock:
+                self.shared += 1
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        started = time.perf_counter()
+        try:
+            flight.result = compute()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                del self._flights[key]
+                self.computations += 1
+                self.compute_seconds += elapsed
+                self.last_compute_seconds = elapsed
+            flight.done.set()
+
+    def clear(self) -> None:
+        """Drop all segments; rebuilds are picked up through the generation without this"""
+        with self._lock:
+            self._segments.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            requests = self.computations + self.shared
+            return {
+                "segments": len(self._segments),
+                "generation": self._generation,
+                "segment_hits": self.hits,
+                "segment_misses": self.misses,
+                "segment_hit_ratio": round(self.hits / lookups, 4) if lookups else 0,
+                "computations": self.computations,
+                "shared_requests": self.shared,
+                "shared_ratio": round(self.shared / requests, 4) if requests else 0,
+                "average_compute_ms": round(self.compute_seconds / self.computations * 1000, 2) if self.computations else 0,
+                "last_compute_ms": round(self.last_compute_seconds * 1000, 2),
+            }
+
+analytics_cache = AnalyticsCache()
+
+def single_flight(name: str):
+    """Collapse concurrent requests to an endpoint with identical query parameters into one computation"""
+    def decorator(endpoint):
+        @functools.wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            key = (name, tuple(sorted((k, v) for k, v in kwargs.items() if k != "db")))
+            return analytics_cache.single_flight(key, lambda: endpoint(*args, **kwargs))
+        return wrapper
+    return decorator
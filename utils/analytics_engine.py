@@ -0,0 +1,236 @@
+import os
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, List, Optional
+import numpy as np
+from sqlalchemy.orm import Session
+from utils.analytics_cache import analytics_cache
+from utils.analytics_rollups import (
+    MEASURES, ROLLUP_TIMEZONE, hourly_event_rows, hourly_rollup_rows, log_rows, rollup_generation,
+)
+
+class OccupancyConfig:
+    # Local "HH:MM" closing time that visits without a departure are clipped to; empty clips them to now
+    CLOSING_TIME = os.getenv("ANALYTICS_CLOSING_TIME", "")
+    MAX_DAYS = int(os.getenv("ANALYTICS_OCCUPANCY_MAX_DAYS", "31"))
+
+# ISO week numbers run from 1 to 53
+WEEKS = 54
+WEEKDAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+
+class AnalyticsFrame:
+    """
+    Columnar view of the hourly rollup rows for a range of local days.
+    Every row is one (local hour, entry type, verification flags) bucket with its measures,
+    and all statistics are sums of a measure under a mask, binned with bincount.
+    """
+
+    def __init__(self, start_day: date, end_day: date, rows: List[dict]):
+        self.start_day = start_day
+        self.end_day = end_day
+        self.days = np.arange(np.datetime64(start_day, "D"), np.datetime64(end_day + timedelta(days=1), "D"))
+        self.size = len(rows)
+
+        buckets = np.array([row["bucket_hour"] for row in rows], dtype="datetime64[h]")
+        bucket_days = buckets.astype("datetime64[D]")
+        self.day_index = np.searchsorted(self.days, bucket_days)
+        self.hour = (buckets - bucket_days).astype(np.int64)
+        self.type_names, self.type_codes = np.unique(
+            np.array([row["entry_type"] for row in rows], dtype=str), return_inverse=True
+        )
+        self.face = np.array([bool(row["face_verified"]) for row in rows], dtype=bool)
+        self.qr = np.array([bool(row["qr_verified"]) for row in rows], dtype=bool)
+        self.instructor = np.array([bool(row["instructor_verified"]) for row in rows], dtype=bool)
+        self.measures = {
+            measure: np.array([row[measure] or 0 for row in rows], dtype=np.float64)
+            for measure in MEASURES
+        }
+        week_of_day = np.array([day.isocalendar()[1] for day in self.days.tolist()], dtype=np.int64)
+        self.week_index = week_of_day[self.day_index]
+
+    def of_type(self, entry_type: str) -> np.ndarray:
+        matches = np.flatnonzero(self.type_names == entry_type)
+        if not len(matches):
+            return np.zeros(self.size, dtype=bool)
+        return self.type_codes == matches[0]
+
+    def matching_types(self, predicate: Callable[[str], bool]) -> np.ndarray:
+        return np.isin(self.type_codes, [code for code, name in enumerate(self.type_names) if predicate(name)])
+
+    @property
+    def success(self) -> np.ndarray:
+        """Group entries need the instructor or a face match, other entries both face and QR"""
+        group = self.of_type("group_entry")
+        return np.where(group, self.instructor | self.face, self.face & self.qr)
+
+    @property
+    def strict_success(self) -> np.ndarray:
+        return self.face & self.qr
+
+    def total(self, measure: str = "entries", mask: Optional[np.ndarray] = None) -> float:
+        values = self.measures[measure]
+        return float(values.sum() if mask is None else values[mask].sum())
+
+    def _bin(self, index: np.ndarray, length: int, measure: str, mask: Optional[np.ndarray]) -> np.ndarray:
+        weights = self.measures[measure] if mask is None else np.where(mask, self.measures[measure], 0.0)
+        return np.bincount(index, weights=weights, minlength=length)
+
+    def by_hour(self, measure: str = "entries", mask: Optional[np.ndarray] = None) -> np.ndarray:
+        return self._bin(self.hour, 24, measure, mask)
+
+    def by_day(self, measure: str = "entries", mask: Optional[np.ndarray] = None) -> np.ndarray:
+        return self._bin(self.day_index, len(self.days), measure, mask)
+
+    def by_week(self, measure: str = "entries", mask: Optional[np.ndarray] = None) -> np.ndarray:
+        return self._bin(self.week_index, WEEKS, measure, mask)
+
+    def by_type(self, measure: str = "entries") -> Dict[str, float]:
+        sums = np.bincount(self.type_codes, weights=self.measures[measure], minlength=len(self.type_names))
+        return {str(name): float(value) for name, value in zip(self.type_names, sums)}
+
+    def active_hours(self) -> np.ndarray:
+        return np.flatnonzero(np.bincount(self.hour, minlength=24))
+
+    def active_days(self) -> np.ndarray:
+        return np.flatnonzero(np.bincount(self.day_index, minlength=len(self.days)))
+
+    def active_weeks(self) -> np.ndarray:
+        return np.flatnonzero(np.bincount(self.week_index, minlength=WEEKS))
+
+    def day_label(self, index: int) -> str:
+        return str(self.days[index])
+
+def load_frame(db: Session, start_day: date, end_day: date,
+               institution_id: Optional[int] = None, user_id: Optional[int] = None) -> AnalyticsFrame:
+    """
+    The hourly rollups for the range, or a single user's logs aggregated the same way in Postgres.
+    Closed days come from the analytics cache, so a request usually only queries the open days.
+    """
+    def load(first: date, last: date) -> List[dict]:
+        if user_id:
+            return log_rows(db, first, last, "bucket_hour", institution_id, user_id)
+        return hourly_rollup_rows(db, first, last, institution_id)
+
+    rows = analytics_cache.rows((institution_id, user_id), start_day, end_day, load, rollup_generation(db))
+    return AnalyticsFrame(start_day, end_day, rows)
+
+def _grid(values: np.ndarray) -> List[List[float]]:
+    return [[float(value) for value in row] for row in values]
+
+def heatmap(db: Session, start_day: date, end_day: date, institution_id: Optional[int] = None) -> dict:
+    """Dense (local day x hour) matrices of arrivals, departures and average face verification time"""
+    rows = analytics_cache.rows(
+        ("heatmap", institution_id), start_day, end_day,
+        lambda first, last: hourly_event_rows(db, first, last, institution_id),
+        rollup_generation(db),
+    )
+    days = np.arange(np.datetime64(start_day, "D"), np.datetime64(end_day + timedelta(days=1), "D"))
+    buckets = np.array([row["bucket_hour"] for row in rows], dtype="datetime64[h]")
+    bucket_days = buckets.astype("datetime64[D]")
+    cell = np.searchsorted(days, bucket_days) * 24 + (buckets - bucket_days).astype(np.int64)
+    shape, cells = (len(days), 24), len(days) * 24
+
+    def binned(field: str) -> np.ndarray:
+        weights = np.array([row[field] or 0 for row in rows], dtype=np.float64)
+        return np.bincount(cell, weights=weights, minlength=cells).reshape(shape)
+
+    arrivals = binned("arrivals")
+    departures = binned("departures")
+    verified = binned("verified")
+    verification_seconds = binned("verification_seconds")
+    average_verification = np.round(
+        np.divide(verification_seconds, verified, out=np.zeros(shape), where=verified > 0), 2
+    )
+
+    # Days of the week fold onto a 7 x 24 grid for staffing
+    weekday = (days.view("int64") + 3) % 7  # Monday is 0, 1970-01-01 was a Thursday
+    by_weekday = np.zeros((7, 24))
+    np.add.at(by_weekday, weekday, arrivals)
+    weekday_days = np.bincount(weekday, minlength=7)
+
+    return {
+        "dates": [str(day) for day in days],
+        "weekdays": [WEEKDAYS[day] for day in weekday],
+        "arrivals": _grid(arrivals),
+        "departures": _grid(departures),
+        "average_verification_seconds": _grid(average_verification),
+        "weekday_labels": list(WEEKDAYS),
+        "weekday_arrivals": _grid(by_weekday),
+        "weekday_average_arrivals": _grid(np.round(
+            np.divide(by_weekday, weekday_days[:, None], out=np.zeros((7, 24)), where=weekday_days[:, None] > 0), 2
+        )),
+        "totals": {
+            "arrivals": int(arrivals.sum()),
+            "departures": int(departures.sum()),
+            "average_verification_seconds": round(float(verification_seconds.sum() / verified.sum()), 2)
+            if verified.sum() else 0,
+        },
+    }
+
+LOCAL_OFFSET_SECONDS = int(ROLLUP_TIMEZONE.utcoffset(None).total_seconds())
+
+def _local_iso(seconds: int) -> str:
+    """UTC epoch seconds as Asia/Kolkata ISO time"""
+    return f"{np.datetime64(int(seconds) + LOCAL_OFFSET_SECONDS, 's')}+05:30"
+
+def occupancy(intervals: List[tuple], window_start: datetime, window_end: datetime, now: datetime,
+              threshold: int = 0, resolution_minutes: int = 1, closing_minute: Optional[int] = None) -> dict:
+    """
+    People on site over [window_start, window_end), all naive UTC, from (arrival, departure) pairs.
+    Visits still open end at now, or at the local closing time of their day when closing_minute is given.
+    Peak and time above threshold come from a sorted sweep over +1/-1 events; the curve is sampled per minute.
+    """
+    start = int(np.datetime64(window_start, "s").astype(np.int64))
+    end = int(np.datetime64(min(window_end, now), "s").astype(np.int64))
+    arrivals = np.array([arrival for arrival, _ in intervals], dtype="datetime64[s]").astype(np.int64)
+    departures = np.array([departure for _, departure in intervals], dtype="datetime64[s]")
+    still_open = np.isnat(departures)
+    departures = departures.astype(np.int64)
+
+    open_until = np.full(len(arrivals), int(np.datetime64(now, "s").astype(np.int64)))
+    if closing_minute is not None:
+        day_start = (arrivals + LOCAL_OFFSET_SECONDS) // 86400 * 86400 - LOCAL_OFFSET_SECONDS
+        closing = day_start + closing_minute * 60
+        # Arrivals after closing time are open until the next day's closing
+        closing = np.where(closing >= arrivals, closing, closing + 86400)
+        open_until = np.minimum(open_until, closing)
+    departures = np.where(still_open, open_until, departures)
+
+    arrivals, departures = np.maximum(arrivals, start), np.minimum(departures, end)
+    kept = departures > arrivals
+    arrivals, departures = np.sort(arrivals[kept]), np.sort(departures[kept])
+
+    # Sweep: departures sort before arrivals at the same second, so back-to-back visits do not overlap
+    times = np.concatenate([arrivals, departures])
+    deltas = np.concatenate([np.ones(len(arrivals), dtype=np.int64), -np.ones(len(departures), dtype=np.int64)])
+    order = np.lexsort((deltas, times))
+    times, levels = times[order], np.cumsum(deltas[order])
+    spans = np.diff(np.append(times, end))
+    peak_index = int(np.argmax(levels)) if len(levels) else None
+
+    minutes = np.arange(start, max(end, start), 60, dtype=np.int64)
+    curve = np.searchsorted(arrivals, minutes, side="right") - np.searchsorted(departures, minutes, side="right")
+
+    step = max(int(resolution_minutes), 1)
+    buckets = -(-len(curve) // step)
+    padded = np.zeros(buckets * step, dtype=np.int64)
+    padded[:len(curve)] = curve
+    bucket_sizes = np.minimum(step, len(curve) - np.arange(buckets) * step)
+    bucket_peaks = padded.reshape(buckets, step).max(axis=1)
+    bucket_averages = padded.reshape(buckets, step).sum(axis=1) / np.maximum(bucket_sizes, 1)
+
+    return {
+        "visits": int(len(arrivals)),
+        "peak_occupancy": int(levels[peak_index]) if peak_index is not None else 0,
+        "peak_time": _local_iso(times[peak_index]) if peak_index is not None else None,
+        "threshold": threshold,
+        "minutes_above_threshold": round(float(spans[levels > threshold].sum()) / 60, 2),
+        "resolution_minutes": step,
+        "timeline": [
+            {
+                "time": _local_iso(minutes[index * step]),
+                "peak_occupancy": int(bucket_peaks[index]),
+                "average_occupancy": round(float(bucket_averages[index]), 2)
+            }
+            for index in range(buckets)
+        ],
+    }
@@ -0,0 +1,507 @@
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from utils.analytics_sketches import (
+    HISTOGRAM_UPSERT, VISITOR_UPSERT, SketchConfig, histogram_bin, histogram_bin_sql,
+    histogram_percentiles, hll_estimate, visitor_rebuild_sql,
+)
+
+# Rollups are bucketed in Asia/Kolkata local time, like the analytics responses
+ROLLUP_TIMEZONE = timezone(timedelta(hours=5, minutes=30))
+
+DIMENSIONS = ("entry_type", "face_verified", "qr_verified", "instructor_verified")
+MEASURES = (
+    "entries",
+    "new_visitors",
+    "completed",
+    "duration_seconds",
+    "completion_seconds",
+    "completion_under_1m",
+    "completion_1_2m",
+    "completion_2_5m",
+)
+
+def _parse_utc(value: str) -> datetime:
+    """Log timestamps are naive UTC ISO strings"""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def to_local(value: datetime) -> datetime:
+    """Naive UTC to naive Asia/Kolkata time"""
+    return value.replace(tzinfo=timezone.utc).astimezone(ROLLUP_TIMEZONE).replace(tzinfo=None)
+
+def log_entry_type(log: dict) -> str:
+    entry_type = log.get("entry_type") or "normal"
+    return entry_type if isinstance(entry_type, str) else "normal"
+
+def completion_minutes(log: dict) -> float:
+    """Time from arrival to completed verification; group entries and unverified scans use fixed defaults"""
+    if log_entry_type(log) == "group_entry":
+        return 0.5
+    if log.get("face_verification_time"):
+        return (_parse_utc(log["face_verification_time"]) - _parse_utc(log["arrival"])).total_seconds() / 60
+    return 1.0
+
+def log_contribution(log: Optional[dict], first_visit: bool = False) -> Optional[Tuple[tuple, Dict[str, float]]]:
+    """The (local hour, *dimensions) key and measures one time_logs entry adds to the rollups"""
+    if not log or not log.get("arrival"):
+        return None
+    arrival = _parse_utc(log["arrival"])
+    key = (
+        to_local(arrival).replace(minute=0, second=0, microsecond=0),
+        log_entry_type(log),
+        bool(log.get("face_verified")),
+        bool(log.get("qr_verified")),
+        bool(log.get("verified_by_instructor")),
+    )
+    departure = log.get("departure")
+    minutes = completion_minutes(log)
+    measures = {
+        "entries": 1,
+        "new_visitors": 1 if first_visit else 0,
+        "completed": 1 if departure else 0,
+        "duration_seconds": (_parse_utc(departure) - arrival).total_seconds() if departure else 0.0,
+        "completion_seconds": minutes * 60,
+        "completion_under_1m": 1 if minutes <= 1 else 0,
+        "completion_1_2m": 1 if 1 < minutes <= 2 else 0,
+        "completion_2_5m": 1 if 2 < minutes <= 5 else 0,
+    }
+    return key, measures
+
+def _upsert_sql(table: str, bucket_column: str) -> str:
+    columns = (bucket_column, "institution_id") + DIMENSIONS + MEASURES
+    conflict = ", ".join((bucket_column, "institution_id") + DIMENSIONS)
+    updates = ", ".join(f"{m} = {table}.{m} + EXCLUDED.{m}" for m in MEASURES)
+    return f"""
+        INSERT INTO {table} ({", ".join(columns)})
+        VALUES ({", ".join(":" + c for c in columns)})
+        ON CONFLICT ({conflict}) DO UPDATE SET {updates}
+    """
+
+HOURLY_UPSERT = _upsert_sql("analytics_hourly_rollups", "bucket_hour")
+DAILY_UPSERT = _upsert_sql("analytics_daily_rollups", "day")
+
+class RollupDelta:
+    """
+    Contribution changes collected during one write, applied to both rollup tables just before commit.
+    Changing a log is recorded as removing its old contribution and adding the new one.
+    The completion and dwell time histograms follow the same way; visitor sketches only grow.
+    """
+
+    def __init__(self):
+        self.hourly = defaultdict(lambda: dict.fromkeys(MEASURES, 0))
+        self.histograms = defaultdict(int)
+        self.visitors = set()
+
+    def add(self, institution_id: Optional[int], log: Optional[dict], first_visit: bool = False, sign: int = 1,
+            user_id: Optional[int] = None) -> None:
+        contribution = log_contribution(log, first_visit)
+        if contribution is None:
+            return
+        (bucket_hour, *dimensions), measures = contribution
+        totals = self.hourly[(bucket_hour, institution_id or 0, *dimensions)]
+        for name, value in measures.items():
+            totals[name] += sign * value
+
+        self.histograms[(bucket_hour, institution_id or 0, "completion", histogram_bin(measures["completion_seconds"]))] += sign
+        if measures["completed"]:
+            self.histograms[(bucket_hour, institution_id or 0, "duration", histogram_bin(measures["duration_seconds"]))] += sign
+        if user_id is not None and sign > 0:
+            self.visitors.add((bucket_hour, institution_id or 0, user_id))
+
+    def remove(self, institution_id: Optional[int], log: Optional[dict], first_visit: bool = False) -> None:
+        self.add(institution_id, log, first_visit, sign=-1)
+
+    def replace(self, institution_id: Optional[int], old_log: Optional[dict], new_log: Optional[dict], first_visit: bool = False) -> None:
+        self.remove(institution_id, old_log, first_visit)
+        self.add(institution_id, new_log, first_visit)
+
+    def daily(self) -> Dict[tuple, Dict[str, float]]:
+        daily = defaultdict(lambda: dict.fromkeys(MEASURES, 0))
+        for (bucket_hour, *rest), measures in self.hourly.items():
+            totals = daily[(bucket_hour.date(), *rest)]
+            for name, value in measures.items():
+                totals[name] += value
+        return daily
+
+    @staticmethod
+    def _params(bucket_column: str, changes: Dict[tuple, Dict[str, float]]) -> List[dict]:
+        # Sorted so concurrent writers lock rollup rows in the same order
+        params = []
+        for key in sorted(changes):
+            measures = changes[key]
+            if not any(measures.values()):
+                continue
+            params.append({
+                bucket_column: key[0],
+                "institution_id": key[1],
+                **dict(zip(DIMENSIONS, key[2:])),
+                **measures,
+            })
+        return params
+
+    def apply(self, db: Session) -> None:
+        """Upsert the deltas in the caller's transaction"""
+        hourly = self._params("bucket_hour", self.hourly)
+        if hourly:
+            db.execute(text(HOURLY_UPSERT), hourly)
+            daily = self._params("day", self.daily())
+            # A log moved between hours of the same day leaves the daily rollup unchanged
+            if daily:
+                db.execute(text(DAILY_UPSERT), daily)
+
+        histograms = [
+            dict(zip(("bucket_hour", "institution_id", "metric", "bin"), key), count=count)
+            for key, count in sorted(self.histograms.items()) if count
+        ]
+        if histograms:
+            db.execute(text(HISTOGRAM_UPSERT), histograms)
+        if self.visitors:
+            db.execute(text(VISITOR_UPSERT), [
+                {"bucket_hour": bucket_hour, "institution_id": institution_id, "user_id": user_id}
+                for bucket_hour, institution_id, user_id in sorted(self.visitors)
+            ])
+        self.hourly.clear()
+        self.histograms.clear()
+        self.visitors.clear()
+
+def iter_record_contributions(records: Iterable, start_day: date = None, end_day: date = None):
+    """(institution_id, user_id, key, measures) for every log of the given (FinalRecords, institution_id) rows"""
+    for record, institution_id in records:
+        for index, log in enumerate(record.time_logs or []):
+            contribution = log_contribution(log, first_visit=index == 0)
+            if contribution is None:
+                continue
+            key, measures = contribution
+            day = key[0].date()
+            if (start_day and day < start_day) or (end_day and day > end_day):
+                continue
+            yield institution_id, record.user_id, key, measures
+
+LOCAL_TIMEZONE_NAME = "Asia/Kolkata"
+
+def _json_truthy(field: str) -> str:
+    """SQL for Python's bool() of a time_logs field, so ids and flags count the same way in both"""
+    value = f"log.value->'{field}'"
+    return f"""COALESCE(CASE jsonb_typeof({value})
+            WHEN 'boolean' THEN ({value})::boolean
+            WHEN 'number' THEN ({value})::numeric <> 0
+            WHEN 'string' THEN {value} <> '""'::jsonb
+            WHEN 'object' THEN {value} <> '{{}}'::jsonb
+            WHEN 'array' THEN {value} <> '[]'::jsonb
+        END, FALSE)"""
+
+def _json_timestamp(field: str) -> str:
+    return f"(NULLIF(log.value->>'{field}', ''))::timestamp"
+
+def logs_cte(record_filter: str = "TRUE") -> str:
+    """
+    One row per time_logs entry with an arrival, expanded inside Postgres.
+    Timestamps stay naive UTC; local_* columns are Asia/Kolkata wall-clock time.
+    """
+    return f"""
+        logs AS (
+            SELECT
+                r.record_id,
+                r.user_id,
+                COALESCE(u.institution_id, 0) AS institution_id,
+                log.ordinality = 1 AS first_visit,
+                {_json_timestamp("arrival")} AS arrival,
+                {_json_timestamp("departure")} AS departure,
+                {_json_timestamp("face_verification_time")} AS face_verification_time,
+                CASE WHEN jsonb_typeof(log.value->'entry_type') = 'string' AND log.value->>'entry_type' <> ''
+                     THEN log.value->>'entry_type' ELSE 'normal' END AS entry_type,
+                {_json_truthy("face_verified")} AS face_verified,
+                {_json_truthy("qr_verified")} AS qr_verified,
+                {_json_truthy("verified_by_instructor")} AS instructor_verified
+            FROM final_records r
+            LEFT JOIN users u ON u.user_id = r.user_id
+            CROSS JOIN LATERAL jsonb_array_elements(
+                CASE WHEN jsonb_typeof(r.time_logs) = 'array' THEN r.time_logs ELSE '[]'::jsonb END
+            ) WITH ORDINALITY AS log(value, ordinality)
+            WHERE COALESCE(log.value->>'arrival', '') <> '' AND {record_filter}
+        ),
+        scored AS (
+            SELECT
+                logs.*,
+                timezone('UTC', arrival) AT TIME ZONE '{LOCAL_TIMEZONE_NAME}' AS local_arrival,
+                date_trunc('hour', timezone('UTC', arrival), '{LOCAL_TIMEZONE_NAME}') AT TIME ZONE '{LOCAL_TIMEZONE_NAME}' AS local_hour,
+                CASE WHEN entry_type = 'group_entry' THEN 0.5
+                     WHEN face_verification_time IS NOT NULL
+                     THEN extract(epoch FROM face_verification_time - arrival) / 60
+                     ELSE 1.0 END::float8 AS completion_minutes
+            FROM logs
+        )
+    """
+
+MEASURES_SQL = """
+    count(*) AS entries,
+    count(*) FILTER (WHERE first_visit) AS new_visitors,
+    count(*) FILTER (WHERE departure IS NOT NULL) AS completed,
+    COALESCE(sum(extract(epoch FROM departure - arrival)) FILTER (WHERE departure IS NOT NULL), 0)::float8 AS duration_seconds,
+    COALESCE(sum(completion_minutes) * 60, 0)::float8 AS completion_seconds,
+    count(*) FILTER (WHERE completion_minutes <= 1) AS completion_under_1m,
+    count(*) FILTER (WHERE completion_minutes > 1 AND completion_minutes <= 2) AS completion_1_2m,
+    count(*) FILTER (WHERE completion_minutes > 2 AND completion_minutes <= 5) AS completion_2_5m
+"""
+
+def record_filters(start_day: date = None, end_day: date = None, institution_id: Optional[int] = None,
+                   user_id: Optional[int] = None, records: str = "r", users: str = "u") -> Tuple[str, str, dict]:
+    """(final_records/users filter, local hour filter, params) for a range of local days"""
+    record_sql, local_sql, params = ["TRUE"], ["TRUE"], {}
+    # Local days run ahead of UTC, so a log's local day is its entry_date or the day after
+    if start_day:
+        record_sql.append(f"{records}.entry_date >= :record_start")
+        local_sql.append("local_hour >= :local_start")
+        params.update(record_start=start_day - timedelta(days=1), local_start=datetime.combine(start_day, datetime.min.time()))
+    if end_day:
+        record_sql.append(f"{records}.entry_date <= :record_end")
+        local_sql.append("local_hour < :local_end")
+        params.update(record_end=end_day, local_end=datetime.combine(end_day + timedelta(days=1), datetime.min.time()))
+    if institution_id:
+        record_sql.append(f"{users}.institution_id = :institution_id")
+        params["institution_id"] = institution_id
+    if user_id:
+        record_sql.append(f"{records}.user_id = :user_id")
+        params["user_id"] = user_id
+    return " AND ".join(record_sql), " AND ".join(local_sql), params
+
+def rebuild_rollups(db: Session, start_day: date = None, end_day: date = None, commit: bool = True) -> int:
+    """
+    Recompute the rollups from final_records inside Postgres, for all days or an inclusive range of local days.
+    The tables are locked for the rebuild, so concurrent scans wait and then apply their deltas on top.
+    """
+    db.execute(text(
+        "LOCK TABLE analytics_hourly_rollups, analytics_daily_rollups, analytics_hourly_histograms, "
+        "analytics_visitor_sketches IN EXCLUSIVE MODE"
+    ))
+    record_filter, local_filter, params = record_filters(start_day, end_day)
+    day_filter = local_filter.replace("local_hour", "bucket_hour")
+    db.execute(text(f"DELETE FROM analytics_hourly_rollups WHERE {day_filter}"), params)
+    db.execute(text(f"DELETE FROM analytics_daily_rollups WHERE {local_filter.replace('local_hour', 'day')}"), params)
+    db.execute(text(f"DELETE FROM analytics_hourly_histograms WHERE {day_filter}"), params)
+    db.execute(text(f"DELETE FROM analytics_visitor_sketches WHERE {day_filter}"), params)
+
+    dimensions = ", ".join(DIMENSIONS)
+    measures = ", ".join(MEASURES)
+    db.execute(text(f"""
+        WITH {logs_cte(record_filter)}
+        INSERT INTO analytics_hourly_rollups (bucket_hour, institution_id, {dimensions}, {measures})
+        SELECT local_hour, institution_id, {dimensions}, {MEASURES_SQL}
+        FROM scored
+        WHERE {local_filter}
+        GROUP BY local_hour, institution_id, {dimensions}
+    """), params)
+    sums = ", ".join(f"sum({m})" for m in MEASURES)
+    db.execute(text(f"""
+        INSERT INTO analytics_daily_rollups (day, institution_id, {dimensions}, {measures})
+        SELECT bucket_hour::date, institution_id, {dimensions}, {sums}
+        FROM analytics_hourly_rollups
+        WHERE {day_filter}
+        GROUP BY bucket_hour::date, institution_id, {dimensions}
+    """), params)
+    db.execute(text(f"""
+        WITH {logs_cte(record_filter)}
+        INSERT INTO analytics_hourly_histograms (bucket_hour, institution_id, metric, bin, count)
+        SELECT local_hour, institution_id, metric, bin, count(*)
+        FROM (
+            SELECT local_hour, institution_id, 'completion' AS metric,
+                   {histogram_bin_sql("completion_minutes * 60")} AS bin
+            FROM scored WHERE {local_filter}
+            UNION ALL
+            SELECT local_hour, institution_id, 'duration',
+                   {histogram_bin_sql("extract(epoch FROM departure - arrival)")}
+            FROM scored WHERE {local_filter} AND departure IS NOT NULL
+        ) binned
+        GROUP BY 1, 2, 3, 4
+    """), params)
+    db.execute(text(f"""
+        WITH {logs_cte(record_filter)}
+        INSERT INTO analytics_visitor_sketches (bucket_hour, institution_id, register, rank)
+        {visitor_rebuild_sql(local_filter)}
+    """), params)
+    logs = db.execute(text(
+        f"SELECT COALESCE(sum(entries), 0) FROM analytics_hourly_rollups WHERE {day_filter}"
+    ), params).scalar()
+    # Every worker sees the new generation with the rebuilt rows and stops serving its cached days
+    db.execute(text("""
+        INSERT INTO analytics_rollup_generation (id, generation) VALUES (1, 1)
+        ON CONFLICT (id) DO UPDATE SET generation = analytics_rollup_generation.generation + 1
+    """))
+    if commit:
+        db.commit()
+    return int(logs)
+
+def rollup_generation(db: Session) -> int:
+    """Bumped by rebuild_rollups(); part of the analytics cache key"""
+    return int(db.execute(text("SELECT generation FROM analytics_rollup_generation WHERE id = 1")).scalar() or 0)
+
+def log_rows(db: Session, start_day: date, end_day: date, grain: str = "day",
+             institution_id: Optional[int] = None, user_id: Optional[int] = None) -> List[dict]:
+    """The rollup rows computed straight from final_records in Postgres, e.g. for a single user"""
+    record_filter, local_filter, params = record_filters(start_day, end_day, institution_id, user_id)
+    bucket = {
+        "day": "local_hour::date",
+        "hour": "CAST(extract(hour FROM local_hour) AS INTEGER)",
+        "bucket_hour": "local_hour",
+    }[grain]
+    dimensions = ", ".join(DIMENSIONS)
+    rows = db.execute(text(f"""
+        WITH {logs_cte(record_filter)}
+        SELECT {bucket} AS {grain}, {dimensions}, {MEASURES_SQL}
+        FROM scored
+        WHERE {local_filter}
+        GROUP BY 1, {dimensions}
+        ORDER BY 1
+    """), params).mappings().all()
+    return [dict(row) for row in rows]
+
+def hourly_event_rows(db: Session, start_day: date, end_day: date, institution_id: Optional[int] = None) -> List[dict]:
+    """Arrivals, departures and face verification time per local hour; departures count in the hour they happened"""
+    record_filter, local_filter, params = record_filters(start_day, end_day, institution_id)
+    rows = db.execute(text(f"""
+        WITH {logs_cte(record_filter)},
+        events AS (
+            SELECT local_hour, 1 AS arrivals, 0 AS departures,
+                   CASE WHEN face_verification_time IS NOT NULL THEN 1 ELSE 0 END AS verified,
+                   COALESCE(extract(epoch FROM face_verification_time - arrival), 0) AS verification_seconds
+            FROM scored
+            UNION ALL
+            SELECT date_trunc('hour', timezone('UTC', departure), '{LOCAL_TIMEZONE_NAME}') AT TIME ZONE '{LOCAL_TIMEZONE_NAME}',
+                   0, 1, 0, 0
+            FROM scored
+            WHERE departure IS NOT NULL
+        )
+        SELECT local_hour AS bucket_hour, sum(arrivals) AS arrivals, sum(departures) AS departures,
+               sum(verified) AS verified, sum(verification_seconds)::float8 AS verification_seconds
+        FROM events
+        WHERE {local_filter}
+        GROUP BY 1
+        ORDER BY 1
+    """), params).mappings().all()
+    return [dict(row) for row in rows]
+
+def visit_intervals(db: Session, start_day: date, end_day: date, institution_id: Optional[int] = None) -> List[tuple]:
+    """(arrival, departure) in naive UTC of every visit overlapping the local days; departure is None while on site"""
+    record_filter, _, params = record_filters(start_day, end_day, institution_id)
+    window_start = datetime.combine(start_day, datetime.min.time(), ROLLUP_TIMEZONE)
+    window_end = datetime.combine(end_day + timedelta(days=1), datetime.min.time(), ROLLUP_TIMEZONE)
+    params.update(
+        window_start=window_start.astimezone(timezone.utc).replace(tzinfo=None),
+        window_end=window_end.astimezone(timezone.utc).replace(tzinfo=None),
+    )
+    return db.execute(text(f"""
+        WITH {logs_cte(record_filter)}
+        SELECT arrival, departure FROM logs
+        WHERE arrival < :window_end AND (departure IS NULL OR departure > :window_start)
+    """), params).all()
+
+def _filters(start_day: date, end_day: date, institution_id: Optional[int], column: str) -> Tuple[str, dict]:
+    if column == "bucket_hour":
+        sql = "bucket_hour >= :start AND bucket_hour < :end"
+        params = {
+            "start": datetime.combine(start_day, datetime.min.time()),
+            "end": datetime.combine(end_day + timedelta(days=1), datetime.min.time()),
+        }
+    else:
+        sql = "day BETWEEN :start AND :end"
+        params = {"start": start_day, "end": end_day}
+    if institution_id:
+        sql += " AND institution_id = :institution_id"
+        params["institution_id"] = institution_id
+    return sql, params
+
+def _grouped_rows(db: Session, table: str, bucket_sql: str, bucket_name: str, where: str, params: dict) -> List[dict]:
+    dimensions = ", ".join(DIMENSIONS)
+    sums = ", ".join(f"sum({m}) AS {m}" for m in MEASURES)
+    rows = db.execute(text(f"""
+        SELECT {bucket_sql} AS {bucket_name}, {dimensions}, {sums}
+        FROM {table}
+        WHERE {where}
+        GROUP BY 1, {dimensions}
+        ORDER BY 1
+    """), params).mappings().all()
+    return [dict(row) for row in rows]
+
+def daily_rollup_rows(db: Session, start_day: date, end_day: date, institution_id: Optional[int] = None) -> List[dict]:
+    """Measures per local day and dimensions, summed over institutions unless one is given"""
+    where, params = _filters(start_day, end_day, institution_id, "day")
+    return _grouped_rows(db, "analytics_daily_rollups", "day", "day", where, params)
+
+def hourly_rollup_rows(db: Session, start_day: date, end_day: date, institution_id: Optional[int] = None) -> List[dict]:
+    """Measures per local hour bucket and dimensions, summed over institutions unless one is given"""
+    where, params = _filters(start_day, end_day, institution_id, "bucket_hour")
+    return _grouped_rows(db, "analytics_hourly_rollups", "bucket_hour", "bucket_hour", where, params)
+
+def hour_of_day_rollup_rows(db: Session, start_day: date, end_day: date, institution_id: Optional[int] = None) -> List[dict]:
+    """Measures per local hour of day (0-23) and dimensions over the range"""
+    where, params = _filters(start_day, end_day, institution_id, "bucket_hour")
+    return _grouped_rows(db, "analytics_hourly_rollups", "CAST(extract(hour FROM bucket_hour) AS INTEGER)", "hour", where, params)
+
+def sketch_summary(db: Session, start_day: date, end_day: date, institution_id: Optional[int] = None) -> dict:
+    """Completion and dwell time percentiles and unique visitors for the range, merged from the hourly sketches"""
+    where, params = _filters(start_day, end_day, institution_id, "bucket_hour")
+    bins = db.execute(text(f"""
+        SELECT metric, bin, sum(count) FROM analytics_hourly_histograms
+        WHERE {where} GROUP BY metric, bin
+    """), params).all()
+    ranks = db.execute(text(f"""
+        SELECT register, max(rank) FROM analytics_visitor_sketches
+        WHERE {where} GROUP BY register
+    """), params).all()
+    return {
+        "completion_time_percentiles_minutes": histogram_percentiles((b, c) for m, b, c in bins if m == "completion"),
+        "duration_percentiles_minutes": histogram_percentiles((b, c) for m, b, c in bins if m == "duration"),
+        "unique_visitors": hll_estimate(ranks),
+        "mode": "sketch",
+    }
+
+def exact_summary(db: Session, start_day: date, end_day: date,
+                  institution_id: Optional[int] = None, user_id: Optional[int] = None) -> dict:
+    """sketch_summary() computed exactly from final_records"""
+    record_filter, local_filter, params = record_filters(start_day, end_day, institution_id, user_id)
+    row = db.execute(text(f"""
+        WITH {logs_cte(record_filter)}
+        SELECT
+            percentile_disc(ARRAY[0.5, 0.9, 0.99]) WITHIN GROUP (ORDER BY completion_minutes) AS completion,
+            percentile_disc(ARRAY[0.5, 0.9, 0.99]) WITHIN GROUP (ORDER BY extract(epoch FROM departure - arrival) / 60)
+                FILTER (WHERE departure IS NOT NULL) AS duration,
+            count(DISTINCT user_id) AS unique_visitors
+        FROM scored
+        WHERE {local_filter}
+    """), params).mappings().first()
+
+    def labelled(values):
+        return {label: round(float(value), 2) if value is not None else None
+                for label, value in zip(("p50", "p90", "p99"), values or (None, None, None))}
+
+    return {
+        "completion_time_percentiles_minutes": labelled(row["completion"]),
+        "duration_percentiles_minutes": labelled(row["duration"]),
+        "unique_visitors": row["unique_visitors"],
+        "mode": "exact",
+    }
+
+def distribution_summary(db: Session, start_day: date, end_day: date,
+                         institution_id: Optional[int] = None, user_id: Optional[int] = None) -> dict:
+    """Exact for a single user or a short range, otherwise from the mergeable sketches"""
+    if user_id or (end_day - start_day).days + 1 <= SketchConfig.EXACT_MAX_DAYS:
+        return exact_summary(db, start_day, end_day, institution_id, user_id)
+    return sketch_summary(db, start_day, end_day, institution_id)
+
+def rows_from_records(records: Iterable, start_day: date, end_day: date, grain: str = "day") -> List[dict]:
+    """Python reference for log_rows(), computed from (FinalRecords, institution_id) pairs in memory"""
+    grouped = defaultdict(lambda: dict.fromkeys(MEASURES, 0))
+    for _, _, key, measures in iter_record_contributions(records, start_day, end_day):
+        bucket = key[0].date() if grain == "day" else key[0].hour
+        totals = grouped[(bucket, *key[1:])]
+        for name, value in measures.items():
+            totals[name] += value
+    return [
+        {grain: key[0], **dict(zip(DIMENSIONS, key[1:])), **measures}
+        for key, measures in sorted(grouped.items(), key=lambda item: item[0][0])
+    ]
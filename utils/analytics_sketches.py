@@ -0,0 +1,94 @@
+import math
+import os
+from typing import Dict, Iterable, Optional, Tuple
+
+class SketchConfig:
+    # Ranges up to this many days are answered exactly from final_records instead of the sketches
+    EXACT_MAX_DAYS = int(os.getenv("ANALYTICS_EXACT_MAX_DAYS", "7"))
+
+# Histogram bins grow by 5%, so a percentile read from the bin midpoint is within about 2.5%
+HISTOGRAM_GROWTH = 1.05
+# 2^10 HyperLogLog registers: about 3% standard error on unique visitors
+HLL_PRECISION = 10
+HLL_REGISTERS = 1 << HLL_PRECISION
+PERCENTILES = (0.5, 0.9, 0.99)
+
+def histogram_bin(seconds: float) -> int:
+    """Bin 0 holds everything under a second, bin n >= 1 starts at HISTOGRAM_GROWTH ** (n - 1) seconds"""
+    if seconds < 1:
+        return 0
+    return 1 + int(math.floor(math.log(seconds) / math.log(HISTOGRAM_GROWTH)))
+
+def histogram_bin_sql(seconds: str) -> str:
+    """histogram_bin() in SQL, used when the histograms are rebuilt inside Postgres"""
+    return f"CASE WHEN {seconds} < 1 THEN 0 ELSE 1 + floor(ln({seconds}) / ln({HISTOGRAM_GROWTH}))::int END"
+
+def bin_value(bin_index: int) -> float:
+    """Geometric midpoint of a bin in seconds"""
+    if bin_index <= 0:
+        return 0.5
+    return HISTOGRAM_GROWTH ** (bin_index - 0.5)
+
+def histogram_percentiles(bins: Iterable[Tuple[int, float]], percentiles: Iterable[float] = PERCENTILES) -> Dict[str, Optional[float]]:
+    """Percentiles in minutes from (bin, count) pairs"""
+    counts = sorted((int(b), float(c)) for b, c in bins if c and c > 0)
+    total = sum(c for _, c in counts)
+    result = {}
+    for q in percentiles:
+        label = f"p{round(q * 100)}"
+        if not total:
+            result[label] = None
+            continue
+        target, seen = q * total, 0.0
+        for bin_index, count in counts:
+            seen += count
+            if seen >= target:
+                result[label] = round(bin_value(bin_index) / 60, 2)
+                break
+    return result
+
+def hll_estimate(ranks: Iterable[Tuple[int, int]]) -> int:
+    """Cardinality from merged (register, rank) pairs; empty registers are missing"""
+    registers = dict(ranks)
+    m = HLL_REGISTERS
+    alpha = 0.7213 / (1 + 1.079 / m)
+    empty = m - len(registers)
+    estimate = alpha * m * m / (sum(2.0 ** -rank for rank in registers.values()) + empty)
+    # Linear counting is more accurate while many registers are still empty
+    if estimate <= 2.5 * m and empty:
+        estimate = m * math.log(m / empty)
+    return int(round(estimate))
+
+def _hll_sql(hash_sql: str) -> Tuple[str, str]:
+    """(register, rank) of a bigint hash: low bits pick the register, the rank is the first set bit of the rest"""
+    register = f"({hash_sql}) & {HLL_REGISTERS - 1}"
+    rest = 64 - HLL_PRECISION
+    rank = f"COALESCE(NULLIF(position('1' IN substring(({hash_sql})::bit(64)::text, 1, {rest})), 0), {rest + 1})"
+    return register, rank
+
+def user_hash_sql(user_id: str) -> str:
+    return f"hashtextextended(CAST({user_id} AS text), 0)"
+
+HISTOGRAM_UPSERT = """
+    INSERT INTO analytics_hourly_histograms (bucket_hour, institution_id, metric, bin, count)
+    VALUES (:bucket_hour, :institution_id, :metric, :bin, :count)
+    ON CONFLICT (bucket_hour, institution_id, metric, bin)
+    DO UPDATE SET count = analytics_hourly_histograms.count + EXCLUDED.count
+"""
+
+_register, _rank = _hll_sql("hashed.h")
+VISITOR_UPSERT = f"""
+    INSERT INTO analytics_visitor_sketches (bucket_hour, institution_id, register, rank)
+    SELECT :bucket_hour, :institution_id, {_register}, {_rank}
+    FROM (SELECT {user_hash_sql(":user_id")} AS h) hashed
+    ON CONFLICT (bucket_hour, institution_id, register)
+    DO UPDATE SET rank = GREATEST(analytics_visitor_sketches.rank, EXCLUDED.rank)
+"""
+
+def visitor_rebuild_sql(local_filter: str) -> str:
+    """(local_hour, institution_id, register, rank) rows from the scored CTE of logs_cte()"""
+    return f"""
+        SELECT local_hour, institution_id, {_register} AS register, max({_rank}) AS rank
+        FROM (SELECT local_hour, institution_id, {user_hash_sql("user_id")} AS h FROM scored WHERE {local_filter}) hashed
+        GROUP BY 1, 2, 3
+    """
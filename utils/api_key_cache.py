@@ -0,0 +1,146 @@
+import os
+import select
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, Optional
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+class ApiKeyCacheConfig:
+    SIZE = int(os.getenv("API_KEY_CACHE_SIZE", "10000"))
+    TTL_SECONDS = float(os.getenv("API_KEY_CACHE_TTL_SECONDS", "60"))
+    # Postgres channel used to tell the other workers that a key was revoked
+    CHANNEL = os.getenv("API_KEY_INVALIDATION_CHANNEL", "api_key_invalidation")
+    # With a single worker local invalidation is enough and the listener can be turned off
+    LISTEN = os.getenv("API_KEY_CACHE_LISTEN", "true").lower() == "true"
+    RECONNECT_SECONDS = float(os.getenv("API_KEY_CACHE_RECONNECT_SECONDS", "5"))
+
+class ApiKeyCache:
+    """
+    Bounded TTL cache of verified API keys, keyed by the key hash.
+    Entries hold the app user's columns, so a hit needs no query. Logins and logouts
+    invalidate locally and through NOTIFY; while the listener is down the cache is bypassed.
+    """
+
+    def __init__(self, size: int = None, ttl_seconds: float = None):
+        self.size = size or ApiKeyCacheConfig.SIZE
+        self.ttl_seconds = ApiKeyCacheConfig.TTL_SECONDS if ttl_seconds is None else ttl_seconds
+        self._entries = OrderedDict()  # key hash -> (app_user_id, valid_until, columns)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+        self.listening = False
+        # Bumped on every invalidation, so a lookup that raced with one is not cached
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl_seconds > 0 and (self.listening or not ApiKeyCacheConfig.LISTEN)
+
+    def get(self, key_hash: str) -> Optional[Dict[str, Any]]:
+        """Cached columns of the app user owning the key, or None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key_hash)
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key_hash]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key_hash)
+            self.hits += 1
+            return dict(entry[2])
+
+    def generation(self) -> int:
+        """Take before reading the database and pass to put()"""
+        return self._generation
+
+    def put(self, key_hash: str, app_user_id: int, expiry: datetime, columns: Dict[str, Any], generation: int) -> None:
+        if not self.enabled:
+            return
+        # Never serve a key past its own expiry, so expired keys still reach the database and get cleared
+        remaining = (expiry - datetime.utcnow()).total_seconds()
+        valid_until = time.monotonic() + min(self.ttl_seconds, remaining)
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[key_hash] = (app_user_id, valid_until, columns)
+            self._entries.move_to_end(key_hash)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, app_user_id: int) -> None:
+        with self._lock:
+            for key_hash in [k for k, entry in self._entries.items() if entry[0] == app_user_id]:
+                del self._entries[key_hash]
+            self._generation += 1
+            self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def notify(self, db: Session, app_user_id: int) -> None:
+        """Queue a NOTIFY for all workers; Postgres delivers it when db commits"""
+        if ApiKeyCacheConfig.LISTEN:
+            db.execute(text("SELECT pg_notify(:channel, :payload)"),
+                       {"channel": ApiKeyCacheConfig.CHANNEL, "payload": str(app_user_id)})
+
+    def start(self) -> None:
+        if self._thread is not None or not ApiKeyCacheConfig.LISTEN:
+            return
+        self._thread = threading.Thread(target=self._listen_loop, name="api-key-listener", daemon=True)
+        self._thread.start()
+
+    def _listen_loop(self) -> None:
+        import psycopg2
+        from database import DATABASE_URL
+
+        while not self._stopping.is_set():
+            connection = None
+            try:
+                connection = psycopg2.connect(DATABASE_URL)
+                connection.autocommit = True
+                connection.cursor().execute(f'LISTEN "{ApiKeyCacheConfig.CHANNEL}"')
+                # Revocations may have been missed while disconnected
+                self.clear()
+                self.listening = True
+                print(f"API key cache listening on {ApiKeyCacheConfig.CHANNEL}")
+                while not self._stopping.is_set():
+                    if select.select([connection], [], [], 1.0)[0]:
+                        connection.poll()
+                        while connection.notifies:
+                            payload = connection.notifies.pop(0).payload
+                            self.invalidate_user(int(payload))
+            except Exception as e:
+                print(f"API key invalidation listener error: {str(e)}")
+            finally:
+                self.listening = False
+                if connection is not None:
+                    connection.close()
+            self._stopping.wait(ApiKeyCacheConfig.RECONNECT_SECONDS)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "listening": self.listening,
+            }
+
+    def close(self) -> None:
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(5)
+            self._thread = None
+
+api_key_cache = ApiKeyCache()
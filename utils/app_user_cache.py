@@ -0,0 +1,232 @@
+import hmac
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+from utils.security import hash_password, check_password
+
+class AppUserCacheConfig:
+    # Full reload interval used only when the realtime listener cannot be attached
+    REFRESH_SECONDS = int(os.getenv("APP_USER_REFRESH_SECONDS", "60"))
+    LOAD_TIMEOUT_SECONDS = int(os.getenv("APP_USER_LOAD_TIMEOUT_SECONDS", "15"))
+
+class AppUserCacheUnavailable(Exception):
+    """The app users have not been loaded yet, so a missing user name proves nothing"""
+
+class AppUserCredentialCache:
+    """
+    Local copy of the Firebase app_users node, indexed by user name and holding only salted hashes.
+    Loaded once, then kept current by a realtime listener (or a periodic reload as a fallback).
+    """
+
+    def __init__(self, ref_provider: Callable[[], Any]):
+        self.ref_provider = ref_provider
+        self._ref = None
+        self._records = {}  # Firebase key -> cached credential record
+        self._by_name = {}  # user name -> Firebase key
+        self._adding = set()  # user names being pushed by add()
+        self._plaintext = {}  # Firebase key -> legacy plaintext password waiting to be hashed
+        self._upgrade_thread = None
+        self._lock = threading.RLock()
+        self._loaded = threading.Event()
+        self._started = False
+        self._listener = None
+        self._refresh_thread = None
+        self._stopping = threading.Event()
+        self.updated_at = None
+
+    @property
+    def ref(self):
+        if self._ref is None:
+            self._ref = self.ref_provider()
+        return self._ref
+
+    def start(self) -> None:
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        try:
+            # The first listener event carries the whole node, later ones only the changes
+            self._listener = self.ref.listen(self._on_event)
+            if not self._loaded.wait(AppUserCacheConfig.LOAD_TIMEOUT_SECONDS):
+                raise TimeoutError("Timed out waiting for the initial app user snapshot")
+            print(f"App user cache loaded {len(self._records)} users, listening for changes")
+        except Exception as e:
+            print(f"App user listener unavailable, falling back to periodic reload: {str(e)}")
+            if self._listener is not None:
+                self._listener.close()
+                self._listener = None
+            try:
+                self.reload()
+            except Exception as e:
+                # Keep retrying from the refresh loop; lookups answer unavailable until a load succeeds
+                print(f"Error loading app users: {str(e)}")
+            self._refresh_thread = threading.Thread(target=self._refresh_loop, name="app-user-refresh", daemon=True)
+            self._refresh_thread.start()
+
+    def _refresh_loop(self) -> None:
+        while not self._stopping.wait(AppUserCacheConfig.REFRESH_SECONDS):
+            try:
+                self.reload()
+            except Exception as e:
+                print(f"Error reloading app users: {str(e)}")
+
+    def reload(self) -> None:
+        self._replace_all(self.ref.get() or {})
+
+    def _on_event(self, event) -> None:
+        try:
+            parts = [part for part in event.path.split("/") if part]
+            if not parts:
+                if event.event_type == "put":
+                    self._replace_all(event.data or {})
+                else:
+                    # Each child of a patch replaces that path; children may be deeper paths like key/field
+                    for path, value in (event.data or {}).items():
+                        key, _, field = path.strip("/").partition("/")
+                        if field:
+                            self._apply(key, {field: value}, merge=True)
+                        else:
+                            self._apply(key, value)
+            elif len(parts) == 1:
+                self._apply(parts[0], event.data, merge=event.event_type == "patch")
+            else:
+                # A single field of one user changed
+                self._apply(parts[0], {parts[1]: event.data}, merge=True)
+        except Exception as e:
+            print(f"Error applying app user change at {event.path}: {str(e)}")
+
+    def _replace_all(self, records: Dict[str, Any]) -> None:
+        with self._lock:
+            self._records = {}
+            self._by_name = {}
+            for key, record in records.items():
+                self._apply(key, record)
+        self._loaded.set()
+
+    def _apply(self, key: str, record: Optional[Dict[str, Any]], merge: bool = False) -> None:
+        with self._lock:
+            current = self._records.pop(key, None)
+            self._plaintext.pop(key, None)
+            if current is not None and self._by_name.get(current["name"]) == key:
+                del self._by_name[current["name"]]
+            if merge and current is not None and record is not None:
+                record = {**current["raw"], **record}
+            if not record or "name" not in record:
+                return
+            record = {k: v for k, v in record.items() if v is not None}
+
+            password_hash = record.get("password_hash")
+            if not password_hash and record.get("password") is not None:
+                # Hashing and the Firebase write happen on the upgrade thread, not under the lock
+                self._plaintext[key] = str(record["password"])
+                self._start_upgrades()
+            raw = {k: v for k, v in record.items() if k != "password"}
+            raw["password_hash"] = password_hash
+            self._records[key] = {
+                "name": record["name"],
+                "email": record.get("email"),
+                "password_hash": password_hash,
+                "raw": raw,
+            }
+            self._by_name[record["name"]] = key
+            self.updated_at = time.time()
+
+    def _start_upgrades(self) -> None:
+        with self._lock:
+            if self._upgrade_thread is None:
+                self._upgrade_thread = threading.Thread(target=self._upgrade_loop, name="app-user-upgrade", daemon=True)
+                self._upgrade_thread.start()
+
+    def _upgrade_loop(self) -> None:
+        """Hash legacy plaintext passwords one by one and replace them in Firebase"""
+        while True:
+            with self._lock:
+                if not self._plaintext:
+                    self._upgrade_thread = None
+                    return
+                key, password = next(iter(self._plaintext.items()))
+                name = self._records[key]["name"]
+            password_hash = hash_password(password)
+            try:
+                self.ref.child(key).update({"password_hash": password_hash, "password": None})
+                print(f"Upgraded stored password of app user {name} to a salted hash")
+            except Exception as e:
+                # The hash is still used locally; the next full load queues the upgrade again
+                print(f"Error upgrading password of app user {name}: {str(e)}")
+            with self._lock:
+                # Skip it if the record changed while hashing
+                if self._plaintext.get(key) == password:
+                    del self._plaintext[key]
+                    record = self._records[key]
+                    record["password_hash"] = record["raw"]["password_hash"] = password_hash
+
+    def _wait_loaded(self) -> None:
+        """Start the cache if needed and wait for the first load; the index is empty until then"""
+        if not self._started:
+            self.start()
+        if not self._loaded.wait(AppUserCacheConfig.LOAD_TIMEOUT_SECONDS):
+            raise AppUserCacheUnavailable("App users are still loading")
+
+    def verify(self, user_name: str, password: str) -> Optional[Dict[str, Any]]:
+        """Return the cached user if the credentials are valid, None otherwise"""
+        self._wait_loaded()
+        with self._lock:
+            key = self._by_name.get(user_name)
+            record = self._records.get(key) if key else None
+            plaintext = self._plaintext.get(key) if key else None
+        if record is None:
+            return None
+        if record["password_hash"]:
+            valid = check_password(password, record["password_hash"])
+        else:
+            # Legacy record whose upgrade has not run yet
+            valid = plaintext is not None and hmac.compare_digest(password.encode(), plaintext.encode())
+        if not valid:
+            return None
+        return {"name": record["name"], "email": record["email"]}
+
+    def exists(self, user_name: str) -> bool:
+        self._wait_loaded()
+        with self._lock:
+            return user_name in self._by_name
+
+    def add(self, user_name: str, password: str, email: str, unique_id_type: str, unique_id: str) -> bool:
+        """Create an app user in Firebase with a hashed password; False if the name is taken"""
+        self._wait_loaded()
+        record = {
+            "name": user_name,
+            "password_hash": hash_password(password),
+            "email": email,
+            "unique_id_type": unique_id_type,
+            "unique_id": unique_id,
+        }
+        with self._lock:
+            if user_name in self._by_name or user_name in self._adding:
+                return False
+            self._adding.add(user_name)
+        try:
+            # Pushed without holding the lock, so logins are not blocked on the network
+            key = self.ref.push(record).key
+            with self._lock:
+                # Index it right away rather than waiting for the listener to echo it back
+                self._apply(key, record)
+        finally:
+            with self._lock:
+                self._adding.discard(user_name)
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "users": len(self._records),
+                "listening": self._listener is not None,
+                "updated_at": self.updated_at,
+            }
+
+    def close(self) -> None:
+        self._stopping.set()
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
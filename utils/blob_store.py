@@ -0,0 +1,213 @@
+import hashlib
+import mimetypes
+import os
+from datetime import datetime, timedelta
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+from database import SessionLocal
+from utils.image_pipeline import ingest_image, delete_derivatives
+from utils.storage import storage
+
+UPLOAD_DIR = "uploads"
+PROBE_DIR = "temp_images"
+CHUNK_SIZE = 1024 * 1024
+
+class BlobStoreConfig:
+    # Probes are written before the record pointing at them commits, so young ones are never collected
+    PROBE_GRACE_HOURS = float(os.getenv("PROBE_GRACE_HOURS", "24"))
+
+# Session.info key of the blobs a transaction wrote and has not committed yet
+WRITTEN_BLOBS = "written_blobs"
+
+def hash_stream(stream) -> str:
+    """Return the SHA-256 hex digest of a file object, leaving it rewound"""
+    sha = hashlib.sha256()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+        sha.update(chunk)
+    stream.seek(0)
+    return sha.hexdigest()
+
+def blob_path(root: str, digest: str, ext: str) -> str:
+    """Sharded storage key of a blob: <root>/ab/cd/<digest>.<ext>"""
+    return f"{root}/{digest[:2]}/{digest[2:4]}/{digest}.{ext}"
+
+def is_blob_path(path: str) -> bool:
+    """Check whether a path already follows the content-addressed layout"""
+    if not path:
+        return False
+    parts = path.replace("\\", "/").split("/")
+    digest = os.path.splitext(parts[-1])[0]
+    return (
+        len(parts) >= 3 and len(digest) == 64
+        and parts[-3] == digest[:2] and parts[-2] == digest[2:4]
+    )
+
+def _lock_digest(db: Session, digest: str) -> None:
+    """Serialize writing and discarding the files of one digest until the transaction ends"""
+    db.execute(text("SELECT pg_advisory_xact_lock(hashtextextended(:digest, 0))"), {"digest": digest})
+
+def acquire_blob(db: Session, digest: str, path: str) -> None:
+    """
+    Add a reference to a blob, creating its row if needed.
+    The upsert keeps the row locked until commit, so a concurrent purge cannot remove the files.
+    """
+    db.execute(text("""
+        INSERT INTO upload_blobs (digest, path, ref_count, created_at)
+        VALUES (:digest, :path, 1, now())
+        ON CONFLICT (digest) DO UPDATE SET ref_count = upload_blobs.ref_count + 1
+    """), {"digest": digest, "path": path})
+
+def release_blob(db: Session, path: str) -> bool:
+    """Drop a reference to a blob. Returns True when nothing references it any more"""
+    if not is_blob_path(path):
+        return False
+    digest = os.path.splitext(os.path.basename(path))[0]
+    row = db.execute(text("""
+        UPDATE upload_blobs SET ref_count = GREATEST(ref_count - 1, 0)
+        WHERE digest = :digest
+        RETURNING ref_count
+    """), {"digest": digest}).first()
+    return row is not None and row.ref_count == 0
+
+def purge_blob(db: Session, path: str) -> bool:
+    """Delete an unreferenced blob and its derivatives. Call after the releasing transaction committed"""
+    if not is_blob_path(path):
+        return False
+    digest = os.path.splitext(os.path.basename(path))[0]
+    try:
+        row = db.execute(text("""
+            SELECT digest FROM upload_blobs
+            WHERE digest = :digest AND ref_count = 0
+            FOR UPDATE
+        """), {"digest": digest}).first()
+        if not row:
+            db.rollback()
+            return False
+
+        storage.delete(path)
+        delete_derivatives(path)
+        db.execute(text("DELETE FROM upload_blobs WHERE digest = :digest"), {"digest": digest})
+        db.commit()
+        return True
+    except Exception as e:
+        db.rollback()
+        print(f"Error purging blob {digest}: {e}")
+        return False
+
+def store_image(db: Session, stream, digest: str = None) -> str:
+    """
+    Store an uploaded image in the content-addressed upload store and return its master path.
+    Identical uploads share one master and one set of derivatives.
+    """
+    digest = digest or hash_stream(stream)
+    path = blob_path(UPLOAD_DIR, digest, "jpg")
+
+    _lock_digest(db, digest)
+    acquire_blob(db, digest, path)
+    if not storage.exists(path):
+        ingest_image(stream, path)
+        # Unlinked again if this transaction rolls back, see _discard_uncommitted_blobs
+        db.info.setdefault(WRITTEN_BLOBS, set()).add(path)
+    else:
+        print(f"Upload {digest} already stored, reusing {path}")
+
+    return path
+
+def discard_blob(path: str) -> bool:
+    """Delete a blob's files unless a committed row still references them"""
+    digest = os.path.splitext(os.path.basename(path))[0]
+    db = SessionLocal()
+    try:
+        _lock_digest(db, digest)
+        row = db.execute(text("SELECT ref_count FROM upload_blobs WHERE digest = :digest"), {"digest": digest}).first()
+        if row is not None and row.ref_count > 0:
+            db.rollback()
+            return False
+        storage.delete(path)
+        delete_derivatives(path)
+        db.execute(text("DELETE FROM upload_blobs WHERE digest = :digest"), {"digest": digest})
+        db.commit()
+        return True
+    except Exception as e:
+        db.rollback()
+        print(f"Error discarding blob {digest}: {e}")
+        return False
+    finally:
+        db.close()
+
+@event.listens_for(SessionLocal, "after_commit")
+def _keep_committed_blobs(session: Session) -> None:
+    session.info.pop(WRITTEN_BLOBS, None)
+
+@event.listens_for(SessionLocal, "after_transaction_end")
+def _discard_uncommitted_blobs(session: Session, transaction) -> None:
+    """Files written by a transaction that rolled back would otherwise be orphaned"""
+    if transaction.parent is not None:
+        return
+    for path in session.info.pop(WRITTEN_BLOBS, ()):
+        print(f"Discarding upload {path} written by a rolled back transaction")
+        discard_blob(path)
+
+def collect_unreferenced_blobs(db: Session) -> int:
+    """
+    Remove upload blobs nothing references: rows a purge left at zero, and files without a row,
+    e.g. from a process that died before its upload committed or was discarded
+    """
+    removed = 0
+    for (path,) in db.execute(text("SELECT path FROM upload_blobs WHERE ref_count = 0")).all():
+        removed += purge_blob(db, path)
+
+    # Derivatives are named <digest>_<name>, so every file of a blob starts with its digest
+    digests = {os.path.basename(key)[:64] for key in storage.list(f"{UPLOAD_DIR}/")}
+    known = {
+        digest for (digest,) in db.execute(
+            text("SELECT digest FROM upload_blobs WHERE digest = ANY(:digests)"), {"digests": list(digests)}
+        ).all()
+    }
+    db.rollback()
+    for digest in digests - known:
+        if len(digest) == 64:
+            removed += discard_blob(blob_path(UPLOAD_DIR, digest, "jpg"))
+    return removed
+
+def probe_extension(filename: str) -> str:
+    """Lower-cased extension of an uploaded file name, defaulting to jpg"""
+    ext = os.path.splitext(filename or "")[1].lstrip(".").lower()
+    return ext if ext.isalnum() else "jpg"
+
+def collect_unreferenced_probes(db: Session, grace_hours: float = None) -> int:
+    """Delete probe images older than the grace period that no attendance record points at"""
+    grace = BlobStoreConfig.PROBE_GRACE_HOURS if grace_hours is None else grace_hours
+    cutoff = datetime.utcnow() - timedelta(hours=grace)
+    candidates = [key for key, modified in storage.list_modified(f"{PROBE_DIR}/") if modified < cutoff]
+    if not candidates:
+        return 0
+    referenced = {
+        path for (path,) in db.execute(text("""
+            SELECT face_image_path FROM final_records WHERE face_image_path LIKE :prefix
+            UNION
+            SELECT log->>'face_image_path'
+            FROM final_records r
+            CROSS JOIN LATERAL jsonb_array_elements(
+                CASE WHEN jsonb_typeof(r.time_logs) = 'array' THEN r.time_logs ELSE '[]'::jsonb END
+            ) AS log
+            WHERE log->>'face_image_path' LIKE :prefix
+        """), {"prefix": f"{PROBE_DIR}/%"}).all()
+    }
+    db.rollback()
+    removed = 0
+    for key in candidates:
+        if key not in referenced:
+            storage.delete(key)
+            removed += 1
+    return removed
+
+def store_probe(stream, ext: str, digest: str = None) -> str:
+    """Store a verification probe image by content hash and return its path"""
+    digest = digest or hash_stream(stream)
+    path = blob_path(PROBE_DIR, digest, ext or "jpg")
+    if not storage.exists(path):
+        stream.seek(0)
+        storage.write_stream(path, stream, mimetypes.guess_type(path)[0])
+    return path
@@ -1,12 +1,15 @@
-import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
 from email.mime.application import MIMEApplication
-import os
-from typing import List
-from fastapi import HTTPException, BackgroundTasks
+from typing import Callable, List
+from fastapi import HTTPException
 from pathlib import Path
+from utils.storage import storage
+from template_generator import card_data_for_user, get_or_render_card
+from qr_generation import render_qr_png
+from utils.mail_worker import MailWorker, SMTPSession
+from utils.email_outbox import OutboxDispatcher
 
 class EmailConfig:
     # Gmail SMTP Configuration
@@ -25,110 +28,113 @@ class InvitationEmailHandler:
         if not all([self.email, self.password]):
             raise ValueError("Email credentials not configured")
 
-    def send_welcome_email(
+    def build_welcome_email(
         self,
         to_email: str,
         user_name: str,
-        qr_code_path: str,
+        qr_png: bytes,
         visitor_card_path: str
-    ) -> bool:
-        """Send welcome email with visitor card details and attachments"""
-        try:
-            msg = MIMEMultipart()
-            msg["From"] = self.email
-            msg["To"] = to_email
-            msg["Subject"] = "Welcome to Spring Festival - Your Visitor Card is Ready"
+    ) -> MIMEMultipart:
+        """Build the welcome email with the visitor card and QR code attached"""
+        msg = MIMEMultipart()
+        msg["From"] = self.email
+        msg["To"] = to_email
+        msg["Subject"] = "Welcome to Spring Festival - Your Visitor Card is Ready"
 
-            # HTML Content
-            html_content = f"""
-            <html>
-                <body style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
-                    <div style="background-color: #f8f9fa; padding: 20px; border-radius: 8px;">
-                        <h1 style="text-align: center; color: #1a1a1a;">Welcome to Spring Festival</h1>
-                        <div style="margin: 20px 0; line-height: 1.6;">
-                            <p>Dear {user_name},</p>
-                            <p>Welcome to Spring Festival! Your registration has been completed successfully.</p>
-                            <p>Your visitor card and QR code are attached to this email.</p>
-                            <p>Important Information:</p>
-                            <ul>
-                                <li>Keep your QR code handy for quick check-in</li>
-                                <li>Your visitor card is your identity within the premises</li>
-                                <li>Follow all safety guidelines and protocols</li>
-                            </ul>
-                            <p>Please find your visitor card and QR code attached to this email.</p>
-                        </div>
-                        <div style="text-align: center; color: #6c757d; font-size: 12px; margin-top: 20px; border-top: 1px solid #dee2e6; padding-top: 20px;">
-                            <p>This is an automated message. Please do not reply to this email.</p>
-                            <p>Spring Festival Team</p>
-                        </div>
+        # HTML Content
+        html_content = f"""
+        <html>
+            <body style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
+                <div style="background-color: #f8f9fa; padding: 20px; border-radius: 8px;">
+                    <h1 style="text-align: center; color: #1a1a1a;">Welcome to Spring Festival</h1>
+                    <div style="margin: 20px 0; line-height: 1.6;">
+                        <p>Dear {user_name},</p>
+                        <p>Welcome to Spring Festival! Your registration has been completed successfully.</p>
+                        <p>Your visitor card and QR code are attached to this email.</p>
+                        <p>Important Information:</p>
+                        <ul>
+                            <li>Keep your QR code handy for quick check-in</li>
+                            <li>Your visitor card is your identity within the premises</li>
+                            <li>Follow all safety guidelines and protocols</li>
+                        </ul>
+                        <p>Please find your visitor card and QR code attached to this email.</p>
                     </div>
-                </body>
-            </html>
-            """
-
-            msg.attach(MIMEText(html_content, "html"))
+                    <div style="text-align: center; color: #6c757d; font-size: 12px; margin-top: 20px; border-top: 1px solid #dee2e6; padding-top: 20px;">
+                        <p>This is an automated message. Please do not reply to this email.</p>
+                        <p>Spring Festival Team</p>
+                    </div>
+                </div>
+            </body>
+        </html>
+        """
 
-            # Attach Visitor Card
-            if os.path.exists(visitor_card_path):
-                with open(visitor_card_path, 'rb') as f:
-                    visitor_card = MIMEImage(f.read())
-                    visitor_card.add_header(
-                        'Content-Disposition',
-                        'attachment',
-                        filename=f'visitor_card_{user_name}.png'
-                    )
-                    msg.attach(visitor_card)
+        msg.attach(MIMEText(html_content, "html"))
 
-            # Attach QR Code
-            if os.path.exists(qr_code_path):
-                with open(qr_code_path, 'rb') as f:
-                    qr_code = MIMEImage(f.read())
-                    qr_code.add_header(
-                        'Content-Disposition',
-                        'attachment',
-                        filename=f'qr_code_{user_name}.png'
-                    )
-                    msg.attach(qr_code)
+        # Attach Visitor Card
+        if visitor_card_path and storage.exists(visitor_card_path):
+            visitor_card = MIMEImage(storage.read_bytes(visitor_card_path))
+            visitor_card.add_header(
+                'Content-Disposition',
+                'attachment',
+                filename=f'visitor_card_{user_name}.png'
+            )
+            msg.attach(visitor_card)
 
-            try:
-                # Connect to Gmail SMTP Server and Send Email
-                server = smtplib.SMTP_SSL(EmailConfig.SMTP_SERVER, EmailConfig.SMTP_PORT)
-                server.login(self.email, self.password)
-                server.send_message(msg)
-                server.quit()
-                print(f"✅ Welcome email with attachments sent successfully to {to_email}!")
-                return True
+        # Attach QR Code
+        if qr_png:
+            qr_code = MIMEImage(qr_png, "png")
+            qr_code.add_header(
+                'Content-Disposition',
+                'attachment',
+                filename=f'qr_code_{user_name}.png'
+            )
+            msg.attach(qr_code)
 
-            except Exception as e:
-                print(f"❌ SMTP Error: {str(e)}")
-                return False
+        return msg
 
+    def send_welcome_email(
+        self,
+        to_email: str,
+        user_name: str,
+        qr_png: bytes,
+        visitor_card_path: str
+    ) -> bool:
+        """Send one welcome email over a fresh connection; bulk sending goes through mail_worker"""
+        try:
+            msg = self.build_welcome_email(to_email, user_name, qr_png, visitor_card_path)
+            session = smtp_session()
+            try:
+                session.send(msg)
+            finally:
+                session.close()
+            print(f"✅ Welcome email with attachments sent successfully to {to_email}!")
+            return True
         except Exception as e:
             print(f"❌ Failed to send welcome email: {str(e)}")
             return False
 
-def send_welcome_email_background(
-    background_tasks: BackgroundTasks,
-    user_email: str,
-    user_name: str,
-    qr_code_path: str,
-    visitor_card_path: str
-):
-    """Add email sending to background tasks"""
-    def send_email():
-        try:
-            email_handler = InvitationEmailHandler()
-            success = email_handler.send_welcome_email(
-                to_email=user_email,
-                user_name=user_name,
-                qr_code_path=qr_code_path,
-                visitor_card_path=visitor_card_path
-            )
-            if success:
-                print(f"✅ Background email with attachments sent successfully to {user_email}")
-            else:
-                print(f"❌ Failed to send background email to {user_email}")
-        except Exception as e:
-            print(f"❌ Background email task failed: {str(e)}")
+def smtp_session() -> SMTPSession:
+    return SMTPSession(EmailConfig.SMTP_SERVER, EmailConfig.SMTP_PORT, EmailConfig.EMAIL_ADDRESS, EmailConfig.EMAIL_PASSWORD)
+
+# Dedicated sender threads with persistent SMTP connections, shared by the whole process
+mail_worker = MailWorker(smtp_session)
+
+def welcome_email_job(user) -> Callable[[], MIMEMultipart]:
+    """Outbox builder for the welcome template; the visitor card is rendered on the mail thread"""
+    card_data = card_data_for_user(user)
+    user_email, user_name = user.email, user.name
+
+    def build_message():
+        visitor_card_path, _ = get_or_render_card(card_data)
+        return InvitationEmailHandler().build_welcome_email(
+            to_email=user_email,
+            user_name=user_name,
+            qr_png=render_qr_png(card_data["qr_payload"]),
+            visitor_card_path=visitor_card_path
+        )
+    return build_message
+
+WELCOME_TEMPLATE = "welcome"
 
-    background_tasks.add_task(send_email) 
\ No newline at end of file
+# Feeds due outbox rows to the mail worker
+outbox_dispatcher = OutboxDispatcher(mail_worker, {WELCOME_TEMPLATE: welcome_email_job})
@@ -0,0 +1,211 @@
+import os
+import random
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from database import SessionLocal
+import models
+
+class OutboxConfig:
+    POLL_SECONDS = float(os.getenv("EMAIL_OUTBOX_POLL_SECONDS", "2"))
+    BATCH_SIZE = int(os.getenv("EMAIL_OUTBOX_BATCH_SIZE", "50"))
+    MAX_ATTEMPTS = int(os.getenv("EMAIL_OUTBOX_MAX_ATTEMPTS", "8"))
+    BACKOFF_BASE_SECONDS = int(os.getenv("EMAIL_OUTBOX_BACKOFF_BASE_SECONDS", "30"))
+    BACKOFF_MAX_SECONDS = int(os.getenv("EMAIL_OUTBOX_BACKOFF_MAX_SECONDS", "3600"))
+    # Rows left in "sending" longer than this (e.g. the worker died) are claimed again
+    LEASE_SECONDS = int(os.getenv("EMAIL_OUTBOX_LEASE_SECONDS", "600"))
+    # Claimed rows waiting in the mail queue; keep it well under what the rate limit sends within the lease
+    MAX_IN_FLIGHT = int(os.getenv("EMAIL_OUTBOX_MAX_IN_FLIGHT", "100"))
+    # Run the dispatcher inside the web app; disable when tasks/email_outbox_worker.py runs separately
+    IN_APP = os.getenv("EMAIL_OUTBOX_IN_APP", "true").lower() == "true"
+
+# Timestamps are stored as naive UTC, like the rest of the schema
+UTC_NOW = "timezone('utc', now())"
+
+def enqueue_email(db: Session, user_id: int, template: str) -> None:
+    """Add an email to the outbox inside the caller's transaction; a duplicate for the same user and template is ignored"""
+    db.execute(text(f"""
+        INSERT INTO email_outbox (user_id, template, status, attempts, next_attempt_at, created_at)
+        VALUES (:user_id, :template, 'pending', 0, {UTC_NOW}, {UTC_NOW})
+        ON CONFLICT (user_id, template) DO NOTHING
+    """), {"user_id": user_id, "template": template})
+
+def enqueue_institution(db: Session, institution_id: int, template: str, resend: bool = True) -> int:
+    """Queue an email for every user of an institution in one statement; resend resets rows already sent or failed"""
+    conflict = """
+        DO UPDATE SET status = 'pending', attempts = 0, next_attempt_at = EXCLUDED.next_attempt_at,
+                      last_error = NULL, sent_at = NULL
+        WHERE email_outbox.status IN ('sent', 'failed')
+    """ if resend else "DO NOTHING"
+    result = db.execute(text(f"""
+        INSERT INTO email_outbox (user_id, template, status, attempts, next_attempt_at, created_at)
+        SELECT user_id, :template, 'pending', 0, {UTC_NOW}, {UTC_NOW}
+        FROM users WHERE institution_id = :institution_id
+        ON CONFLICT (user_id, template) {conflict}
+    """), {"institution_id": institution_id, "template": template})
+    db.commit()
+    return result.rowcount
+
+def claim_due(db: Session, limit: int) -> List[dict]:
+    """Claim due rows for this worker; SKIP LOCKED lets several workers poll without blocking each other"""
+    rows = db.execute(text(f"""
+        UPDATE email_outbox SET status = 'sending', locked_at = {UTC_NOW}, attempts = attempts + 1
+        WHERE outbox_id IN (
+            SELECT outbox_id FROM email_outbox
+            WHERE (status = 'pending' AND next_attempt_at <= {UTC_NOW})
+               OR (status = 'sending' AND locked_at < {UTC_NOW} - make_interval(secs => :lease))
+            ORDER BY next_attempt_at
+            LIMIT :limit
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING outbox_id, user_id, template, attempts
+    """), {"limit": limit, "lease": OutboxConfig.LEASE_SECONDS}).mappings().all()
+    db.commit()
+    return [dict(row) for row in rows]
+
+def backoff_seconds(attempts: int) -> float:
+    """Exponential backoff with jitter"""
+    delay = min(OutboxConfig.BACKOFF_BASE_SECONDS * 2 ** max(attempts - 1, 0), OutboxConfig.BACKOFF_MAX_SECONDS)
+    return delay * random.uniform(0.8, 1.2)
+
+def mark_sent(db: Session, outbox_id: int) -> None:
+    db.execute(text(f"""
+        UPDATE email_outbox SET status = 'sent', sent_at = {UTC_NOW}, locked_at = NULL, last_error = NULL
+        WHERE outbox_id = :outbox_id
+    """), {"outbox_id": outbox_id})
+    db.commit()
+
+def mark_failed(db: Session, outbox_id: int, attempts: int, error: str) -> None:
+    """Schedule a retry, or give up once the attempts are used up"""
+    if attempts >= OutboxConfig.MAX_ATTEMPTS:
+        status, next_attempt_at = "failed", datetime.utcnow()
+    else:
+        status, next_attempt_at = "pending", datetime.utcnow() + timedelta(seconds=backoff_seconds(attempts))
+    db.execute(text("""
+        UPDATE email_outbox SET status = :status, next_attempt_at = :next_attempt_at,
+                                locked_at = NULL, last_error = :error
+        WHERE outbox_id = :outbox_id
+    """), {"status": status, "next_attempt_at": next_attempt_at, "error": error[:2000], "outbox_id": outbox_id})
+    db.commit()
+
+def release_claim(db: Session, outbox_id: int) -> None:
+    """Hand a claimed row back without counting the attempt, e.g. when the mail queue is full"""
+    db.execute(text("""
+        UPDATE email_outbox SET status = 'pending', attempts = GREATEST(attempts - 1, 0), locked_at = NULL
+        WHERE outbox_id = :outbox_id
+    """), {"outbox_id": outbox_id})
+    db.commit()
+
+def outbox_stats(db: Session) -> dict:
+    """Backlog and throughput of the outbox"""
+    counts = dict(db.execute(text("SELECT status, count(*) FROM email_outbox GROUP BY status")).all())
+    row = db.execute(text(f"""
+        SELECT
+            min(next_attempt_at) FILTER (WHERE status = 'pending') AS oldest_pending,
+            count(*) FILTER (WHERE status = 'sent' AND sent_at >= {UTC_NOW} - interval '5 minutes') AS sent_5m,
+            count(*) FILTER (WHERE status = 'sent' AND sent_at >= {UTC_NOW} - interval '1 hour') AS sent_1h,
+            count(*) FILTER (WHERE status = 'pending' AND attempts > 0) AS retrying
+        FROM email_outbox
+    """)).mappings().first()
+    oldest = row["oldest_pending"]
+    return {
+        "pending": counts.get("pending", 0),
+        "sending": counts.get("sending", 0),
+        "sent": counts.get("sent", 0),
+        "failed": counts.get("failed", 0),
+        "retrying": row["retrying"],
+        "oldest_pending_seconds": round((datetime.utcnow() - oldest).total_seconds(), 1) if oldest else 0,
+        "sent_per_minute_5m": round(row["sent_5m"] / 5, 2),
+        "sent_last_hour": row["sent_1h"],
+    }
+
+class OutboxDispatcher:
+    """
+    Polls the outbox and hands due emails to the mail worker.
+    Results are written back from the mail threads: sent, or rescheduled with backoff.
+    """
+
+    def __init__(self, mail_worker, builders: Dict[str, Callable[[models.User], Callable]]):
+        self.mail_worker = mail_worker
+        self.builders = builders
+        self._thread = None
+        self._stopping = threading.Event()
+        self.claimed = 0
+        self.sent = 0
+        self.retried = 0
+
+    def dispatch_once(self) -> int:
+        """Claim as many due rows as the mail queue has room for and submit them"""
+        in_flight = self.mail_worker.stats()["queued"]
+        limit = min(OutboxConfig.BATCH_SIZE, OutboxConfig.MAX_IN_FLIGHT - in_flight, self.mail_worker.free_slots())
+        if limit <= 0:
+            return 0
+        db = SessionLocal()
+        try:
+            rows = claim_due(db, limit)
+            if not rows:
+                return 0
+            self.claimed += len(rows)
+            users = {
+                user.user_id: user
+                for user in db.query(models.User).filter(models.User.user_id.in_([r["user_id"] for r in rows]))
+            }
+            # Builders copy what they need from the user up front, the jobs run after this session closed
+            jobs = []
+            for row in rows:
+                user = users.get(row["user_id"])
+                builder = self.builders.get(row["template"])
+                if user is None or builder is None:
+                    jobs.append((row, None, None))
+                else:
+                    jobs.append((row, builder(user), f"{row['template']} email to {user.email}"))
+
+            for row, build_message, description in jobs:
+                if build_message is None:
+                    mark_failed(db, row["outbox_id"], OutboxConfig.MAX_ATTEMPTS, "Unknown user or template")
+                elif not self.mail_worker.submit(build_message, description, on_done=self._on_done(row)):
+                    release_claim(db, row["outbox_id"])
+            return len(rows)
+        finally:
+            db.close()
+
+    def _on_done(self, row: dict) -> Callable[[Optional[Exception]], None]:
+        def done(error: Optional[Exception]) -> None:
+            db = SessionLocal()
+            try:
+                if error is None:
+                    mark_sent(db, row["outbox_id"])
+                    self.sent += 1
+                else:
+                    mark_failed(db, row["outbox_id"], row["attempts"], str(error))
+                    self.retried += 1
+            except Exception as e:
+                print(f"Error updating outbox row {row['outbox_id']}: {str(e)}")
+            finally:
+                db.close()
+        return done
+
+    def run(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                # Keep claiming while there is a backlog, otherwise wait for the next poll
+                if self.dispatch_once() >= OutboxConfig.BATCH_SIZE:
+                    continue
+            except Exception as e:
+                print(f"Error dispatching outbox: {str(e)}")
+            self._stopping.wait(OutboxConfig.POLL_SECONDS)
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name="email-outbox", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(10)
+
+    def stats(self) -> dict:
+        return {"claimed": self.claimed, "sent": self.sent, "retried": self.retried}
@@ -0,0 +1,238 @@
+import atexit
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Tuple
+
+class EventLoggerConfig:
+    FLUSH_INTERVAL_SECONDS = float(os.getenv("EVENT_FLUSH_INTERVAL_SECONDS", "1.0"))
+    FLUSH_SIZE = int(os.getenv("EVENT_FLUSH_SIZE", "200"))
+    QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "10000"))
+    # drop_oldest, drop_newest or spill (append overflow to SPILL_PATH and replay it once the queue drains)
+    OVERFLOW_POLICY = os.getenv("EVENT_OVERFLOW_POLICY", "spill")
+    SPILL_PATH = os.getenv("EVENT_SPILL_PATH", "event_spill/events.jsonl")
+
+# Same alphabet as Firebase push ids, so generated keys sort chronologically like push() keys
+PUSH_CHARS = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+_push_lock = threading.Lock()
+_last_push_time = 0
+_last_random = []
+
+def push_key() -> str:
+    """Generate a Firebase-style push id locally instead of asking the server for one"""
+    global _last_push_time, _last_random
+    with _push_lock:
+        now = int(time.time() * 1000)
+        if now == _last_push_time:
+            # Increment the random part so keys created in the same millisecond stay ordered
+            for i in range(11, -1, -1):
+                if _last_random[i] != 63:
+                    _last_random[i] += 1
+                    break
+                _last_random[i] = 0
+        else:
+            _last_random = [random.randrange(64) for _ in range(12)]
+        _last_push_time = now
+
+        time_chars = []
+        for _ in range(8):
+            time_chars.append(PUSH_CHARS[now % 64])
+            now //= 64
+        return "".join(reversed(time_chars)) + "".join(PUSH_CHARS[i] for i in _last_random)
+
+class BufferedEventLogger:
+    """
+    Collects events in a bounded in-memory queue and writes them from a background thread,
+    one multi-path update per batch. Callers only enqueue, so they never wait on the network.
+    """
+
+    def __init__(
+        self,
+        write_batch: Callable[[Dict[str, Any]], None],
+        flush_interval: float = None,
+        flush_size: int = None,
+        max_queue: int = None,
+        overflow_policy: str = None,
+        spill_path: str = None,
+    ):
+        self.write_batch = write_batch
+        self.flush_interval = flush_interval or EventLoggerConfig.FLUSH_INTERVAL_SECONDS
+        self.flush_size = flush_size or EventLoggerConfig.FLUSH_SIZE
+        self.max_queue = max_queue or EventLoggerConfig.QUEUE_SIZE
+        self.overflow_policy = overflow_policy or EventLoggerConfig.OVERFLOW_POLICY
+        self.spill_path = spill_path or EventLoggerConfig.SPILL_PATH
+
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._spill_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.failed_batches = 0
+
+    def enqueue(self, path: str, data: Dict[str, Any]) -> str:
+        """Queue an event under path/<push key> and return the key"""
+        key = push_key()
+        item = (f"{path}/{key}", data)
+        spill = False
+        with self._condition:
+            if len(self._queue) >= self.max_queue:
+                if self.overflow_policy == "drop_newest":
+                    self.dropped += 1
+                    return key
+                if self.overflow_policy == "drop_oldest":
+                    self._queue.popleft()
+                    self.dropped += 1
+                else:
+                    spill = True
+            if not spill:
+                self._queue.append(item)
+                self.enqueued += 1
+                if len(self._queue) >= self.flush_size:
+                    self._condition.notify()
+        if spill:
+            # Written after releasing the queue lock, so the file I/O does not stall other callers or the writer
+            self._spill([item])
+            return key
+        self._ensure_started()
+        return key
+
+    def _ensure_started(self) -> None:
+        if self._thread is None:
+            with self._condition:
+                if self._thread is None and not self._stopping:
+                    self._thread = threading.Thread(target=self._run, name="event-logger", daemon=True)
+                    self._thread.start()
+                    atexit.register(self.close)
+
+    def _run(self) -> None:
+        retry_delay = 0
+        while True:
+            with self._condition:
+                if retry_delay:
+                    # Back off while the backend is failing instead of retrying in a tight loop
+                    self._condition.wait(retry_delay)
+                elif len(self._queue) < self.flush_size:
+                    self._condition.wait(self.flush_interval)
+                if self._stopping:
+                    return
+            failures = self.failed_batches
+            written = self.flush()
+            if self.failed_batches > failures:
+                retry_delay = min(max(retry_delay * 2, self.flush_interval), 30)
+                continue
+            retry_delay = 0
+            if written == 0 and not self._queue:
+                self._replay_spill()
+
+    def _take_batch(self) -> List[Tuple[str, Dict[str, Any]]]:
+        with self._condition:
+            count = min(self.flush_size, len(self._queue))
+            return [self._queue.popleft() for _ in range(count)]
+
+    def flush(self) -> int:
+        """Write everything queued so far; returns the number of events written"""
+        written = 0
+        with self._flush_lock:
+            while True:
+                batch = self._take_batch()
+                if not batch:
+                    return written
+                try:
+                    self.write_batch(dict(batch))
+                    written += len(batch)
+                    self.written += len(batch)
+                except Exception as e:
+                    self.failed_batches += 1
+                    print(f"Error writing {len(batch)} events: {str(e)}")
+                    self._requeue(batch)
+                    return written
+
+    def _requeue(self, batch: list) -> None:
+        """Put a failed batch back at the front of the queue, spilling or dropping what no longer fits"""
+        with self._condition:
+            room = max(self.max_queue - len(self._queue), 0)
+            overflow = batch[room:]
+            self._queue.extendleft(reversed(batch[:room]))
+        if overflow:
+            if self.overflow_policy == "spill":
+                self._spill(overflow)
+            else:
+                self.dropped += len(overflow)
+
+    def _spill(self, items: list) -> None:
+        try:
+            with self._spill_lock:
+                os.makedirs(os.path.dirname(os.path.abspath(self.spill_path)), exist_ok=True)
+                with open(self.spill_path, "a") as spill_file:
+                    for path, data in items:
+                        spill_file.write(json.dumps({"path": path, "data": data}) + "\n")
+            self.spilled += len(items)
+        except Exception as e:
+            self.dropped += len(items)
+            print(f"Error spilling {len(items)} events: {str(e)}")
+
+    def _replay_spill(self) -> None:
+        """Feed spilled events back through the writer once the queue has drained"""
+        with self._spill_lock:
+            if not os.path.exists(self.spill_path):
+                return
+            replay_path = f"{self.spill_path}.replay"
+            os.replace(self.spill_path, replay_path)
+
+        with open(replay_path) as replay_file:
+            events = [json.loads(line) for line in replay_file if line.strip()]
+        replayed = 0
+        try:
+            for start in range(0, len(events), self.flush_size):
+                batch = events[start:start + self.flush_size]
+                self.write_batch({event["path"]: event["data"] for event in batch})
+                replayed += len(batch)
+                self.written += len(batch)
+        except Exception as e:
+            # Keep the unreplayed remainder for the next attempt
+            print(f"Error replaying spilled events: {str(e)}")
+            self._spill([(event["path"], event["data"]) for event in events[replayed:]])
+        os.remove(replay_path)
+        if replayed:
+            print(f"Replayed {replayed} spilled events")
+
+    def stats(self) -> dict:
+        with self._condition:
+            queued = len(self._queue)
+        return {
+            "queued": queued,
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+            "failed_batches": self.failed_batches,
+        }
+
+    def close(self, timeout: float = 10.0) -> None:
+        """Stop the background thread and flush what is still queued"""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
+
+        # Whatever could not be written is kept on disk if spilling is enabled
+        with self._condition:
+            remaining = list(self._queue)
+            self._queue.clear()
+        if remaining:
+            if self.overflow_policy == "spill":
+                self._spill(remaining)
+            else:
+                self.dropped += len(remaining)
+                print(f"Dropped {len(remaining)} unwritten events on shutdown")
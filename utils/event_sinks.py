@@ -0,0 +1,139 @@
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Tuple
+
+class EventSinkConfig:
+    # firebase, local or memory
+    BACKEND = os.getenv("EVENT_SINK", "firebase")
+    LOG_DIR = os.getenv("EVENT_LOG_DIR", "event_log")
+    SEGMENT_BYTES = int(os.getenv("EVENT_LOG_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+    # fsync at most this often; 0 syncs after every batch
+    FSYNC_INTERVAL_SECONDS = float(os.getenv("EVENT_LOG_FSYNC_INTERVAL_SECONDS", "1.0"))
+
+class EventSink:
+    """Destination for batches of events, given as a {path: data} multi-path update"""
+
+    def write_batch(self, updates: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+class FirebaseSink(EventSink):
+    """Writes each batch to Realtime Database as one multi-path update"""
+
+    def __init__(self):
+        self._ref = None
+
+    @property
+    def ref(self):
+        if self._ref is None:
+            from firebase_config import firebase_reference
+            self._ref = firebase_reference("/")
+        return self._ref
+
+    def write_batch(self, updates: Dict[str, Any]) -> None:
+        self.ref.update(updates)
+
+class MemorySink(EventSink):
+    """Keeps events in a list, for tests and local benchmarks"""
+
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+
+    def write_batch(self, updates: Dict[str, Any]) -> None:
+        with self._lock:
+            self.events.extend(updates.items())
+
+    def clear(self) -> None:
+        with self._lock:
+            self.events = []
+
+class LocalLogSink(EventSink):
+    """
+    Append-only JSONL log split into numbered segments.
+    Segments rotate at a size limit; fsyncs are batched by interval instead of issued per write.
+    """
+
+    def __init__(self, directory: str = None, segment_bytes: int = None, fsync_interval: float = None):
+        self.directory = directory or EventSinkConfig.LOG_DIR
+        self.segment_bytes = segment_bytes or EventSinkConfig.SEGMENT_BYTES
+        self.fsync_interval = EventSinkConfig.FSYNC_INTERVAL_SECONDS if fsync_interval is None else fsync_interval
+        self._lock = threading.Lock()
+        self._file = None
+        self._segment = None
+        self._last_sync = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def segment_path(self, number: int) -> str:
+        return os.path.join(self.directory, f"events-{number:06d}.jsonl")
+
+    def segments(self) -> List[str]:
+        """Segment files in write order"""
+        names = sorted(
+            name for name in os.listdir(self.directory)
+            if name.startswith("events-") and name.endswith(".jsonl")
+        )
+        return [os.path.join(self.directory, name) for name in names]
+
+    def _open_segment(self) -> None:
+        if self._segment is None:
+            existing = self.segments()
+            self._segment = int(os.path.basename(existing[-1])[7:13]) if existing else 1
+        elif self._file is not None:
+            self._sync()
+            self._file.close()
+            self._segment += 1
+        self._file = open(self.segment_path(self._segment), "a", encoding="utf-8")
+
+    def _sync(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_sync = time.monotonic()
+
+    def write_batch(self, updates: Dict[str, Any]) -> None:
+        timestamp = time.time()
+        lines = "".join(
+            json.dumps({"path": path, "data": data, "logged_at": timestamp}, default=str) + "\n"
+            for path, data in updates.items()
+        )
+        with self._lock:
+            if self._file is None or self._file.tell() >= self.segment_bytes:
+                self._open_segment()
+            self._file.write(lines)
+            if time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync()
+            else:
+                self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
+
+def read_segment(path: str, offset: int = 0) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """Yield (offset after the line, event) for each complete line of a segment"""
+    with open(path, "rb") as segment:
+        segment.seek(offset)
+        for line in segment:
+            if not line.endswith(b"\n"):
+                # Partially written tail, picked up on the next read
+                return
+            offset += len(line)
+            if line.strip():
+                yield offset, json.loads(line)
+
+def create_event_sink(backend: str = None) -> EventSink:
+    backend = backend or EventSinkConfig.BACKEND
+    if backend == "firebase":
+        return FirebaseSink()
+    if backend == "local":
+        return LocalLogSink()
+    if backend == "memory":
+        return MemorySink()
+    raise ValueError(f"Unknown event sink backend: {backend}")
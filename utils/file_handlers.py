@@ -1,26 +1,244 @@
-import os
-import shutil
-from uuid import uuid4
-from fastapi import UploadFile
-
-UPLOAD_DIR = "uploads"
-
-def save_upload_file(file: UploadFile, prefix: str = "") -> str:
-    """Save an uploaded file and return the path"""
-    filename = f"{prefix}_{uuid4().hex}_{file.filename}"
-    file_path = os.path.join(UPLOAD_DIR, filename)
-    
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    
-    return file_path
+import hashlib
+from dataclasses import dataclass
+from typing import Optional
+from fastapi import UploadFile, HTTPException
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+from utils.image_pipeline import delete_derivatives
+from utils.blob_store import store_image, store_probe, release_blob, purge_blob, is_blob_path
+from utils.storage import storage
+
+CHUNK_SIZE = 64 * 1024
+MB = 1024 * 1024
+
+# Image types accepted for uploads, keyed by the name returned from sniff_image_type
+IMAGE_TYPES = {
+    "jpeg": ("jpg", "image/jpeg"),
+    "png": ("png", "image/png"),
+    "webp": ("webp", "image/webp"),
+}
+
+@dataclass
+class UploadLimit:
+    max_bytes: int
+    allowed_types: tuple = ("jpeg", "png", "webp")
+
+PROFILE_IMAGE_LIMIT = UploadLimit(max_bytes=10 * MB)
+PROBE_IMAGE_LIMIT = UploadLimit(max_bytes=5 * MB)
+APP_USER_IMAGE_LIMIT = UploadLimit(max_bytes=5 * MB)
+QR_FRAME_LIMIT = UploadLimit(max_bytes=3 * MB)
+MAX_QR_FRAMES = 8
+# Requests with form fields only
+FORM_FIELDS_LIMIT = MB
+
+# Whole-request limits, checked against Content-Length before the body is parsed and against the bytes received.
+# They leave a little room for the other form fields on top of the file limit.
+REQUEST_BODY_LIMITS = {
+    "/users/create": PROFILE_IMAGE_LIMIT.max_bytes + MB,
+    "/users/{user_id}": PROFILE_IMAGE_LIMIT.max_bytes + MB,
+    "/face_recognition/verify": PROBE_IMAGE_LIMIT.max_bytes + MB,
+    "/face_recognition/group_entry": PROBE_IMAGE_LIMIT.max_bytes + MB,
+    "/verify_face": PROBE_IMAGE_LIMIT.max_bytes + MB,
+    "/app_users/create": APP_USER_IMAGE_LIMIT.max_bytes + MB,
+    "/qr/scan_frames": MAX_QR_FRAMES * QR_FRAME_LIMIT.max_bytes + MB,
+    "/qr/group_entry": FORM_FIELDS_LIMIT,
+    "/qr/group_entry_bypass": FORM_FIELDS_LIMIT,
+}
+
+@dataclass
+class UploadInfo:
+    digest: str
+    size: int
+    image_type: str
+
+    @property
+    def extension(self) -> str:
+        return IMAGE_TYPES[self.image_type][0]
+
+    @property
+    def content_type(self) -> str:
+        return IMAGE_TYPES[self.image_type][1]
+
+def sniff_image_type(header: bytes) -> Optional[str]:
+    """Detect the image type from its magic bytes instead of trusting the file name"""
+    if header.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if len(header) >= 12 and header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+class UploadScanner:
+    """Hashes, sizes and type-checks an upload chunk by chunk, failing as soon as a limit is hit"""
+
+    def __init__(self, limit: UploadLimit):
+        self.limit = limit
+        self.sha = hashlib.sha256()
+        self.size = 0
+        self.image_type = None
+
+    def feed(self, chunk: bytes) -> None:
+        if self.size == 0:
+            self.image_type = sniff_image_type(chunk[:16])
+            if self.image_type not in self.limit.allowed_types:
+                raise HTTPException(status_code=415, detail="Image must be a jpg, png or webp file")
+        self.size += len(chunk)
+        if self.size > self.limit.max_bytes:
+            raise HTTPException(status_code=413, detail=f"Image must be at most {self.limit.max_bytes // MB} MB")
+        self.sha.update(chunk)
+
+    def result(self) -> UploadInfo:
+        if self.size == 0:
+            raise HTTPException(status_code=400, detail="Uploaded file is empty")
+        return UploadInfo(digest=self.sha.hexdigest(), size=self.size, image_type=self.image_type)
+
+def check_declared_size(file: UploadFile, limit: UploadLimit) -> None:
+    """Reject an upload whose declared size is already over the limit, without reading it"""
+    size = getattr(file, "size", None)
+    if size is not None and size > limit.max_bytes:
+        raise HTTPException(status_code=413, detail=f"Image must be at most {limit.max_bytes // MB} MB")
+
+async def receive_upload(file: UploadFile, limit: UploadLimit) -> UploadInfo:
+    """Stream an upload in chunks, hashing it and enforcing the limit, without buffering it in memory"""
+    check_declared_size(file, limit)
+    scanner = UploadScanner(limit)
+    await file.seek(0)
+    while True:
+        chunk = await file.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        scanner.feed(chunk)
+    await file.seek(0)
+    return scanner.result()
+
+def inspect_upload(file: UploadFile, limit: UploadLimit) -> UploadInfo:
+    """Blocking counterpart of receive_upload for sync endpoints, which already run in the threadpool"""
+    check_declared_size(file, limit)
+    scanner = UploadScanner(limit)
+    file.file.seek(0)
+    for chunk in iter(lambda: file.file.read(CHUNK_SIZE), b""):
+        scanner.feed(chunk)
+    file.file.seek(0)
+    return scanner.result()
+
+def save_upload_file(file: UploadFile, db: Session) -> str:
+    """Store an uploaded image in the content-addressed store and return the master path"""
+    info = inspect_upload(file, PROFILE_IMAGE_LIMIT)
+    try:
+        return store_image(db, file.file, info.digest)
+    except Exception as e:
+        print(f"Error ingesting upload {file.filename}: {e}")
+        raise HTTPException(status_code=400, detail="Uploaded file is not a valid image")
+
+async def save_probe_upload(file: UploadFile) -> str:
+    """Stream a verification probe into storage and return its path"""
+    info = await receive_upload(file, PROBE_IMAGE_LIMIT)
+    return await run_in_threadpool(store_probe, file.file, info.extension, info.digest)
+
+async def read_qr_frame(file: UploadFile) -> bytes:
+    """Check a camera frame against the frame limit and return its bytes"""
+    await receive_upload(file, QR_FRAME_LIMIT)
+    return await file.read()
+
+async def save_app_user_picture(file: UploadFile, user_name: str) -> str:
+    """Stream an app user's profile picture into storage and return its path"""
+    info = await receive_upload(file, APP_USER_IMAGE_LIMIT)
+    path = f"app_users/{user_name}_{info.digest[:16]}.{info.extension}"
+    await run_in_threadpool(storage.write_stream, path, file.file, info.content_type)
+    return path
+
+def release_upload_file(db: Session, file_path: str) -> None:
+    """Drop the reference a record holds on an upload, inside the caller's transaction"""
+    if is_blob_path(file_path):
+        release_blob(db, file_path)
+
+def purge_upload_file(db: Session, file_path: str) -> bool:
+    """Remove a released upload once its transaction committed, if nothing references it any more"""
+    if is_blob_path(file_path):
+        return purge_blob(db, file_path)
+    # Legacy flat uploads are owned by a single record
+    return delete_file(file_path)
 
 def delete_file(file_path: str) -> bool:
-    """Delete a file if it exists"""
+    """Delete a stored file and any image derivatives generated for it"""
     try:
-        if file_path and os.path.exists(file_path):
-            os.remove(file_path)
+        if file_path and storage.exists(file_path):
+            storage.delete(file_path)
+            delete_derivatives(file_path)
             return True
     except Exception as e:
         print(f"Error deleting file: {e}")
-    return False 
\ No newline at end of file
+    return False
+
+class RequestBodyTooLarge(HTTPException):
+    def __init__(self, limit: int):
+        super().__init__(status_code=413, detail=f"Request body must be at most {limit // MB} MB")
+
+class UploadSizeLimitMiddleware:
+    """
+    Reject oversized upload requests: from their Content-Length before the body is read, and by
+    counting the received bytes for chunked or understated bodies, aborting once the limit is passed.
+    """
+
+    def __init__(self, app, limits: dict = None):
+        self.app = app
+        self.limits = limits or REQUEST_BODY_LIMITS
+
+    def _limit_for(self, path: str) -> Optional[int]:
+        if path in self.limits:
+            return self.limits[path]
+        # Match templated paths such as /users/{user_id}
+        parts = path.rstrip("/").split("/")
+        for pattern, limit in self.limits.items():
+            pattern_parts = pattern.split("/")
+            if len(pattern_parts) == len(parts) and all(
+                p == q or (p.startswith("{") and p.endswith("}"))
+                for p, q in zip(pattern_parts, parts)
+            ):
+                return limit
+        return None
+
+    async def __call__(self, scope, receive, send):
+        limit = None
+        if scope["type"] == "http" and scope["method"] in ("POST", "PUT"):
+            limit = self._limit_for(scope["path"])
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > limit:
+            await self._reject(RequestBodyTooLarge(limit), scope, receive, send)
+            return
+
+        received = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # An HTTPException, so the form parser passes it through and the app answers 413
+                    raise RequestBodyTooLarge(limit)
+            return message
+
+        async def tracking_send(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except RequestBodyTooLarge as e:
+            if response_started:
+                raise
+            await self._reject(e, scope, receive, send)
+
+    async def _reject(self, error: RequestBodyTooLarge, scope, receive, send) -> None:
+        response = JSONResponse(status_code=error.status_code, content={"detail": error.detail})
+        await response(scope, receive, send)
@@ -0,0 +1,103 @@
+import os
+from io import BytesIO
+from PIL import Image, ImageOps
+from utils.storage import storage
+
+# Longest side of the stored master image
+MAX_MASTER_SIZE = 1600
+MASTER_QUALITY = 85
+
+# Derivatives generated once at ingest time: name -> (box size, format, extension, save options)
+DERIVATIVES = {
+    "face": ((160, 160), "JPEG", "jpg", {"quality": 95}),          # face model input, stretched like before
+    "avatar": ((150, 150), "JPEG", "jpg", {"quality": 90}),        # visitor card avatar
+    "thumb": ((200, 200), "WEBP", "webp", {"quality": 80, "method": 6}),
+    "thumb_small": ((64, 64), "WEBP", "webp", {"quality": 75, "method": 6}),
+}
+
+CONTENT_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+def load_normalized(source) -> Image.Image:
+    """Open an image, apply its EXIF rotation and convert it to RGB"""
+    image = Image.open(source)
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        # Flatten transparency on a white background instead of black
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.split()[-1])
+        return background
+    return image.convert("RGB")
+
+def open_stored_image(key: str) -> Image.Image:
+    """Open an image held in storage. Pillow needs a seekable stream, so the object is buffered"""
+    return Image.open(BytesIO(storage.read_bytes(key)))
+
+def load_stored_normalized(key: str) -> Image.Image:
+    """Open an image held in storage with EXIF rotation applied, as RGB"""
+    return load_normalized(BytesIO(storage.read_bytes(key)))
+
+def crop_to_box(image: Image.Image, box_size: tuple) -> Image.Image:
+    """Resize and center-crop an image to exactly fill the given box"""
+    return ImageOps.fit(image, box_size, Image.Resampling.LANCZOS)
+
+def resize_to_box(image: Image.Image, box_size: tuple) -> Image.Image:
+    """Stretch an image to the box without cropping, like the transforms.Resize the face model was tuned with"""
+    return image.resize(box_size, Image.Resampling.BILINEAR)
+
+def fit_derivative(image: Image.Image, name: str) -> Image.Image:
+    box_size = DERIVATIVES[name][0]
+    # The face crop keeps the whole frame so embeddings match those of the original uploads
+    return resize_to_box(image, box_size) if name == "face" else crop_to_box(image, box_size)
+
+def derivative_path(master_path: str, name: str) -> str:
+    """Return the path a derivative of the given master image is stored at"""
+    stem, _ = os.path.splitext(master_path)
+    return f"{stem}_{name}.{DERIVATIVES[name][2]}"
+
+def derivative_or_original(master_path: str, name: str) -> str:
+    """Return the derivative path if it was generated, otherwise the master path"""
+    if master_path:
+        path = derivative_path(master_path, name)
+        if storage.exists(path):
+            return path
+    return master_path
+
+def save_image(image: Image.Image, key: str, image_format: str, **options) -> None:
+    """Encode an image and write it to storage in one atomic put"""
+    buffer = BytesIO()
+    image.save(buffer, image_format, **options)
+    buffer.seek(0)
+    storage.write_stream(key, buffer, CONTENT_TYPES.get(image_format))
+
+def ingest_image(source, master_path: str) -> dict:
+    """
+    Store a normalized, size-capped JPEG master and all derivatives for an uploaded image.
+    Returns a dict mapping "master" and each derivative name to its path.
+    """
+    image = load_normalized(source)
+    if max(image.size) > MAX_MASTER_SIZE:
+        image.thumbnail((MAX_MASTER_SIZE, MAX_MASTER_SIZE), Image.Resampling.LANCZOS)
+
+    paths = {"master": master_path}
+
+    # Derivatives are written first so an existing master means the whole set is complete
+    for name, (_, image_format, _, options) in DERIVATIVES.items():
+        path = derivative_path(master_path, name)
+        save_image(fit_derivative(image, name), path, image_format, **options)
+        paths[name] = path
+
+    save_image(image, master_path, "JPEG", quality=MASTER_QUALITY, optimize=True, progressive=True)
+    return paths
+
+def regenerate_derivative(master_path: str, name: str) -> str:
+    """Write one derivative again from its stored master, e.g. after the way it is fitted changed"""
+    _, image_format, _, options = DERIVATIVES[name]
+    path = derivative_path(master_path, name)
+    save_image(fit_derivative(load_stored_normalized(master_path), name), path, image_format, **options)
+    return path
+
+def delete_derivatives(master_path: str) -> None:
+    """Delete every derivative generated for a master image"""
+    for name in DERIVATIVES:
+        storage.delete(derivative_path(master_path, name))
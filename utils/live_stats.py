@@ -0,0 +1,194 @@
+import os
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from database import SessionLocal
+
+class LiveStatsConfig:
+    PATH = os.getenv("LIVE_STATS_PATH", "live_stats")
+    PUBLISH_SECONDS = float(os.getenv("LIVE_STATS_PUBLISH_SECONDS", "5"))
+    # Window used for the per-operator scans per minute
+    RATE_WINDOW_SECONDS = int(os.getenv("LIVE_STATS_RATE_WINDOW_SECONDS", "300"))
+    # Also push every scan and face verification as its own event, as before
+    RAW_EVENTS = os.getenv("LIVE_STATS_RAW_EVENTS", "false").lower() == "true"
+
+# Operator id of the counters backfilled from FinalRecords at startup, and of scans without an operator
+SEED_OPERATOR = -1
+NO_OPERATOR = 0
+# Serializes the once-a-day backfill between workers starting together
+SEED_LOCK_KEY = 4039
+
+COUNTER_UPSERT = """
+    INSERT INTO live_stats_counters (day, operator_id, bucket_minute, metric, count)
+    VALUES (:day, :operator_id, :bucket_minute, :metric, :count)
+    ON CONFLICT (day, operator_id, bucket_minute, metric)
+    DO UPDATE SET count = live_stats_counters.count + EXCLUDED.count
+"""
+
+class LiveStats:
+    """
+    Visitor counters for the current day, published as one compact snapshot.
+    Each worker counts locally and flushes its deltas to live_stats_counters; the snapshot is
+    summed from that table, so with several workers every scan is counted exactly once.
+    """
+
+    def __init__(self, session_factory: Callable = None):
+        self.session_factory = session_factory or SessionLocal
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+        self._pending = defaultdict(int)  # (day, operator, minute, metric) -> count not yet flushed
+        self._published = None
+
+    def _record(self, metric: str, operator_id, count: int) -> None:
+        # Entries are dated by UTC day, like FinalRecords.entry_date
+        now = datetime.utcnow()
+        key = (now.date(), operator_id or NO_OPERATOR, now.replace(second=0, microsecond=0), metric)
+        with self._lock:
+            self._pending[key] += count
+
+    def record_arrival(self, operator_id=None, count: int = 1) -> None:
+        self._record("arrivals", operator_id, count)
+
+    def record_departure(self, operator_id=None, count: int = 1) -> None:
+        self._record("departures", operator_id, count)
+
+    def record_verification(self, outcome: str, operator_id=None) -> None:
+        """outcome is matched, not_matched or unknown_user"""
+        self._record(f"verification:{outcome}", operator_id, 1)
+
+    def flush(self, db: Session) -> None:
+        """Add this worker's counts since the last flush to the shared counters"""
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(int)
+        if not pending:
+            return
+        try:
+            db.execute(text(COUNTER_UPSERT), [
+                {"day": day, "operator_id": operator_id, "bucket_minute": minute, "metric": metric, "count": count}
+                for (day, operator_id, minute, metric), count in sorted(pending.items())
+            ])
+            db.commit()
+        except Exception:
+            db.rollback()
+            # Keep the counts for the next flush
+            with self._lock:
+                for key, count in pending.items():
+                    self._pending[key] += count
+            raise
+
+    def snapshot(self, db: Session) -> Dict:
+        """Today's totals over all workers"""
+        now = datetime.utcnow()
+        rows = db.execute(text("""
+            SELECT operator_id, metric, sum(count) AS total,
+                   COALESCE(sum(count) FILTER (WHERE bucket_minute >= :window_start), 0) AS recent
+            FROM live_stats_counters
+            WHERE day = :day
+            GROUP BY operator_id, metric
+        """), {"day": now.date(), "window_start": now - timedelta(seconds=LiveStatsConfig.RATE_WINDOW_SECONDS)}).mappings().all()
+
+        totals = defaultdict(int)
+        verifications = defaultdict(int)
+        operators = defaultdict(lambda: {"arrivals": 0, "departures": 0, "verifications": 0, "recent": 0})
+        for row in rows:
+            metric, total = row["metric"], int(row["total"])
+            if metric.startswith("verification:"):
+                verifications[metric.split(":", 1)[1]] += total
+                kind = "verifications"
+            else:
+                totals[metric] += total
+                kind = metric
+            if row["operator_id"] not in (SEED_OPERATOR, NO_OPERATOR):
+                operator = operators[str(row["operator_id"])]
+                operator[kind] += total
+                operator["recent"] += int(row["recent"])
+
+        return {
+            "date": now.date().isoformat(),
+            "arrivals": totals["arrivals"],
+            "departures": totals["departures"],
+            "inside_now": max(totals["arrivals"] - totals["departures"], 0),
+            "verifications": dict(verifications),
+            "operators": {
+                operator_id: {
+                    "arrivals": counts["arrivals"],
+                    "departures": counts["departures"],
+                    "verifications": counts["verifications"],
+                    # Minute buckets, so the rate is approximate at the window edge
+                    "per_minute": round(counts["recent"] * 60 / LiveStatsConfig.RATE_WINDOW_SECONDS, 2),
+                }
+                for operator_id, counts in operators.items()
+            },
+        }
+
+    def publish(self, write_batch: Callable[[Dict], None]) -> bool:
+        """Flush, then write the summed snapshot to the live stats path if it changed since the last publish"""
+        db = self.session_factory()
+        try:
+            self.flush(db)
+            snapshot = self.snapshot(db)
+        finally:
+            db.close()
+        if snapshot == self._published:
+            return False
+        write_batch({LiveStatsConfig.PATH: {**snapshot, "updated_at": datetime.utcnow().isoformat()}})
+        self._published = snapshot
+        return True
+
+    def start(self, write_batch: Callable[[Dict], None]) -> None:
+        if self._thread is not None:
+            return
+
+        def run():
+            while not self._stopping.wait(LiveStatsConfig.PUBLISH_SECONDS):
+                try:
+                    self.publish(write_batch)
+                except Exception as e:
+                    print(f"Error publishing live stats: {str(e)}")
+
+        self._thread = threading.Thread(target=run, name="live-stats", daemon=True)
+        self._thread.start()
+
+    def stop(self, write_batch: Optional[Callable[[Dict], None]] = None) -> None:
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(5)
+        if write_batch is not None:
+            try:
+                self.publish(write_batch)
+            except Exception as e:
+                print(f"Error publishing live stats: {str(e)}")
+
+def seed_live_stats(db: Session) -> None:
+    """
+    Backfill today's arrivals and departures from FinalRecords, counted inside Postgres.
+    Runs once per day across all workers: skipped as soon as any counter for today exists.
+    """
+    today = datetime.utcnow().date()
+    db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SEED_LOCK_KEY})
+    if db.execute(text("SELECT 1 FROM live_stats_counters WHERE day = :today LIMIT 1"), {"today": today}).first():
+        db.commit()
+        print("Live stats already counting today, not seeding")
+        return
+    row = db.execute(text("""
+        SELECT
+            count(*) AS arrivals,
+            count(*) FILTER (WHERE COALESCE(log->>'departure', '') <> '') AS departures
+        FROM final_records r
+        CROSS JOIN LATERAL jsonb_array_elements(
+            CASE WHEN jsonb_typeof(r.time_logs) = 'array' THEN r.time_logs ELSE '[]'::jsonb END
+        ) AS log
+        WHERE r.entry_date = :today
+    """), {"today": today}).mappings().first()
+    arrivals, departures = row["arrivals"], row["departures"]
+    midnight = datetime.combine(today, datetime.min.time())
+    db.execute(text(COUNTER_UPSERT), [
+        {"day": today, "operator_id": SEED_OPERATOR, "bucket_minute": midnight, "metric": metric, "count": count}
+        for metric, count in (("arrivals", arrivals), ("departures", departures))
+    ])
+    db.commit()
+    print(f"Live stats seeded with {arrivals} arrivals and {departures} departures")
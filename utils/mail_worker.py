@@ -0,0 +1,216 @@
+import os
+import queue
+import smtplib
+import threading
+import time
+from email.message import Message
+from typing import Callable, Optional
+
+class MailWorkerConfig:
+    POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "2"))
+    # Provider sending limit, enforced across all connections
+    RATE_PER_MINUTE = float(os.getenv("SMTP_RATE_PER_MINUTE", "60"))
+    BURST = int(os.getenv("SMTP_BURST", "10"))
+    # Connections idle longer than this are checked with NOOP before reuse
+    IDLE_CHECK_SECONDS = int(os.getenv("SMTP_IDLE_CHECK_SECONDS", "60"))
+    QUEUE_SIZE = int(os.getenv("MAIL_QUEUE_SIZE", "5000"))
+
+class TokenBucket:
+    """Blocking token bucket: acquire() waits until a send is allowed"""
+
+    def __init__(self, rate_per_second: float, capacity: int):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class SMTPSession:
+    """One authenticated SMTP connection that is kept open between sends and reopened when it drops"""
+
+    def __init__(self, host: str, port: int, user: str, password: str):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.connection = None
+        self.last_used = 0
+        self.connects = 0
+
+    def _connect(self) -> None:
+        self.connection = smtplib.SMTP_SSL(self.host, self.port, timeout=30)
+        self.connection.login(self.user, self.password)
+        self.connects += 1
+
+    def _alive(self) -> bool:
+        try:
+            return self.connection.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def send(self, message: Message) -> None:
+        for attempt in range(2):
+            try:
+                if self.connection is None:
+                    self._connect()
+                elif time.monotonic() - self.last_used > MailWorkerConfig.IDLE_CHECK_SECONDS and not self._alive():
+                    self.close()
+                    self._connect()
+                self.connection.send_message(message)
+                self.last_used = time.monotonic()
+                return
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, OSError):
+                # Dropped connection: reconnect once, other SMTP errors are not retried here
+                self.close()
+                if attempt == 1:
+                    raise
+
+    def close(self) -> None:
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.connection = None
+
+class MailWorker:
+    """
+    Sends mail from its own threads, each holding a persistent SMTP session.
+    Jobs build their message inside the worker, so callers only enqueue.
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], SMTPSession],
+        pool_size: int = None,
+        rate_per_minute: float = None,
+        burst: int = None,
+        queue_size: int = None,
+    ):
+        self.connect = connect
+        self.pool_size = pool_size or MailWorkerConfig.POOL_SIZE
+        self.bucket = TokenBucket(
+            (rate_per_minute or MailWorkerConfig.RATE_PER_MINUTE) / 60,
+            burst or MailWorkerConfig.BURST,
+        )
+        self._queue = queue.Queue(maxsize=queue_size or MailWorkerConfig.QUEUE_SIZE)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._sessions = []
+        self._stopping = threading.Event()
+
+        self.sent = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def _ensure_started(self) -> None:
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self.pool_size):
+                thread = threading.Thread(target=self._run, name=f"mail-worker-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(
+        self,
+        build_message: Callable[[], Optional[Message]],
+        description: str = "",
+        on_done: Optional[Callable[[Optional[Exception]], None]] = None,
+    ) -> bool:
+        """
+        Queue a job; build_message runs on a mail thread and returns the message to send.
+        on_done is called there with None after a successful send, or with the error.
+        """
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((build_message, description, on_done))
+            return True
+        except queue.Full:
+            self.rejected += 1
+            print(f"❌ Mail queue full, dropping {description}")
+            return False
+
+    def _run(self) -> None:
+        session = self.connect()
+        with self._lock:
+            self._sessions.append(session)
+        while not self._stopping.is_set():
+            try:
+                job = self._queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            if job is None:
+                break
+            build_message, description, on_done = job
+            error = None
+            try:
+                self.send(session, build_message())
+                print(f"✅ Sent {description}")
+            except Exception as e:
+                error = e
+                print(f"❌ Failed to send {description}: {str(e)}")
+            try:
+                if on_done:
+                    on_done(error)
+            except Exception as e:
+                # A failing callback must not take the mail thread down with it
+                print(f"❌ Mail callback failed for {description}: {str(e)}")
+            finally:
+                self._queue.task_done()
+        session.close()
+
+    def send(self, session: SMTPSession, message: Optional[Message]) -> None:
+        if message is None:
+            return
+        self.bucket.acquire()
+        try:
+            session.send(message)
+            self.sent += 1
+        except Exception:
+            self.failed += 1
+            raise
+
+    def free_slots(self) -> int:
+        return self._queue.maxsize - self._queue.qsize()
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "sent": self.sent,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "connections": sum(1 for s in self._sessions if s.connection is not None),
+            "connects": sum(s.connects for s in self._sessions),
+        }
+
+    def close(self, timeout: float = 30.0) -> None:
+        """Send what is queued within timeout seconds, then close the SMTP sessions"""
+        if not self._threads:
+            return
+        deadline = time.monotonic() + timeout
+        for _ in self._threads:
+            try:
+                self._queue.put(None, timeout=max(deadline - time.monotonic(), 0))
+            except queue.Full:
+                break
+        for thread in self._threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+        # Past the deadline threads stop after their current job and the rest of the queue is dropped
+        self._stopping.set()
+        unsent = sum(1 for job in list(self._queue.queue) if job is not None)
+        if unsent:
+            print(f"❌ Mail worker closed with {unsent} messages unsent")
+        self._threads = []
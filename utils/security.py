@@ -1,8 +1,49 @@
 from datetime import datetime, timedelta
+import hashlib
+import hmac
+import os
 import secrets
 from fastapi import HTTPException, Header
-from sqlalchemy.orm import Session
+from sqlalchemy import text
+from sqlalchemy.orm import Session, make_transient_to_detached
 import models
+from utils.api_key_cache import api_key_cache
+
+PASSWORD_HASH_ITERATIONS = int(os.getenv("PASSWORD_HASH_ITERATIONS", "100000"))
+
+def hash_password(password: str, iterations: int = PASSWORD_HASH_ITERATIONS) -> str:
+    """Salted PBKDF2 hash, stored as pbkdf2_sha256$iterations$salt$hash"""
+    salt = secrets.token_hex(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), bytes.fromhex(salt), iterations).hex()
+    return f"pbkdf2_sha256${iterations}${salt}${digest}"
+
+def check_password(password: str, encoded: str) -> bool:
+    try:
+        algorithm, iterations, salt, digest = encoded.split("$")
+    except (AttributeError, ValueError):
+        return False
+    if algorithm != "pbkdf2_sha256":
+        return False
+    candidate = hashlib.pbkdf2_hmac("sha256", password.encode(), bytes.fromhex(salt), int(iterations)).hex()
+    return hmac.compare_digest(candidate, digest)
+
+def hash_api_key(api_key: str) -> str:
+    """API keys are random, so an unsalted SHA-256 is enough to keep them out of the table"""
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+def upgrade_api_key_storage(engine) -> None:
+    """Add the api_key_hash column to existing databases and hash the plaintext keys; safe to run on every start"""
+    with engine.begin() as connection:
+        connection.execute(text("ALTER TABLE app_users ADD COLUMN IF NOT EXISTS api_key_hash VARCHAR(64)"))
+        connection.execute(text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_app_users_api_key_hash ON app_users (api_key_hash)"
+        ))
+        result = connection.execute(text("""
+            UPDATE app_users SET api_key_hash = encode(sha256(convert_to(api_key, 'UTF8')), 'hex'), api_key = NULL
+            WHERE api_key IS NOT NULL
+        """))
+    if result.rowcount:
+        print(f"Hashed {result.rowcount} stored API keys")
 
 class SecurityHandler:
     def __init__(self):
@@ -17,10 +58,13 @@ class SecurityHandler:
         api_key = self.generate_api_key()
         expiry = datetime.utcnow() + timedelta(hours=self.API_KEY_EXPIRY_HOURS)
         
-        # Update user's API key and expiry
-        app_user.api_key = api_key
+        # Only the hash is stored; the previous key stops working on every worker
+        app_user.api_key = None
+        app_user.api_key_hash = hash_api_key(api_key)
         app_user.api_key_expiry = expiry
+        api_key_cache.notify(db, app_user.user_id)
         db.commit()
+        api_key_cache.invalidate_user(app_user.user_id)
         
         return {
             "api_key": api_key,
@@ -31,8 +75,11 @@ class SecurityHandler:
         """Remove API key on logout"""
         try:
             app_user.api_key = None
+            app_user.api_key_hash = None
             app_user.api_key_expiry = None
+            api_key_cache.notify(db, app_user.user_id)
             db.commit()
+            api_key_cache.invalidate_user(app_user.user_id)
             return True
         except Exception as e:
             db.rollback()
@@ -42,9 +89,18 @@ class SecurityHandler:
         """Verify API key and check expiry"""
         if not api_key:
             raise HTTPException(status_code=401, detail="API key is required")
-            
+
+        key_hash = hash_api_key(api_key)
+        cached = api_key_cache.get(key_hash)
+        if cached is not None:
+            # Attach the cached row to this session without a query, callers may still update it
+            app_user = models.AppUsers(**cached)
+            make_transient_to_detached(app_user)
+            return db.merge(app_user, load=False)
+
+        generation = api_key_cache.generation()
         app_user = db.query(models.AppUsers).filter(
-            models.AppUsers.api_key == api_key
+            models.AppUsers.api_key_hash == key_hash
         ).first()
         
         if not app_user:
@@ -53,10 +109,14 @@ class SecurityHandler:
         if not app_user.api_key_expiry or app_user.api_key_expiry < datetime.utcnow():
             # Clear expired key
             app_user.api_key = None
+            app_user.api_key_hash = None
             app_user.api_key_expiry = None
             db.commit()
             raise HTTPException(status_code=401, detail="API key expired. Please login again")
-            
+
+        api_key_cache.put(key_hash, app_user.user_id, app_user.api_key_expiry, {
+            column.key: getattr(app_user, column.key) for column in models.AppUsers.__table__.columns
+        }, generation)
         return app_user
 
 security_handler = SecurityHandler() 
\ No newline at end of file
@@ -0,0 +1,253 @@
+import os
+import shutil
+from datetime import datetime, timezone
+from io import BytesIO
+from typing import Iterator, Optional, Tuple
+from uuid import uuid4
+from fastapi import HTTPException
+from fastapi.responses import FileResponse, RedirectResponse, StreamingResponse
+
+CHUNK_SIZE = 1024 * 1024
+
+class StorageConfig:
+    # "local" or "s3"
+    BACKEND = os.getenv("STORAGE_BACKEND", "local")
+
+    # Local filesystem root; keys are resolved against it instead of the working directory.
+    # Defaults to a data directory outside the source tree, which holds credentials
+    LOCAL_ROOT = os.getenv("STORAGE_ROOT") or os.path.join(
+        os.getenv("XDG_DATA_HOME") or os.path.expanduser("~/.local/share"), "spring_festival"
+    )
+
+    # S3-compatible object storage (AWS S3, MinIO, ...)
+    S3_BUCKET = os.getenv("S3_BUCKET", "spring-festival")
+    S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")  # e.g. http://localhost:9000 for MinIO
+    S3_REGION = os.getenv("S3_REGION", "us-east-1")
+    S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY")
+    S3_SECRET_KEY = os.getenv("S3_SECRET_KEY")
+    S3_URL_EXPIRY_SECONDS = int(os.getenv("S3_URL_EXPIRY_SECONDS", "300"))
+
+def normalize_key(key: str) -> str:
+    """Turn a stored path into a storage key and reject anything escaping the storage root"""
+    if not key:
+        raise ValueError("Empty storage key")
+    normalized = os.path.normpath(key.replace("\\", "/")).replace(os.sep, "/").lstrip("/")
+    if normalized == "." or normalized.startswith("../") or normalized == "..":
+        raise ValueError(f"Invalid storage key: {key}")
+    return normalized
+
+class StorageBackend:
+    """Interface shared by all storage drivers. Keys are relative, slash-separated paths"""
+
+    def open_read(self, key: str):
+        """Return a readable binary stream for the object"""
+        raise NotImplementedError
+
+    def read_bytes(self, key: str) -> bytes:
+        with self.open_read(key) as stream:
+            return stream.read()
+
+    def write_stream(self, key: str, stream, content_type: Optional[str] = None) -> None:
+        """Store the contents of a binary stream; readers never observe a partial object"""
+        raise NotImplementedError
+
+    def write_bytes(self, key: str, data: bytes, content_type: Optional[str] = None) -> None:
+        self.write_stream(key, BytesIO(data), content_type)
+
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def list(self, prefix: str) -> Iterator[str]:
+        """Yield every key under a prefix"""
+        raise NotImplementedError
+
+    def list_modified(self, prefix: str) -> Iterator[Tuple[str, datetime]]:
+        """Yield (key, last modified as naive UTC) for every key under a prefix"""
+        raise NotImplementedError
+
+    def local_path(self, key: str) -> Optional[str]:
+        """Filesystem path of the object, if the driver keeps objects on local disk"""
+        return None
+
+    def presigned_url(self, key: str, filename: Optional[str] = None, media_type: Optional[str] = None) -> Optional[str]:
+        """Short-lived URL clients can fetch the object from directly, if the driver supports it"""
+        return None
+
+class LocalStorage(StorageBackend):
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, normalize_key(key))
+
+    def open_read(self, key: str):
+        try:
+            return open(self._path(key), "rb")
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Object not found: {key}")
+
+    def write_stream(self, key: str, stream, content_type: Optional[str] = None) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write next to the target and rename so readers never see a partial file
+        temp_path = f"{path}.{uuid4().hex}.tmp"
+        try:
+            with open(temp_path, "wb") as buffer:
+                shutil.copyfileobj(stream, buffer, CHUNK_SIZE)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self._path(key))
+
+    def delete(self, key: str) -> None:
+        path = self._path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def list(self, prefix: str) -> Iterator[str]:
+        base = self._path(prefix)
+        if os.path.isfile(base):
+            yield normalize_key(prefix)
+            return
+        for dirpath, _, filenames in os.walk(base):
+            for filename in filenames:
+                if filename.endswith(".tmp"):
+                    continue
+                yield os.path.relpath(os.path.join(dirpath, filename), self.root).replace(os.sep, "/")
+
+    def list_modified(self, prefix: str) -> Iterator[Tuple[str, datetime]]:
+        for key in self.list(prefix):
+            try:
+                yield key, datetime.utcfromtimestamp(os.path.getmtime(self._path(key)))
+            except FileNotFoundError:
+                continue
+
+    def local_path(self, key: str) -> Optional[str]:
+        return self._path(key)
+
+class S3Storage(StorageBackend):
+    """
+    Driver for S3-compatible object stores. For local testing point it at MinIO:
+    docker run -p 9000:9000 minio/minio server /data, then set S3_ENDPOINT_URL=http://localhost:9000
+    """
+
+    def __init__(self, bucket: str, endpoint_url: Optional[str] = None, region: Optional[str] = None,
+                 access_key: Optional[str] = None, secret_key: Optional[str] = None,
+                 url_expiry_seconds: int = 300):
+        try:
+            import boto3
+            from botocore.client import Config
+        except ImportError:
+            raise RuntimeError("boto3 is required for STORAGE_BACKEND=s3")
+
+        self.bucket = bucket
+        self.url_expiry_seconds = url_expiry_seconds
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            region_name=region,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            # Path-style addressing works with MinIO and other self-hosted endpoints
+            config=Config(signature_version="s3v4", s3={"addressing_style": "path"}),
+        )
+
+    def open_read(self, key: str):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=normalize_key(key))["Body"]
+        except self.client.exceptions.NoSuchKey:
+            raise FileNotFoundError(f"Object not found: {key}")
+
+    def write_stream(self, key: str, stream, content_type: Optional[str] = None) -> None:
+        # upload_fileobj streams in multipart chunks; the object only appears once complete
+        extra_args = {"ContentType": content_type} if content_type else None
+        self.client.upload_fileobj(stream, self.bucket, normalize_key(key), ExtraArgs=extra_args)
+
+    def exists(self, key: str) -> bool:
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=normalize_key(key))
+            return True
+        except ClientError as e:
+            # Only a missing object means False; auth, throttling and network errors propagate
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def delete(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=normalize_key(key))
+
+    def list(self, prefix: str) -> Iterator[str]:
+        paginator = self.client.get_paginator("list_objects_v2")
+        # Keep the trailing slash so "uploads/" does not also match "uploads_old/"
+        s3_prefix = normalize_key(prefix) + ("/" if prefix.endswith("/") else "")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=s3_prefix):
+            for item in page.get("Contents", []):
+                yield item["Key"]
+
+    def list_modified(self, prefix: str) -> Iterator[Tuple[str, datetime]]:
+        paginator = self.client.get_paginator("list_objects_v2")
+        s3_prefix = normalize_key(prefix) + ("/" if prefix.endswith("/") else "")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=s3_prefix):
+            for item in page.get("Contents", []):
+                yield item["Key"], item["LastModified"].astimezone(timezone.utc).replace(tzinfo=None)
+
+    def presigned_url(self, key: str, filename: Optional[str] = None, media_type: Optional[str] = None) -> Optional[str]:
+        params = {"Bucket": self.bucket, "Key": normalize_key(key)}
+        if filename:
+            params["ResponseContentDisposition"] = f'attachment; filename="{filename}"'
+        if media_type:
+            params["ResponseContentType"] = media_type
+        return self.client.generate_presigned_url(
+            "get_object", Params=params, ExpiresIn=self.url_expiry_seconds
+        )
+
+def create_storage() -> StorageBackend:
+    """Build the storage driver selected by StorageConfig"""
+    if StorageConfig.BACKEND == "s3":
+        return S3Storage(
+            bucket=StorageConfig.S3_BUCKET,
+            endpoint_url=StorageConfig.S3_ENDPOINT_URL,
+            region=StorageConfig.S3_REGION,
+            access_key=StorageConfig.S3_ACCESS_KEY,
+            secret_key=StorageConfig.S3_SECRET_KEY,
+            url_expiry_seconds=StorageConfig.S3_URL_EXPIRY_SECONDS,
+        )
+    if StorageConfig.BACKEND == "local":
+        return LocalStorage(StorageConfig.LOCAL_ROOT)
+    raise ValueError(f"Unknown storage backend: {StorageConfig.BACKEND}")
+
+storage = create_storage()
+
+def file_response(key: str, media_type: str, filename: Optional[str] = None):
+    """
+    Serve a stored object. Drivers with presigned URLs get a redirect so this node
+    does not proxy the bytes; local files are sent with sendfile.
+    """
+    try:
+        key = normalize_key(key)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid file path")
+
+    url = storage.presigned_url(key, filename=filename, media_type=media_type)
+    if url:
+        return RedirectResponse(url, status_code=307)
+
+    path = storage.local_path(key)
+    if path:
+        if not os.path.isfile(path):
+            raise HTTPException(status_code=404, detail="File not found")
+        return FileResponse(path=path, filename=filename, media_type=media_type)
+
+    if not storage.exists(key):
+        raise HTTPException(status_code=404, detail="File not found")
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'} if filename else None
+    stream = storage.open_read(key)
+    return StreamingResponse(iter(lambda: stream.read(CHUNK_SIZE), b""), media_type=media_type, headers=headers)